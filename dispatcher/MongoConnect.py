@@ -1,5 +1,7 @@
 import datetime
-from daqnt import DAQ_STATUS
+from daqnt import DAQ_STATUS, ChannelHistory, StatusAnomalyDetector
+from daqnt.failure_detector import PhiAccrualDetector
+from daqnt.database import status_order
 import threading
 import time
 import pytz
@@ -71,6 +73,39 @@ class MongoConnect(object):
         # Timeout (in seconds). How long must a node not report to be considered timing out
         self.timeout = int(config['ClientTimeout'])
 
+        # Once we've seen enough status updates from a node we judge it on how late its
+        # next update is compared to its usual cadence, within [min, max] seconds
+        self.failure_detector = PhiAccrualDetector(
+                threshold=float(config.get('HeartbeatPhiThreshold', '8')),
+                min_timeout=float(config.get('ClientTimeoutMin', '3')),
+                max_timeout=float(config.get('ClientTimeoutMax', str(3*self.timeout))),
+                fallback_timeout=self.timeout,
+                window=int(config.get('HeartbeatWindow', '100')))
+        # Latest phi of each node, for the dispatcher and hypervisor
+        self.suspicion = {}
+        # The newest status doc we've seen from each node, and the ones
+        # that came in since the previous update (oldest first)
+        self.last_status_doc = {}
+        self.new_status_docs = {}
+        # After an outage don't pull more than this many docs per node
+        self.status_fetch_limit = 100
+        # '_id' or 'time', depending on whether status is a time-series collection
+        self.status_order = None
+
+        # Per-channel kB of each run, from the channels map of the status docs
+        self.channel_history = ChannelHistory(
+                bin_width=float(config.get('ChannelHistoryBinWidth', '10')),
+                output_dir=config.get('ChannelHistoryDir', None))
+        # {detector: channels we expect data from}, from the cable map
+        self.expected_channels = {}
+
+        # Watches rate, buffer and PLL of each node for signs of trouble, warning
+        # at most every AnomalyWarningInterval seconds per node and kind
+        self.anomaly_detector = StatusAnomalyDetector(
+                buffer_limit=float(config.get('AnomalyBufferLimit', '8000')),
+                horizon=float(config.get('AnomalyHorizon', '300')))
+        self.anomaly_interval = float(config.get('AnomalyWarningInterval', '600'))
+
         # How long a node can be timing out or missed an ack before it gets fixed (TPC only)
         self.timeout_take_action = int(config['TimeoutActionThreshold'])
 
@@ -151,13 +186,9 @@ class MongoConnect(object):
                 # print(f'detector is {detector}')
                 for host in dc[detector]['readers'].keys():
                     # print(f'the host is {host}')
-                    doc = self.collections['node_status'].find_one({'host': host},
-                                                                   sort=[('_id', -1)])
-                    dc[detector]['readers'][host] = doc
+                    dc[detector]['readers'][host] = self.get_latest_status(host)
                 for host in dc[detector]['controller'].keys():
-                    doc = self.collections['node_status'].find_one({'host': host},
-                                                                    sort=[('_id', -1)])
-                    dc[detector]['controller'][host] = doc
+                    dc[detector]['controller'][host] = self.get_latest_status(host)
                     # print(f'the doc is {doc}')
         except Exception as e:
             self.logger.error(f'Got error while getting update: {type(e)}: {e}')
@@ -168,6 +199,60 @@ class MongoConnect(object):
         # Now compute aggregate status
         return self.latest_status if self.aggregate_status() is None else None
 
+    def get_latest_status(self, host):
+        """
+        Fetches the status docs this host wrote since we last looked, feeds
+        their times to the failure detector, and returns the newest one
+        """
+        coll = self.collections['node_status']
+        if self.status_order is None:
+            self.status_order = status_order(coll)
+        order = self.status_order
+        if (last := self.last_status_doc.get(host)) is None:
+            docs = [coll.find_one({'host': host}, sort=[(order, -1)])]
+        else:
+            docs = list(coll.find({'host': host, order: {'$gt': last[order]}},
+                                  sort=[(order, -1)], limit=self.status_fetch_limit))
+        docs = [doc for doc in docs if doc is not None][::-1]
+        self.new_status_docs[host] = docs
+        # the failure detector wants the docs' own spacing, moved onto our clock.
+        # The first doc we get of a host may be long gone, is_timeout seeds with it
+        if last is not None:
+            self.failure_detector.observe(host, [self.status_time(doc) for doc in docs],
+                                          time.time())
+        for doc in docs:
+            t = self.status_time(doc)
+            if host in self.host_config:
+                self.channel_history.add(doc, t)
+                for kind, message in self.anomaly_detector.update(host, doc, t):
+                    etype = f'{kind}_{host}'
+                    self.error_timeouts.setdefault(etype, self.anomaly_interval)
+                    self.log_error(message, 'WARNING', etype)
+        if len(docs) > 0:
+            self.last_status_doc[host] = docs[-1]
+        return self.last_status_doc.get(host)
+
+    @staticmethod
+    def status_time(doc):
+        """
+        When a status doc was written (unix timestamp). The 'time' field has ms
+        resolution, the _id only seconds
+        """
+        if 'time' in doc:
+            return doc['time'].replace(tzinfo=pytz.utc).timestamp()
+        return int(str(doc['_id'])[:8], 16)
+
+    def get_suspicion(self, host=None):
+        """
+        How suspicious we are that nodes are dead (phi, 0 = all good, 8 = pretty sure)
+        :param host: a node, or None for all of them
+        :returns: float, or dict {host: float}
+        """
+        self.suspicion = self.failure_detector.suspicion(time.time())
+        if host is None:
+            return dict(self.suspicion)
+        return self.suspicion.get(host, 0.)
+
     def clear_error_timeouts(self):
         self.error_sent = {}
 
@@ -291,12 +376,16 @@ class MongoConnect(object):
         """
         host = doc['host']
         # print('is timeout doc',doc)
-        dt = t - int(str(doc['_id'])[:8], 16)
+        dt = t - self.status_time(doc)
         has_ackd = self.host_ackd_command(host)
         # print(f'it has ackd {has_ackd}')
         ret = False
-        if dt > self.timeout:
-            self.logger.debug(f'{host} last reported {int(dt)} sec ago')
+        self.suspicion[host] = self.failure_detector.phi(host, t)
+        if host not in self.failure_detector.last:
+            # the first doc we see of a host may be long gone, that's all we can judge it on
+            self.failure_detector.heartbeat(host, min(t, self.status_time(doc)))
+        if self.failure_detector.is_dead(host, t):
+            self.logger.debug(f'{host} last reported {dt:.1f} sec ago (phi {self.suspicion[host]:.1f})')
             ret = ret or True
         if has_ackd is not None and t - has_ackd > self.timeout_take_action:
             if host not in self.host_is_timeout:
@@ -520,16 +609,13 @@ class MongoConnect(object):
                                 'max': {'$max': '$rate'}}}
                     ]):
                     rate[doc['_id']] = {'avg': doc['avg'], 'max': doc['max']}
-                channels = set()
-                # if 'xams' in detectors:
-                #     # figure out which channels weren't running
-                #     readers = list(self.latest_status[detectors]['readers'].keys())
-                #     for doc in self.collections['node_status'].find({'host': {'$in': readers}, 'number': int(number)}):
-                #         channels |= set(map(int, doc['channels'].keys()))
-                # print('line 527')
                 updates = {'rate': rate}
-                # if len(channels):
-                #     updates['no_data_from'] = sorted(list(set(range(494)) - channels))
+                # per-channel totals and which channels weren't running, from
+                # what we accumulated during the run
+                channels = self.channel_history.finish(int(number),
+                                                       self.get_expected_channels(detectors))
+                if channels is not None:
+                    updates.update(channels)
                 self.collections['run'].update_one({'number': int(number)},
                                                    {'$set': updates})
                 # print('line 533')
@@ -542,6 +628,23 @@ class MongoConnect(object):
             self.logger.error(f"Database having a moment, hope this doesn't crash. {type(e)}, {e}")
         return
 
+    def get_expected_channels(self, detectors):
+        """
+        The channels of these detectors according to the cable map, None if it
+        doesn't know about them
+        """
+        if isinstance(detectors, str):
+            detectors = [detectors]
+        key = ','.join(sorted(detectors))
+        if key not in self.expected_channels:
+            try:
+                channels = self.dax_db['cable_map'].distinct('pmt', {'detector': {'$in': detectors}})
+            except Exception as e:
+                self.logger.debug(f'Couldn\'t read the cable map: {type(e)}, {e}')
+                return None
+            self.expected_channels[key] = channels or None
+        return self.expected_channels[key]
+
     def get_ack_time(self, detector, command, recurse=True):
         '''
         Finds the time when specified detector's crate controller ack'd the specified command
@@ -714,7 +817,7 @@ class MongoConnect(object):
             return
         self.error_sent[etype] = nowtime
         try:
-            self.collections['log'].insert({
+            self.collections['log'].insert_one({
                 "user": "dispatcher",
                 "message": message,
                 "priority": self.loglevels[priority]
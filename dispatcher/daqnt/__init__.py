@@ -3,4 +3,11 @@ from .logger import get_daq_logger, DAQLogHandler
 from .signal_handler import *
 from .database import *
 from .daq_status import *
+# what the dispatcher and hypervisor use. The chunk and file tools (chunks,
+# chunk_validator, consolidate, ...) are submodules to import explicitly, so
+# they don't get loaded into the dispatcher. So is failure_detector, because
+# it's also run with python -m
+from .channel_history import ChannelHistory
+from .anomaly import StatusAnomalyDetector
 # from .slackbot import DaqntBot
+
@@ -0,0 +1,150 @@
+"""
+Streaming anomaly detection on the status documents of the readers
+
+A reader usually gets in trouble well before it times out: its buffer fills
+up because it can't write as fast as it reads, its rate collapses, or its
+clock loses lock. StatusAnomalyDetector keeps, per host, an exponentially
+weighted mean and variance of the rate, a level + trend (Holt) estimate of
+the buffer, and the last PLL unlock counter. From those it forecasts when the
+buffer will be full and flags what looks wrong, as soon as the status doc
+that shows it arrives. All weights are time-based (time constants in seconds),
+so irregular check-ins are fine, and the state per host is a few numbers.
+"""
+import math
+import typing as ty
+from .daq_status import DAQ_STATUS
+
+__all__ = ['StatusAnomalyDetector']
+
+
+class _HostState(object):
+    __slots__ = ['t', 'n', 'mode', 'number', 'rate_mean', 'rate_var',
+                 'buf_level', 'buf_trend', 'pll']
+
+    def __init__(self, t, doc):
+        self.t = t
+        self.n = 0
+        self.mode = doc.get('mode')
+        self.number = doc.get('number')
+        self.rate_mean = doc.get('rate', 0.) or 0.
+        self.rate_var = 0.
+        self.buf_level = doc.get('buffer_size', 0.) or 0.
+        self.buf_trend = 0.
+        self.pll = doc.get('pll')
+
+
+class StatusAnomalyDetector(object):
+    """Per-host EWMA/trend tracking of rate, buffer and PLL unlocks"""
+
+    def __init__(self,
+                 buffer_limit: float = 8000.,
+                 horizon: float = 300.,
+                 rate_tau: float = 60.,
+                 buffer_tau: float = 10.,
+                 trend_tau: float = 60.,
+                 min_samples: int = 10,
+                 min_trend: float = 0.5,
+                 min_rate: float = 1.,
+                 drop_fraction: float = 0.1,
+                 spike_sigma: float = 6.):
+        """
+        :param buffer_limit: buffer size (MB) at which a reader is in trouble
+        :param horizon: warn if the buffer is forecast to reach the limit within
+            this many seconds
+        :param rate_tau: time constant (s) of the rate mean and variance
+        :param buffer_tau: time constant (s) of the buffer level
+        :param trend_tau: time constant (s) of the buffer trend
+        :param min_samples: docs we need from a host before we judge it
+        :param min_trend: ignore buffer growth slower than this (MB/s)
+        :param min_rate: only look for rate drops if the usual rate is above this (MB/s)
+        :param drop_fraction: a rate below this fraction of the usual is a drop
+        :param spike_sigma: a rate this many std above the usual is a spike
+        """
+        self.buffer_limit = buffer_limit
+        self.horizon = horizon
+        self.rate_tau = rate_tau
+        self.buffer_tau = buffer_tau
+        self.trend_tau = trend_tau
+        self.min_samples = min_samples
+        self.min_trend = min_trend
+        self.min_rate = min_rate
+        self.drop_fraction = drop_fraction
+        self.spike_sigma = spike_sigma
+        self.hosts = {}
+
+    @staticmethod
+    def _weight(dt: float, tau: float) -> float:
+        return 1. - math.exp(-dt / tau)
+
+    def update(self, host: str, doc: dict, t: float) -> ty.List[ty.Tuple[str, str]]:
+        """
+        Add a status doc
+        :param host: who sent it
+        :param doc: the status doc
+        :param t: when it was written (unix timestamp)
+        :returns: list of (kind, message) of what looks wrong, kind is one of
+            BUFFER, RATE_DROP, RATE_SPIKE, PLL
+        """
+        if (s := self.hosts.get(host)) is None:
+            self.hosts[host] = _HostState(t, doc)
+            return []
+        if (dt := t - s.t) <= 0:
+            return []
+        ret = []
+        rate = doc.get('rate', 0.) or 0.
+        buf = doc.get('buffer_size', 0.) or 0.
+        pll = doc.get('pll')
+        running = doc.get('status') == DAQ_STATUS.RUNNING
+        if doc.get('mode') != s.mode or doc.get('number') != s.number:
+            # new run, the old rate and pll counter mean nothing now
+            s.mode, s.number = doc.get('mode'), doc.get('number')
+            s.rate_mean, s.rate_var, s.n = rate, 0., 0
+            s.pll = pll
+
+        # rate, judged against what we had before this doc
+        if s.n >= self.min_samples and running:
+            std = math.sqrt(s.rate_var)
+            if s.rate_mean > self.min_rate and rate < self.drop_fraction * s.rate_mean:
+                ret.append(('RATE_DROP', f'{host} rate dropped to {rate:.2f} MB/s '
+                                         f'from a usual {s.rate_mean:.2f} MB/s'))
+            elif rate > 2 * s.rate_mean and rate - s.rate_mean > self.spike_sigma * max(std, 0.1):
+                ret.append(('RATE_SPIKE', f'{host} rate jumped to {rate:.2f} MB/s '
+                                          f'from a usual {s.rate_mean:.2f}+-{std:.2f} MB/s'))
+        a = self._weight(dt, self.rate_tau)
+        diff = rate - s.rate_mean
+        s.rate_mean += a * diff
+        s.rate_var = (1 - a) * (s.rate_var + a * diff * diff)
+
+        # buffer, Holt's linear trend with time-based weights
+        predicted = s.buf_level + s.buf_trend * dt
+        level = predicted + self._weight(dt, self.buffer_tau) * (buf - predicted)
+        s.buf_trend += self._weight(dt, self.trend_tau) * ((level - s.buf_level) / dt - s.buf_trend)
+        s.buf_level = level
+        if s.n >= self.min_samples and (tte := self.time_to_full(host)) is not None \
+                and tte < self.horizon:
+            ret.append(('BUFFER', f'{host} buffer at {buf:.0f} MB and growing '
+                                  f'{s.buf_trend:.1f} MB/s, full in ~{tte:.0f} s'))
+
+        # pll, a counter of unlocks since the start of the run
+        if pll is not None and s.pll is not None and pll > s.pll:
+            ret.append(('PLL', f'{host} lost PLL lock {pll - s.pll} more time(s), '
+                               f'{pll} this run'))
+        if pll is not None:
+            s.pll = pll
+
+        s.t = t
+        s.n += 1
+        return ret
+
+    def time_to_full(self, host: str) -> ty.Optional[float]:
+        """
+        Forecast of how long (s) until host's buffer reaches the limit, None
+            if it isn't growing (noticeably)
+        """
+        if (s := self.hosts.get(host)) is None or s.buf_trend < self.min_trend:
+            return None
+        return max(self.buffer_limit - s.buf_level, 0.) / s.buf_trend
+
+    def forget(self, host: str) -> None:
+        """Drop the state of a host, eg because it got restarted"""
+        self.hosts.pop(host, None)
@@ -0,0 +1,115 @@
+"""
+Per-channel rate history of each run, from the status documents
+
+Every status document from redax has a 'channels' map with how many kB each
+channel produced since the previous one. ChannelHistory adds these up into a
+channel x time matrix per run (time in bins of bin_width seconds), so that at
+the end of a run we know each channel's total and which channels sent nothing
+without going back to the status collection. The matrix is saved as
+<run>.npz, see ChannelHistory.load.
+"""
+import os
+import typing as ty
+import numpy as np
+
+__all__ = ['ChannelHistory']
+
+
+class _RunHistory(object):
+    """kB per channel per time bin of one run. Grows as needed"""
+
+    def __init__(self, start: float, bin_width: float):
+        self.start = start - start % bin_width
+        self.bin_width = bin_width
+        self.kb = np.zeros((0, 64), dtype=np.float32)
+        self.n_bins = 0
+        self.last_update = start
+
+    def add(self, t: float, channels: dict) -> None:
+        if len(channels) == 0:
+            return
+        ch = np.fromiter(map(int, channels.keys()), dtype=np.int64, count=len(channels))
+        kb = np.fromiter(channels.values(), dtype=np.float32, count=len(channels))
+        i = max(int((t - self.start) // self.bin_width), 0)
+        rows, cols = self.kb.shape
+        if ch.max() >= rows or i >= cols:
+            grown = np.zeros((max(rows, ch.max() + 1), max(cols, 2 * (i + 1))), dtype=np.float32)
+            grown[:rows, :cols] = self.kb
+            self.kb = grown
+        np.add.at(self.kb[:, i], ch, kb)
+        self.n_bins = max(self.n_bins, i + 1)
+        self.last_update = max(self.last_update, t)
+
+    def matrix(self) -> np.ndarray:
+        return self.kb[:, :self.n_bins]
+
+
+class ChannelHistory(object):
+    """Accumulates the channels maps of status docs per run"""
+
+    def __init__(self, bin_width: float = 10., max_runs: int = 4,
+                 output_dir: ty.Optional[str] = None):
+        """
+        :param bin_width: time bin (s)
+        :param max_runs: how many runs to keep track of at once. If a run never
+            gets finished (eg the dispatcher missed the stop) the oldest is dropped
+        :param output_dir: where to save each run's matrix, None to not save them
+        """
+        self.bin_width = bin_width
+        self.max_runs = max_runs
+        self.output_dir = output_dir
+        self.runs = {}
+
+    def add(self, doc: dict, t: float) -> None:
+        """
+        Add one status doc
+        :param doc: the status doc
+        :param t: when it was written (unix timestamp)
+        """
+        if (number := doc.get('number', -1)) is None or number < 0:
+            return
+        if number not in self.runs:
+            if len(self.runs) >= self.max_runs:
+                del self.runs[min(self.runs, key=lambda n: self.runs[n].last_update)]
+            self.runs[number] = _RunHistory(t, self.bin_width)
+        self.runs[number].add(t, doc.get('channels', {}))
+
+    def finish(self, number: int,
+               expected: ty.Optional[ty.Iterable[int]] = None) -> ty.Optional[dict]:
+        """
+        Done with this run: save its matrix and forget about it
+        :param number: the run number
+        :param expected: channels that should have sent data, if known
+        :returns: None if we saw nothing of this run, otherwise a dict for the
+            run doc with 'channel_totals' ({channel: kB}), 'no_data_from' (the
+            channels in expected or that we've seen that sent nothing) and, if
+            saved, 'channel_history' (where the matrix is)
+        """
+        if (run := self.runs.pop(number, None)) is None:
+            return None
+        kb = run.matrix()
+        totals = kb.sum(axis=1)
+        seen = np.flatnonzero(totals > 0)
+        if expected is None:
+            expected = range(len(totals))
+        ret = {'channel_totals': {str(ch): float(totals[ch]) for ch in seen},
+               'no_data_from': sorted(int(ch) for ch in expected
+                                      if ch >= len(totals) or totals[ch] == 0)}
+        if self.output_dir is not None:
+            os.makedirs(self.output_dir, exist_ok=True)
+            path = os.path.join(self.output_dir, f'{number:06d}.npz')
+            np.savez_compressed(path, kb=kb, start=run.start, bin_width=run.bin_width)
+            ret['channel_history'] = path
+        return ret
+
+    @staticmethod
+    def load(path: str) -> ty.Tuple[np.ndarray, np.ndarray]:
+        """
+        Read a saved run
+        :returns: (times, kb): the unix time of the start of each bin, and kB
+            per channel (row) and bin (column)
+        """
+        with np.load(path) as f:
+            kb = f['kb']
+            times = float(f['start']) + float(f['bin_width']) * np.arange(kb.shape[1])
+        return times, kb
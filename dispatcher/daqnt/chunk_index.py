@@ -0,0 +1,228 @@
+"""
+Per-run index of chunk files
+
+To read a time window or a few channels of a run you'd otherwise have to list
+every chunk directory and open every file. ChunkIndex keeps, for each file of
+a run, its chunk number, role (chunk/pre/post), writer (host_threadid),
+compressed and uncompressed size, fragment count, time range and the channels
+in it, in <run>/chunk_index.npz next to the chunks. It's updated incrementally
+(only new or changed files get opened), so it can follow a run as it's written,
+and answers "which files do I need for this time/these channels" without
+touching the data. Times are ns since the start of the run, like the
+fragments' own.
+
+    python -m daqnt.chunk_index /data/xenon/raw/xenonnt/012345 --follow
+    python -m daqnt.chunk_index /data/xenon/raw/xenonnt/012345 --start 60e9 --end 70e9
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+import typing as ty
+import numpy as np
+from .chunks import ChunkFile, list_chunk_files, read_chunk_file
+
+__all__ = ['ChunkIndex']
+
+INDEX_NAME = 'chunk_index.npz'
+KINDS = ['chunk', 'pre', 'post']
+INDEX_DTYPE = np.dtype([('chunk', '<i4'),
+                        ('kind', 'i1'),  # index in KINDS
+                        ('host', '<i2'),  # index in hosts
+                        ('size', '<i8'),  # on disk
+                        ('mtime', '<i8'),  # ns, to notice rewritten files
+                        ('bytes', '<i8'),  # uncompressed
+                        ('fragments', '<i8'),
+                        ('time_min', '<i8'),
+                        ('time_max', '<i8'),
+                        ('ch_start', '<i8'),  # this file's channels are
+                        ('ch_count', '<i4')])  # channels[ch_start:ch_start+ch_count]
+
+
+class ChunkIndex(object):
+    """The index of one run"""
+
+    def __init__(self, run_dir: str, payload_bytes: int = 220):
+        """
+        :param run_dir: the run's directory
+        :param payload_bytes: strax_fragment_payload_bytes of the run
+        """
+        self.run_dir = run_dir
+        self.payload_bytes = payload_bytes
+        self.entries = np.zeros(0, dtype=INDEX_DTYPE)
+        self.channels = np.zeros(0, dtype=np.int16)
+        self.hosts = []
+        self.complete = False
+
+    @property
+    def path(self) -> str:
+        return os.path.join(self.run_dir, INDEX_NAME)
+
+    @classmethod
+    def load(cls, run_dir: str, payload_bytes: int = 220) -> 'ChunkIndex':
+        """The saved index of a run, empty if there isn't one"""
+        index = cls(run_dir, payload_bytes)
+        if os.path.exists(index.path):
+            with np.load(index.path) as f:
+                index.entries = f['entries']
+                index.channels = f['channels']
+                index.hosts = [str(h) for h in f['hosts']]
+                index.complete = bool(f['complete'])
+                index.payload_bytes = int(f['payload_bytes'])
+        return index
+
+    def save(self) -> None:
+        """Write the index, atomically"""
+        tmp = self.path + '.tmp.npz'
+        np.savez(tmp, entries=self.entries, channels=self.channels,
+                 hosts=np.array(self.hosts, dtype=str), complete=self.complete,
+                 payload_bytes=self.payload_bytes)
+        os.replace(tmp, self.path)
+
+    def _index_file(self, f: ChunkFile) -> ty.Tuple[dict, np.ndarray]:
+        stat = os.stat(f.path)
+        entry = {'chunk': f.chunk, 'kind': KINDS.index(f.kind), 'size': stat.st_size,
+                 'mtime': stat.st_mtime_ns, 'bytes': 0, 'fragments': 0,
+                 'time_min': -1, 'time_max': -1}
+        channels = np.zeros(0, dtype=np.int16)
+        if stat.st_size > 0:
+            frags = read_chunk_file(f.path, self.payload_bytes)
+            entry['bytes'] = frags.nbytes
+            entry['fragments'] = len(frags)
+            if len(frags) > 0:
+                entry['time_min'] = int(frags['time'].min())
+                entry['time_max'] = int(frags['time'].max())
+                channels = np.unique(frags['channel'])
+        return entry, channels
+
+    def update(self, threads: int = 4) -> int:
+        """
+        Index files that are new or changed since the last update, and save
+        :returns: how many files got (re)indexed
+        """
+        known = {}
+        for i, e in enumerate(self.entries):
+            known[(int(e['chunk']), KINDS[e['kind']], self.hosts[e['host']])] = i
+        todo, keep = [], np.ones(len(self.entries), dtype=bool)
+        for f in list_chunk_files(self.run_dir, kinds=KINDS):
+            if (i := known.get((f.chunk, f.kind, f.host))) is not None:
+                stat = os.stat(f.path)
+                if stat.st_size == self.entries[i]['size'] and \
+                        stat.st_mtime_ns == self.entries[i]['mtime']:
+                    continue
+                keep[i] = False
+            todo.append(f)
+        complete = os.path.exists(os.path.join(self.run_dir, 'THE_END'))
+        if len(todo) == 0:
+            if complete != self.complete:
+                self.complete = complete
+                self.save()
+            return 0
+        self.complete = complete
+        with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+            results = list(pool.map(self._index_file, todo))
+
+        # drop what got rewritten, then append the new ones
+        old = self.entries[keep]
+        channels = [self.channels[e['ch_start']:e['ch_start'] + e['ch_count']] for e in old]
+        new = np.zeros(len(todo), dtype=INDEX_DTYPE)
+        for i, (f, (entry, ch)) in enumerate(zip(todo, results)):
+            if f.host not in self.hosts:
+                self.hosts.append(f.host)
+            entry['host'] = self.hosts.index(f.host)
+            for k, v in entry.items():
+                new[i][k] = v
+            channels.append(ch)
+        entries = np.concatenate([old, new])
+        counts = np.array([len(c) for c in channels], dtype=np.int64)
+        entries['ch_count'] = counts
+        entries['ch_start'] = np.cumsum(counts) - counts
+        order = np.lexsort((entries['host'], entries['kind'], entries['chunk']))
+        self.channels = np.concatenate(channels).astype(np.int16)
+        self.entries = entries[order]
+        self.save()
+        return len(todo)
+
+    def select(self,
+               start: ty.Optional[int] = None,
+               end: ty.Optional[int] = None,
+               channels: ty.Optional[ty.Iterable[int]] = None,
+               kinds: ty.Iterable[str] = ('chunk', 'post')) -> np.ndarray:
+        """
+        Which entries hold data in [start, end) (ns) from any of these channels
+        :param kinds: which files to consider. _pre duplicates the previous _post
+        :returns: the matching rows of entries
+        """
+        e = self.entries
+        mask = np.isin(e['kind'], [KINDS.index(k) for k in kinds]) & (e['fragments'] > 0)
+        if start is not None:
+            mask &= e['time_max'] >= start
+        if end is not None:
+            mask &= e['time_min'] < end
+        if channels is not None:
+            hit = np.isin(self.channels, np.asarray(list(channels)))
+            cs = np.concatenate([[0], np.cumsum(hit)])
+            mask &= (cs[e['ch_start'] + e['ch_count']] - cs[e['ch_start']]) > 0
+        return e[mask]
+
+    def files(self, start: ty.Optional[int] = None, end: ty.Optional[int] = None,
+              channels: ty.Optional[ty.Iterable[int]] = None,
+              kinds: ty.Iterable[str] = ('chunk', 'post')) -> ty.List[str]:
+        """Paths of the files to open for this time window and channels"""
+        ret = []
+        for e in self.select(start, end, channels, kinds):
+            name = f'{e["chunk"]:06d}' + ('' if e['kind'] == 0 else f'_{KINDS[e["kind"]]}')
+            ret.append(os.path.join(self.run_dir, name, self.hosts[e['host']]))
+        return ret
+
+    def channels_of(self, row: np.ndarray) -> np.ndarray:
+        """The channels in the file of one entry"""
+        return self.channels[row['ch_start']:row['ch_start'] + row['ch_count']]
+
+    def summary(self) -> dict:
+        e = self.select(kinds=KINDS)
+        return {'files': len(self.entries), 'chunks': len(np.unique(self.entries['chunk'])),
+                'hosts': len(self.hosts), 'size': int(self.entries['size'].sum()),
+                'bytes': int(self.entries['bytes'].sum()),
+                'fragments': int(self.select()['fragments'].sum()),
+                'time_min': int(e['time_min'].min()) if len(e) else None,
+                'time_max': int(e['time_max'].max()) if len(e) else None,
+                'channels': len(np.unique(self.channels)), 'complete': self.complete}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or query the chunk index of a run')
+    parser.add_argument('run_dir', help='The run\'s directory')
+    parser.add_argument('--payload-bytes', type=int, default=220)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--follow', action='store_true',
+                        help='Keep updating until the run has its THE_END')
+    parser.add_argument('--interval', type=float, default=5, help='Seconds between updates')
+    parser.add_argument('--start', type=float,
+                        help='Query: from this time (ns since the run start). Run once '
+                             'without a query first to build the index')
+    parser.add_argument('--end', type=float, help='Query: until this time (ns since the run start)')
+    parser.add_argument('--channels', type=int, nargs='+', help='Query: these channels')
+    args = parser.parse_args()
+
+    index = ChunkIndex.load(args.run_dir, args.payload_bytes)
+    if args.start is not None or args.end is not None or args.channels is not None:
+        t_start = time.perf_counter()
+        files = index.files(None if args.start is None else int(args.start),
+                            None if args.end is None else int(args.end), args.channels)
+        print(f'{len(files)} files ({(time.perf_counter() - t_start) * 1e3:.2f} ms)')
+        for f in files:
+            print(f)
+        return
+    while True:
+        t_start = time.time()
+        n = index.update(args.threads)
+        if n > 0:
+            print(f'Indexed {n} files in {time.time() - t_start:.2f} s: {index.summary()}')
+        if not args.follow or index.complete:
+            break
+        time.sleep(args.interval)
+
+
+if __name__ == '__main__':
+    main()
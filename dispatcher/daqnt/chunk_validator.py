@@ -0,0 +1,452 @@
+"""
+Live validation of the chunks redax writes
+
+Watches strax_output_path for chunk files as StraxFormatter publishes them
+(written to <chunk>_temp, then renamed into <chunk>), through inotify if we
+can and by polling otherwise, and checks each in a worker pool:
+ - it decompresses to a whole number of fragments
+ - the fragment headers make sense (length, dt, pulse_length, record_i)
+ - times are inside the chunk's (or overlap's) time range and, per channel, in order
+ - channels are in the mode's channel map
+ - <chunk>_post and <chunk+1>_pre of the same thread hold the same number of fragments
+Stats per run go to the chunk_validation collection every few seconds, and new
+problems are logged (rate-limited) to the log collection.
+
+    python -m daqnt.chunk_validator /data/xenon/raw/xenonnt
+"""
+import argparse
+import concurrent.futures
+import ctypes
+import ctypes.util
+import datetime
+import os
+import select
+import socket
+import struct
+import threading
+import time
+import typing as ty
+import numpy as np
+from .chunks import ChunkFile, chunk_time_range, parse_chunk_name, read_chunk_file
+
+__all__ = ['validate_chunk', 'ChunkValidator']
+
+# errors that raise an alarm. Anything else is only counted
+ALARMS = {'unreadable', 'bad_length', 'bad_dt', 'bad_pulse_length', 'bad_record_i',
+          'negative_time', 'outside_chunk', 'unknown_channel', 'overlap_mismatch'}
+
+
+def validate_chunk(f: ChunkFile,
+                   payload_bytes: int = 220,
+                   chunk_length: float = 5.,
+                   chunk_overlap: float = 0.5,
+                   channels: ty.Optional[np.ndarray] = None) -> dict:
+    """
+    Check one chunk file
+    :param f: the file
+    :param payload_bytes: strax_fragment_payload_bytes of the run
+    :param chunk_length: strax_chunk_length of the run (s)
+    :param chunk_overlap: strax_chunk_overlap of the run (s)
+    :param channels: sorted array of the channels in the channel map, None to not check
+    :returns: dict with fragments, bytes (uncompressed), compressed, time
+        ([min, max] or None), and errors ({kind: how many fragments})
+    """
+    ret = {'fragments': 0, 'bytes': 0, 'compressed': 0, 'time': None, 'errors': {}}
+    try:
+        ret['compressed'] = os.path.getsize(f.path)
+        frags = read_chunk_file(f.path, payload_bytes)
+    except Exception as e:
+        ret['errors']['unreadable'] = 1
+        ret['message'] = f'{type(e).__name__}: {e}'
+        return ret
+    ret['fragments'] = len(frags)
+    ret['bytes'] = frags.nbytes
+    if len(frags) == 0:
+        return ret
+    errors = ret['errors']
+
+    def flag(kind, mask):
+        if (n := int(np.count_nonzero(mask))) > 0:
+            errors[kind] = n
+
+    samples = payload_bytes // 2
+    t = frags['time']
+    length = frags['length']
+    pulse_length = frags['pulse_length']
+    record_i = frags['record_i'].astype(np.int64)
+    flag('bad_length', (length <= 0) | (length > samples))
+    flag('bad_dt', frags['dt'] <= 0)
+    flag('bad_pulse_length', pulse_length < length)
+    flag('bad_record_i', (record_i < 0) | (record_i * samples >= pulse_length))
+    flag('negative_time', t < 0)
+    lo, hi = chunk_time_range(f.chunk, f.kind, chunk_length, chunk_overlap)
+    flag('outside_chunk', (t < lo) | (t >= hi))
+    ch = frags['channel']
+    if channels is not None:
+        flag('unknown_channel', ~np.isin(ch, channels))
+    order = np.argsort(ch, kind='stable')
+    ch_sorted, t_sorted = ch[order], t[order]
+    flag('time_order', (ch_sorted[1:] == ch_sorted[:-1]) & (t_sorted[1:] < t_sorted[:-1]))
+    ret['time'] = [int(t.min()), int(t.max())]
+    return ret
+
+
+class _RunStats(object):
+    """Totals of one run"""
+
+    def __init__(self, number):
+        self.number = number
+        self.files = 0
+        self.empty_files = 0
+        self.fragments = 0
+        self.bytes = 0
+        self.compressed = 0
+        self.errors = {}
+        self.last_chunk = -1
+        self.time = [None, None]
+        # fragments per (chunk, host) of each overlap, to compare _post and _pre
+        self.overlaps = {'pre': {}, 'post': {}}
+        self.finished = False
+        self.changed = True
+        self.alarmed = {}
+
+    def add(self, f: ChunkFile, res: dict) -> ty.List[str]:
+        """:returns: the kinds of error this file had"""
+        self.files += 1
+        self.empty_files += res['fragments'] == 0
+        self.fragments += res['fragments']
+        self.bytes += res['bytes']
+        self.compressed += res['compressed']
+        self.last_chunk = max(self.last_chunk, f.chunk)
+        if res['time'] is not None:
+            self.time[0] = res['time'][0] if self.time[0] is None else min(self.time[0], res['time'][0])
+            self.time[1] = res['time'][1] if self.time[1] is None else max(self.time[1], res['time'][1])
+        errors = dict(res['errors'])
+        if f.kind in self.overlaps:
+            # _pre of chunk n is the _post of chunk n-1
+            key = (f.chunk - (f.kind == 'pre'), f.host)
+            self.overlaps[f.kind][key] = res['fragments']
+            other = self.overlaps['post' if f.kind == 'pre' else 'pre']
+            if key in other:
+                if other.pop(key) != res['fragments']:
+                    errors['overlap_mismatch'] = 1
+                del self.overlaps[f.kind][key]
+        for kind, n in errors.items():
+            self.errors[kind] = self.errors.get(kind, 0) + n
+        self.changed = True
+        return list(errors.keys())
+
+    def doc(self, hostname):
+        return {'number': self.number, 'host': hostname, 'files': self.files,
+                'empty_files': self.empty_files, 'fragments': self.fragments,
+                'bytes': self.bytes, 'compressed': self.compressed,
+                'errors': dict(self.errors), 'last_chunk': self.last_chunk,
+                'time_min': self.time[0], 'time_max': self.time[1],
+                'finished': self.finished,
+                'updated': datetime.datetime.now(datetime.timezone.utc)}
+
+
+class _Inotify(object):
+    """Just enough of inotify, through libc"""
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_Q_OVERFLOW = 0x4000
+    IN_IGNORED = 0x8000
+    IN_ISDIR = 0x40000000
+    MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    _event = struct.Struct('iIII')
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add = libc.inotify_add_watch
+        self._add.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self._rm = libc.inotify_rm_watch
+        self.fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        self.watches = {}  # wd: path
+
+    def add(self, path: str) -> None:
+        wd = self._add(self.fd, os.fsencode(path), self.MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), f'Can\'t watch {path}')
+        self.watches[wd] = path
+
+    def remove_under(self, path: str) -> None:
+        for wd, p in list(self.watches.items()):
+            if p == path or p.startswith(path + os.sep):
+                self._rm(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout: float) -> ty.List[ty.Tuple[str, str, int]]:
+        """:returns: list of (directory, name, mask). directory None means we lost events"""
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return []
+        try:
+            buf = os.read(self.fd, 1 << 16)
+        except BlockingIOError:
+            return []
+        ret = []
+        i = 0
+        while i < len(buf):
+            wd, mask, _, length = self._event.unpack_from(buf, i)
+            name = buf[i + self._event.size:i + self._event.size + length].rstrip(b'\0').decode()
+            i += self._event.size + length
+            if mask & self.IN_Q_OVERFLOW:
+                ret.append((None, '', mask))
+            elif mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches:
+                ret.append((self.watches[wd], name, mask))
+        return ret
+
+    def close(self):
+        os.close(self.fd)
+
+
+class ChunkValidator(object):
+    """Finds new chunk files under strax_output_path and validates them"""
+    # where the per-run stats go, and what keeps them
+    collection = 'chunk_validation'
+    stats_class = _RunStats
+
+    def __init__(self, output_path: str, workers: int = 4, db=None, runs_coll=None,
+                 logger=None, poll: float = 5., publish: float = 5., alarm_interval: float = 300.,
+                 settle: float = 60., use_inotify: bool = True):
+        """
+        :param output_path: strax_output_path
+        :param workers: how many files to validate at once
+        :param db: daq database for the stats and alarms, None to just print
+        :param runs_coll: the runs collection, for each run's settings and channel map
+        :param logger: optional logger
+        :param poll: seconds between scans if we don't have inotify
+        :param publish: seconds between stats updates
+        :param alarm_interval: at most one alarm per run and kind of error this often (s)
+        :param settle: stop following a run this long (s) after its THE_END shows up
+        :param use_inotify: try inotify before falling back to polling
+        """
+        self.output_path = os.path.abspath(output_path)
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.db = db
+        self.runs_coll = runs_coll
+        self.logger = logger
+        self.poll = poll
+        self.publish = publish
+        self.alarm_interval = alarm_interval
+        self.settle = settle
+        self.hostname = socket.gethostname()
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.settings = {}
+        self.seen = {}
+        self.ended = {}
+        # runs we're done with (or ignore)
+        self.done = set()
+        self.inotify = None
+        if use_inotify:
+            try:
+                self.inotify = _Inotify()
+            except (OSError, AttributeError) as e:
+                self.log(f'No inotify ({e}), polling every {poll} s')
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+        else:
+            print(msg)
+
+    def run_settings(self, number: int) -> dict:
+        """payload bytes, chunk length/overlap and channels of a run, from its run doc"""
+        if number in self.settings:
+            return self.settings[number]
+        cfg = {}
+        if self.runs_coll is not None:
+            try:
+                doc = self.runs_coll.find_one({'number': number}, {'daq_config': 1})
+                cfg = (doc or {}).get('daq_config', {}) or {}
+            except Exception as e:
+                self.log(f'Couldn\'t get the settings of run {number}: {type(e)}, {e}')
+        channels = None
+        if isinstance(cfg.get('channels'), dict):
+            channels = np.unique(np.array([c for chs in cfg['channels'].values() for c in chs],
+                                          dtype=np.int64))
+        self.settings[number] = {'payload_bytes': int(cfg.get('strax_fragment_payload_bytes', 220)),
+                                 'chunk_length': float(cfg.get('strax_chunk_length', 5)),
+                                 'chunk_overlap': float(cfg.get('strax_chunk_overlap', 0.5)),
+                                 'channels': channels}
+        return self.settings[number]
+
+    def submit(self, path: str) -> None:
+        """A file showed up, validate it if it's a chunk we haven't seen"""
+        chunk_dir, host = os.path.split(path)
+        run_dir, chunk_name = os.path.split(chunk_dir)
+        run_name = os.path.basename(run_dir)
+        if not run_name.isdigit() or os.path.dirname(run_dir) != self.output_path:
+            return
+        number = int(run_name)
+        if number in self.done:
+            return
+        if chunk_name == 'THE_END':
+            with self.lock:
+                self.ended.setdefault(number, time.time())
+            return
+        if (parsed := parse_chunk_name(chunk_name)) is None:
+            return
+        with self.lock:
+            seen = self.seen.setdefault(number, set())
+            if path in seen:
+                return
+            seen.add(path)
+            if number not in self.stats:
+                self.stats[number] = self.stats_class(number)
+        f = ChunkFile(path, parsed[0], parsed[1], host)
+        self.pool.submit(self._process, number, f)
+
+    def _process(self, number, f):
+        try:
+            res = validate_chunk(f, **self.run_settings(number))
+        except Exception as e:
+            self.log(f'Validating {f.path} ran into {type(e)}: {e}')
+            return
+        with self.lock:
+            stats = self.stats.get(number)
+            if stats is None:
+                return
+            kinds = stats.add(f, res)
+        for kind in kinds:
+            if kind in ALARMS:
+                self.alarm(stats, kind, f, res)
+
+    def alarm(self, stats, kind, f, res):
+        now = time.time()
+        if now - stats.alarmed.get(kind, 0) < self.alarm_interval:
+            return
+        stats.alarmed[kind] = now
+        msg = (f'Chunk validation: run {stats.number} {os.path.relpath(f.path, self.output_path)} '
+               f'has {kind} ({res["errors"].get(kind, 1)} of {res["fragments"]} fragments)')
+        if 'message' in res:
+            msg += f': {res["message"]}'
+        self.log(msg)
+        if self.db is not None:
+            try:
+                self.db['log'].insert_one({'user': 'chunk_validator', 'message': msg,
+                                           'priority': 2, 'runid': stats.number})
+            except Exception as e:
+                self.log(f'Couldn\'t log the alarm: {type(e)}, {e}')
+
+    def publish_stats(self) -> None:
+        with self.lock:
+            docs = []
+            for number, stats in self.stats.items():
+                if number in self.ended and time.time() - self.ended[number] > self.settle:
+                    stats.finished = stats.changed = True
+                if stats.changed:
+                    docs.append(stats.doc(self.hostname))
+                    stats.changed = False
+            for number in [n for n, s in self.stats.items() if s.finished]:
+                del self.stats[number]
+                self.done.add(number)
+                self.seen.pop(number, None)
+                self.settings.pop(number, None)
+                self.ended.pop(number, None)
+                if self.inotify is not None:
+                    self.inotify.remove_under(os.path.join(self.output_path, f'{number:06d}'))
+        for doc in docs:
+            if self.db is None:
+                print(doc)
+                continue
+            try:
+                self.db[self.collection].update_one(
+                    {'number': doc['number'], 'host': doc['host']}, {'$set': doc}, upsert=True)
+            except Exception as e:
+                self.log(f'Couldn\'t publish stats of run {doc["number"]}: {type(e)}, {e}')
+
+    def scan(self, path: str, watch: bool = False) -> None:
+        """Submit every file under path (a run or chunk directory, or the top), adding watches"""
+        try:
+            if watch and self.inotify is not None:
+                self.inotify.add(path)
+            with os.scandir(path) as it:
+                entries = list(it)
+        except OSError:
+            return
+        depth = os.path.relpath(path, self.output_path).count(os.sep) + (path != self.output_path)
+        for e in entries:
+            if e.is_dir(follow_symlinks=False):
+                if depth == 0 and not e.name.isdigit():
+                    continue
+                if depth == 1 and parse_chunk_name(e.name) is None and e.name != 'THE_END':
+                    continue
+                if depth == 0 and int(e.name) in self.done:
+                    continue
+                if depth < 2:
+                    self.scan(e.path, watch)
+            elif depth == 2:
+                self.submit(e.path)
+
+    def loop(self, stop: ty.Optional[threading.Event] = None, ignore_existing: bool = False):
+        """Run until stop is set"""
+        stop = stop or threading.Event()
+        if ignore_existing:
+            with os.scandir(self.output_path) as it:
+                self.done |= {int(e.name) for e in it if e.name.isdigit()}
+        self.scan(self.output_path, watch=True)
+        last_publish = last_poll = time.time()
+        while not stop.is_set():
+            if self.inotify is not None:
+                for directory, name, mask in self.inotify.read(0.5):
+                    if directory is None:
+                        self.log('inotify queue overflowed, rescanning')
+                        self.scan(self.output_path, watch=True)
+                        continue
+                    path = os.path.join(directory, name)
+                    if mask & _Inotify.IN_ISDIR:
+                        # whatever got in before the watch was added is found by the scan
+                        if not name.endswith('_temp'):
+                            self.scan(path, watch=True)
+                    elif mask & (_Inotify.IN_MOVED_TO | _Inotify.IN_CLOSE_WRITE):
+                        self.submit(path)
+            else:
+                stop.wait(0.5)
+                if time.time() - last_poll > self.poll:
+                    self.scan(self.output_path)
+                    last_poll = time.time()
+            if time.time() - last_publish > self.publish:
+                self.publish_stats()
+                last_publish = time.time()
+        self.pool.shutdown(wait=True)
+        self.publish_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Validate chunks as redax writes them')
+    parser.add_argument('output_path', help='strax_output_path')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--poll', type=float, default=5, help='Scan interval without inotify (s)')
+    parser.add_argument('--no-inotify', action='store_true', help='Always poll')
+    parser.add_argument('--publish', type=float, default=5, help='Stats update interval (s)')
+    parser.add_argument('--alarm-interval', type=float, default=300,
+                        help='At most one alarm per run and kind this often (s)')
+    parser.add_argument('--ignore-existing', action='store_true',
+                        help='Only validate runs that start after we do')
+    parser.add_argument('--no-db', action='store_true', help='Print instead of using the DB')
+    parser.add_argument('--runs-db', default='run')
+    parser.add_argument('--runs-coll', default='runs_gas')
+    args = parser.parse_args()
+
+    db = runs_coll = None
+    if not args.no_db:
+        from .database import get_client
+        db = get_client('daq')['daq']
+        runs_coll = get_client('run')[args.runs_db][args.runs_coll]
+    validator = ChunkValidator(args.output_path, args.workers, db, runs_coll, poll=args.poll,
+                               publish=args.publish, alarm_interval=args.alarm_interval,
+                               use_inotify=not args.no_inotify)
+    from .signal_handler import SignalHandler
+    sh = SignalHandler()
+    validator.loop(sh.event, args.ignore_existing)
+
+
+if __name__ == '__main__':
+    main()
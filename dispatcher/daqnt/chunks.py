@@ -0,0 +1,310 @@
+"""
+Reading the strax chunks redax writes
+
+StraxFormatter writes each chunk of each run as <strax_output_path>/<run>/<chunk>/<host>_<thread id>,
+with the last strax_chunk_overlap of every chunk also written to <chunk>_post and
+<chunk+1>_pre. Each file is a compressed (LZ4 frame or blosc) array of
+fixed-size fragments: a 24-byte header (time, length, dt, channel, pulse_length,
+record_i, baseline) followed by strax_fragment_payload_bytes of waveform.
+
+The files are decompressed into a buffer that is used directly as a NumPy
+structured array, without copying. Decompression releases the GIL, so a run is
+read with a thread pool.
+
+Run this module to benchmark reading a run:
+    python -m daqnt.chunks /data/xenonnt/012345 --threads 1 2 4 8
+"""
+import argparse
+import concurrent.futures
+import functools
+import os
+import re
+import time
+import typing as ty
+import numpy as np
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+try:
+    import blosc
+    # so the thread pool actually decompresses in parallel
+    blosc.set_releasegil(True)
+except ImportError:
+    blosc = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+__all__ = ['HEADER_SIZE', 'fragment_dtype', 'codec_of', 'compress', 'decompress',
+           'ChunkFile', 'parse_chunk_name', 'list_chunk_files', 'chunk_time_range',
+           'read_chunk_file', 'write_chunk_file', 'read_run']
+
+HEADER_SIZE = 24
+CODECS = ['lz4', 'blosc', 'zstd']
+_LZ4_MAGIC = b'\x04\x22\x4d\x18'
+_ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+
+
+@functools.lru_cache()
+def fragment_dtype(payload_bytes: int = 220) -> np.dtype:
+    """The dtype of a fragment (strax raw_records) for this strax_fragment_payload_bytes"""
+    return np.dtype([('time', '<i8'),
+                     ('length', '<i4'),
+                     ('dt', '<i2'),
+                     ('channel', '<i2'),
+                     ('pulse_length', '<i4'),
+                     ('record_i', '<i2'),
+                     ('baseline', '<i2'),
+                     ('data', '<i2', (payload_bytes // 2,))])
+
+
+def _need(module, name):
+    if module is None:
+        raise RuntimeError(f'{name} isn\'t installed')
+    return module
+
+
+def codec_of(buf: ty.Union[bytes, memoryview]) -> ty.Optional[str]:
+    """
+    Which codec a chunk file was compressed with, from its first bytes
+    :returns: 'lz4', 'blosc', 'zstd', 'empty', or None if we can't tell
+    """
+    if len(buf) == 0:
+        return 'empty'
+    head = bytes(buf[:16])
+    if head[:4] == _LZ4_MAGIC:
+        return 'lz4'
+    if head[:4] == _ZSTD_MAGIC:
+        return 'zstd'
+    # blosc: version, versionlz, flags, typesize, then uint32 nbytes, blocksize, cbytes
+    if len(head) == 16 and head[0] in (1, 2) and \
+            int.from_bytes(head[12:16], 'little') == len(buf):
+        return 'blosc'
+    return None
+
+
+def compress(data: ty.Union[bytes, np.ndarray], codec: str = 'lz4',
+             level: ty.Optional[int] = None) -> bytes:
+    """
+    Compress like StraxFormatter does
+    :param data: the fragments
+    :param codec: lz4, blosc or zstd
+    :param level: compression level, None for what redax uses (lz4 default, blosc 5)
+    """
+    if isinstance(data, np.ndarray):
+        data = memoryview(np.ascontiguousarray(data)).cast('B')
+    if codec == 'lz4':
+        return _need(lz4, 'lz4').frame.compress(
+            data, block_size=lz4.frame.BLOCKSIZE_MAX256KB, block_linked=True,
+            compression_level=level or 0)
+    if codec == 'blosc':
+        return _need(blosc, 'blosc').compress(bytes(data), typesize=1,
+                                              clevel=5 if level is None else level,
+                                              shuffle=blosc.SHUFFLE, cname='lz4')
+    if codec == 'zstd':
+        return _need(zstandard, 'zstandard').ZstdCompressor(
+            level=3 if level is None else level).compress(data)
+    raise ValueError(f'Unknown codec {codec}')
+
+
+def decompress(buf: bytes, codec: ty.Optional[str] = None) -> bytes:
+    """Decompress a chunk file's contents, figuring out the codec if not given"""
+    codec = codec or codec_of(buf)
+    if codec == 'empty':
+        return b''
+    if codec == 'lz4':
+        return _need(lz4, 'lz4').frame.decompress(buf)
+    if codec == 'blosc':
+        return _need(blosc, 'blosc').decompress(buf)
+    if codec == 'zstd':
+        return _need(zstandard, 'zstandard').ZstdDecompressor().decompress(buf)
+    raise ValueError('Unknown compression')
+
+
+class ChunkFile(ty.NamedTuple):
+    """One file of a run directory"""
+    path: str
+    chunk: int
+    kind: str  # 'chunk', 'pre' or 'post'
+    host: str  # <hostname>_<thread id> of the StraxFormatter that wrote it
+
+    @property
+    def size(self) -> int:
+        return os.path.getsize(self.path)
+
+
+_chunk_name = re.compile(r'^(\d+)(?:_(pre|post))?$')
+
+
+def parse_chunk_name(name: str) -> ty.Optional[ty.Tuple[int, str]]:
+    """
+    '000012_post' -> (12, 'post'). None for anything that isn't a finished chunk
+        directory (THE_END, *_temp, ...)
+    """
+    if (m := _chunk_name.match(name)) is None:
+        return None
+    return int(m.group(1)), m.group(2) or 'chunk'
+
+
+def list_chunk_files(run_dir: str, kinds: ty.Iterable[str] = ('chunk', 'post'),
+                     chunks: ty.Optional[ty.Iterable[int]] = None) -> ty.List[ChunkFile]:
+    """
+    The files of a run, ordered by chunk. _pre is a copy of the previous chunk's
+        _post, so by default we skip it.
+    :param run_dir: the run's directory
+    :param kinds: which of 'chunk', 'pre' and 'post' to include
+    :param chunks: only these chunk numbers
+    """
+    kinds = set(kinds)
+    chunks = None if chunks is None else set(chunks)
+    ret = []
+    with os.scandir(run_dir) as it:
+        for d in it:
+            if not d.is_dir() or (parsed := parse_chunk_name(d.name)) is None:
+                continue
+            chunk, kind = parsed
+            if kind not in kinds or (chunks is not None and chunk not in chunks):
+                continue
+            with os.scandir(d.path) as files:
+                ret += [ChunkFile(f.path, chunk, kind, f.name) for f in files if f.is_file()]
+    order = {'pre': 0, 'chunk': 1, 'post': 2}
+    ret.sort(key=lambda f: (f.chunk, order[f.kind], f.host))
+    return ret
+
+
+def chunk_time_range(chunk: int, kind: str, chunk_length: float = 5.,
+                     chunk_overlap: float = 0.5) -> ty.Tuple[int, int]:
+    """
+    The times (ns) data in this file can have, [start, end)
+    :param chunk_length: strax_chunk_length (s)
+    :param chunk_overlap: strax_chunk_overlap (s)
+    """
+    full = int((chunk_length + chunk_overlap) * 1e9)
+    overlap = int(chunk_overlap * 1e9)
+    if kind == 'pre':
+        chunk -= 1
+    if kind == 'chunk':
+        return chunk * full, (chunk + 1) * full - overlap
+    return (chunk + 1) * full - overlap, (chunk + 1) * full
+
+
+def read_chunk_file(path: str, payload_bytes: int = 220) -> np.ndarray:
+    """
+    The fragments in one file. The array is a view of the decompressed buffer
+        (so, read-only)
+    """
+    with open(path, 'rb') as f:
+        buf = f.read()
+    data = decompress(buf)
+    dtype = fragment_dtype(payload_bytes)
+    if len(data) % dtype.itemsize != 0:
+        raise ValueError(f'{path}: {len(data)} bytes isn\'t a whole number of '
+                         f'{dtype.itemsize}-byte fragments, wrong payload_bytes?')
+    return np.frombuffer(data, dtype=dtype)
+
+
+def write_chunk_file(run_dir: str, name: str, writer: str, buf: bytes) -> None:
+    """
+    Write a file like StraxFormatter::WriteOutChunk does: to
+        <run_dir>/<name>_temp/<writer>, then renamed to <run_dir>/<name>/<writer>
+    """
+    temp_dir = os.path.join(run_dir, name + '_temp')
+    if not os.path.exists(temp_dir):
+        os.makedirs(temp_dir, exist_ok=True)
+    temp = os.path.join(temp_dir, writer)
+    with open(temp, 'wb') as f:
+        f.write(buf)
+    final_dir = os.path.join(run_dir, name)
+    if not os.path.exists(final_dir):
+        os.makedirs(final_dir, exist_ok=True)
+    os.rename(temp, os.path.join(final_dir, writer))
+
+
+def read_run(run_dir: str,
+             start: ty.Optional[int] = None,
+             end: ty.Optional[int] = None,
+             channels: ty.Optional[ty.Iterable[int]] = None,
+             payload_bytes: int = 220,
+             chunk_length: float = 5.,
+             chunk_overlap: float = 0.5,
+             threads: int = 8,
+             sort: bool = True) -> np.ndarray:
+    """
+    Read (part of) a run
+    :param run_dir: the run's directory
+    :param start: only fragments with time >= this (ns)
+    :param end: only fragments with time < this (ns)
+    :param channels: only these channels
+    :param payload_bytes: strax_fragment_payload_bytes of the run
+    :param chunk_length: strax_chunk_length of the run (s), to skip files
+        outside [start, end)
+    :param chunk_overlap: strax_chunk_overlap of the run (s)
+    :param threads: how many files to read at once
+    :param sort: sort by time (and channel). Otherwise fragments are in file order
+    :returns: structured array of fragment_dtype(payload_bytes)
+    """
+    files = []
+    for f in list_chunk_files(run_dir):
+        lo, hi = chunk_time_range(f.chunk, f.kind, chunk_length, chunk_overlap)
+        if (start is None or hi > start) and (end is None or lo < end):
+            files.append(f.path)
+    channels = None if channels is None else np.asarray(sorted(channels))
+
+    def load(path):
+        frags = read_chunk_file(path, payload_bytes)
+        mask = None
+        if start is not None:
+            mask = frags['time'] >= start
+        if end is not None:
+            mask = frags['time'] < end if mask is None else mask & (frags['time'] < end)
+        if channels is not None:
+            m = np.isin(frags['channel'], channels)
+            mask = m if mask is None else mask & m
+        return frags if mask is None else frags[mask]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        parts = list(pool.map(load, files))
+    if len(parts) == 0:
+        return np.zeros(0, dtype=fragment_dtype(payload_bytes))
+    ret = np.concatenate(parts)
+    if sort:
+        ret = ret[np.lexsort((ret['channel'], ret['time']))]
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark reading a run\'s chunks')
+    parser.add_argument('run_dir', help='The run\'s directory')
+    parser.add_argument('--threads', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--payload-bytes', type=int, default=220,
+                        help='strax_fragment_payload_bytes')
+    parser.add_argument('--repeat', type=int, default=3, help='Best of this many')
+    parser.add_argument('--no-sort', action='store_true', help='Don\'t time the sorting')
+    args = parser.parse_args()
+
+    files = list_chunk_files(args.run_dir)
+    compressed = sum(f.size for f in files)
+    codecs = set()
+    for f in files[:20]:
+        with open(f.path, 'rb') as fh:
+            codecs.add(codec_of(fh.read()))
+    print(f'{len(files)} files, {compressed / 1e6:.1f} MB compressed, '
+          f'codec(s) {", ".join(str(c) for c in codecs)}')
+    for n in args.threads:
+        best = None
+        for _ in range(args.repeat):
+            t_start = time.perf_counter()
+            frags = read_run(args.run_dir, payload_bytes=args.payload_bytes, threads=n,
+                             sort=not args.no_sort)
+            elapsed = time.perf_counter() - t_start
+            best = elapsed if best is None else min(best, elapsed)
+        print(f'{n:3d} threads: {len(frags)} fragments in {best:.3f} s, '
+              f'{compressed / best / 1e6:.0f} MB/s compressed, '
+              f'{frags.nbytes / best / 1e6:.0f} MB/s decompressed')
+
+
+if __name__ == '__main__':
+    main()
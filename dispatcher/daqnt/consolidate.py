@@ -0,0 +1,275 @@
+"""
+Consolidation of the per-thread chunk files of a run
+
+Every StraxFormatter thread of every reader writes its own file for each
+chunk, so a chunk of a big run is dozens of small files that are each sorted
+more or less, but not with respect to each other. This merges all the
+<host>_<thread> files of <chunk>, and of <chunk>_post, into a single
+time-sorted file each, written as if by a single writer in redax's own
+layout: <output>/<chunk>/<name>, <chunk>_post/<name>, <chunk+1>_pre/<name>
+and THE_END/<name>. So strax and read_run, ChunkIndex, PulseBuilder etc. read
+the output like any other run. The files are merged with a
+k-way merge (pairwise, log2(k) rounds of np.searchsorted on the times) instead
+of re-sorting everything, and chunks are done in a process pool as soon as
+they're complete, so this can follow a run as it's written. That needs to know
+how many writers the run has (--writers, or from the run doc), otherwise a
+chunk looks complete before a slow thread wrote its first file.
+
+    python -m daqnt.consolidate /data/xenon/raw/xenonnt/012345 --follow
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+import typing as ty
+import numpy as np
+from .chunks import compress, fragment_dtype, list_chunk_files, read_chunk_file, \
+    write_chunk_file
+from .manifest import expected_writers
+
+__all__ = ['merge_sorted', 'consolidate_chunk', 'Consolidator']
+
+MERGED_NAME = 'merged_0'  # the <host>_<thread> the consolidated files are under
+
+
+def _merge2(ka, ia, kb, ib):
+    """Merge two sorted key arrays (and the indices riding along), a first on ties"""
+    pos = np.searchsorted(ka, kb, side='right') + np.arange(len(kb))
+    keys = np.empty(len(ka) + len(kb), dtype=ka.dtype)
+    idx = np.empty(len(keys), dtype=ia.dtype)
+    from_a = np.ones(len(keys), dtype=bool)
+    from_a[pos] = False
+    keys[pos], idx[pos] = kb, ib
+    keys[from_a], idx[from_a] = ka, ia
+    return keys, idx
+
+
+def merge_sorted(parts: ty.Sequence[np.ndarray], key: str = 'time') -> np.ndarray:
+    """
+    Merge structured arrays into one sorted by key. Parts that aren't sorted
+        get sorted first. Only the keys and indices move during the merge, the
+        records get copied once at the end.
+    :returns: the merged array, stable (ties keep the order of parts)
+    """
+    keys, idxs, offset = [], [], 0
+    for p in parts:
+        k = p[key]
+        order = np.arange(offset, offset + len(p))
+        if len(k) > 1 and np.any(k[1:] < k[:-1]):
+            srt = np.argsort(k, kind='stable')
+            k, order = k[srt], order[srt]
+        keys.append(k)
+        idxs.append(order)
+        offset += len(p)
+    if offset == 0:
+        return np.concatenate(parts) if len(parts) else parts
+    while len(keys) > 1:
+        merged = [_merge2(keys[i], idxs[i], keys[i + 1], idxs[i + 1])
+                  for i in range(0, len(keys) - 1, 2)]
+        if len(keys) % 2:
+            merged.append((keys[-1], idxs[-1]))
+        keys, idxs = [m[0] for m in merged], [m[1] for m in merged]
+    return np.concatenate(parts)[idxs[0]]
+
+
+def consolidate_chunk(run_dir: str, chunk: int, output_dir: str, payload_bytes: int = 220,
+                      codec: str = 'lz4', level: ty.Optional[int] = None,
+                      name: str = MERGED_NAME) -> dict:
+    """
+    Merge the files of one chunk into <output_dir>/<chunk>/<name>, and those
+        of its _post into <chunk>_post/<name> and <chunk+1>_pre/<name>
+    :returns: {'chunk', 'files', 'fragments', 'bytes' (uncompressed),
+        'compressed' (in), 'written' (out), 'time' ((first, last) or None),
+        'read', 'merge', 'write' (s)}
+    """
+    t_start = time.perf_counter()
+    files = list_chunk_files(run_dir, kinds=('chunk', 'post'), chunks=[chunk])
+    parts = {kind: [read_chunk_file(f.path, payload_bytes) for f in files if f.kind == kind]
+             for kind in ('chunk', 'post')}
+    t_read = time.perf_counter()
+    empty = np.zeros(0, dtype=fragment_dtype(payload_bytes))
+    merged = {kind: merge_sorted(p) if p else empty for kind, p in parts.items()}
+    t_merge = time.perf_counter()
+    packed = {kind: compress(m, codec, level) if len(m) else b'' for kind, m in merged.items()}
+    # the _post first, so the chunk being there means all of it is
+    write_chunk_file(output_dir, f'{chunk + 1:06d}_pre', name, packed['post'])
+    write_chunk_file(output_dir, f'{chunk:06d}_post', name, packed['post'])
+    write_chunk_file(output_dir, f'{chunk:06d}', name, packed['chunk'])
+    times = [m['time'][[0, -1]] for m in merged.values() if len(m)]
+    return {'chunk': chunk, 'files': len(files),
+            'fragments': sum(len(m) for m in merged.values()),
+            'bytes': sum(m.nbytes for m in merged.values()),
+            'compressed': sum(f.size for f in files),
+            'written': len(packed['chunk']) + 2 * len(packed['post']),
+            'time': (int(min(t[0] for t in times)), int(max(t[1] for t in times))) if times else None,
+            'read': t_read - t_start, 'merge': t_merge - t_read,
+            'write': time.perf_counter() - t_merge}
+
+
+class Consolidator(object):
+    """Consolidates the chunks of one run as they get complete"""
+
+    def __init__(self, run_dir: str, output_dir: ty.Optional[str] = None, workers: int = 4,
+                 payload_bytes: int = 220, codec: str = 'lz4', level: ty.Optional[int] = None,
+                 writers: ty.Optional[int] = None, name: str = MERGED_NAME):
+        """
+        :param run_dir: the run's directory
+        :param output_dir: where the consolidated chunks go, default <run_dir>_merged
+        :param workers: processes
+        :param payload_bytes: strax_fragment_payload_bytes of the run
+        :param codec: compress the consolidated chunks with this
+        :param writers: how many <host>_<thread> write the run. Needed to follow
+            a run, otherwise we can only go by the ones we've seen, which is
+            fine once it ended.
+        :param name: the writer name of the consolidated files
+        """
+        self.run_dir = os.path.normpath(run_dir)
+        self.output_dir = output_dir or self.run_dir + '_merged'
+        self.workers = workers
+        self.payload_bytes = payload_bytes
+        self.codec = codec
+        self.level = level
+        self.writers = writers
+        self.name = name
+        self.done = set()
+        self.stats = []
+        os.makedirs(self.output_dir, exist_ok=True)
+        self.done.update(f.chunk for f in list_chunk_files(self.output_dir, kinds=('chunk',))
+                         if f.host == name)
+
+    def ended(self) -> bool:
+        """
+        Did every writer finish? The first thread to finish makes THE_END, so
+            with a known number of writers we wait for all their files in it
+        """
+        end_dir = os.path.join(self.run_dir, 'THE_END')
+        if not os.path.isdir(end_dir):
+            return False
+        return self.writers is None or len(os.listdir(end_dir)) >= self.writers
+
+    def complete_chunks(self) -> ty.Tuple[ty.List[int], bool]:
+        """
+        Chunks that are complete and not done yet. Each thread writes its chunks
+            in order (and empty files for chunks it had no data for), so a chunk is
+            complete once every thread wrote a later chunk, or the run ended.
+        :returns: (chunks, whether the run ended)
+        """
+        ended = self.ended()
+        latest = {}
+        for f in list_chunk_files(self.run_dir, kinds=('chunk',)):
+            latest[f.host] = max(f.chunk, latest.get(f.host, -1))
+        if len(latest) == 0 or (not ended and self.writers is not None
+                                and len(latest) < self.writers):
+            return [], ended
+        last = max(latest.values()) if ended else min(latest.values()) - 1
+        return [c for c in range(last + 1) if c not in self.done], ended
+
+    def run(self, follow: bool = False, interval: float = 2.) -> None:
+        """Consolidate what's complete, and with follow keep going until the run ends"""
+        if follow and self.writers is None:
+            raise ValueError('Following a run needs its number of writers')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            pending = {}
+            while True:
+                chunks, ended = self.complete_chunks()
+                for c in chunks:
+                    if c not in pending.values():
+                        pending[pool.submit(consolidate_chunk, self.run_dir, c, self.output_dir,
+                                            self.payload_bytes, self.codec, self.level,
+                                            self.name)] = c
+                last_round = ended or not follow
+                if last_round:
+                    finished = concurrent.futures.wait(pending).done
+                elif pending:
+                    finished = concurrent.futures.wait(
+                        pending, timeout=interval,
+                        return_when=concurrent.futures.FIRST_COMPLETED).done
+                else:
+                    finished = set()
+                    time.sleep(interval)
+                for fut in finished:
+                    c = pending.pop(fut)
+                    # failed chunks aren't retried, the files are still there
+                    self.done.add(c)
+                    try:
+                        self.stats.append(fut.result())
+                    except Exception as e:
+                        print(f'Couldn\'t consolidate chunk {c}: {type(e)}, {e}')
+                if last_round:
+                    break
+        if ended:
+            os.makedirs(os.path.join(self.output_dir, 'THE_END'), exist_ok=True)
+            with open(os.path.join(self.output_dir, 'THE_END', self.name), 'w') as f:
+                f.write('...my only friend\n')
+
+    def summary(self, wall: float) -> dict:
+        """
+        Throughput, and how it compares to the rate the data came in at
+            (uncompressed bytes over the time the chunks span)
+        """
+        n = len(self.stats)
+        total = sum(s['bytes'] for s in self.stats)
+        ret = {'chunks': n, 'files': sum(s['files'] for s in self.stats),
+               'fragments': sum(s['fragments'] for s in self.stats), 'bytes': total,
+               'compressed': sum(s['compressed'] for s in self.stats),
+               'written': sum(s['written'] for s in self.stats), 'wall': wall,
+               'MBps': total / wall / 1e6 if wall > 0 else None}
+        for k in ('read', 'merge', 'write'):
+            ret[k] = sum(s[k] for s in self.stats)
+        times = [s['time'] for s in self.stats if s['time'] is not None]
+        if times:
+            span = (max(t[1] for t in times) - min(t[0] for t in times)) / 1e9
+            ret['data_MBps'] = total / span / 1e6 if span > 0 else None
+        return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge the per-thread chunk files of a run '
+                                     'into one sorted file per chunk')
+    parser.add_argument('run_dir', help='The run\'s directory')
+    parser.add_argument('--output', help='Where the merged chunks go, default <run_dir>_merged')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--payload-bytes', type=int, default=220)
+    parser.add_argument('--codec', default='lz4', help='name or name:level')
+    parser.add_argument('--writers', type=int,
+                        help='Threads writing the run, all hosts together. Default from the run doc')
+    parser.add_argument('--follow', action='store_true', help='Keep going until the run ends')
+    parser.add_argument('--interval', type=float, default=2.)
+    parser.add_argument('--runs-db', default='run')
+    parser.add_argument('--runs-coll', default='runs_gas')
+    args = parser.parse_args()
+
+    writers = args.writers
+    if writers is None and args.follow:
+        from .database import get_client
+        number = os.path.basename(os.path.normpath(args.run_dir))
+        doc = None
+        if number.isdigit():
+            doc = get_client('run')[args.runs_db][args.runs_coll].find_one(
+                {'number': int(number)}, {'daq_config.boards': 1, 'daq_config.processing_threads': 1})
+        if (writers := sum(expected_writers(doc and doc.get('daq_config')).values())) == 0:
+            print(f'Can\'t tell how many threads write {args.run_dir}, give --writers to follow it')
+            return
+    name, _, level = args.codec.partition(':')
+    cons = Consolidator(args.run_dir, args.output, args.workers, args.payload_bytes, name,
+                        int(level) if level else None, writers)
+    t_start = time.time()
+    cons.run(args.follow, args.interval)
+    s = cons.summary(time.time() - t_start)
+    if s['chunks'] == 0:
+        print('Nothing to consolidate')
+        return
+    print(f'{s["chunks"]} chunks from {s["files"]} files, {s["fragments"]} fragments, '
+          f'{s["compressed"] / 1e6:.1f} MB -> {s["written"] / 1e6:.1f} MB in {s["wall"]:.2f} s '
+          f'with {args.workers} workers')
+    print(f'Per chunk: read {s["read"] / s["chunks"] * 1e3:.1f} ms, merge '
+          f'{s["merge"] / s["chunks"] * 1e3:.1f} ms, write {s["write"] / s["chunks"] * 1e3:.1f} ms')
+    if s.get('data_MBps'):
+        print(f'{s["MBps"]:.0f} MB/s consolidated vs {s["data_MBps"]:.1f} MB/s of data '
+              f'({s["MBps"] / s["data_MBps"]:.1f}x real time)')
+    else:
+        print(f'{s["MBps"]:.0f} MB/s consolidated')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,419 @@
+"""
+Forecast of when strax_output_path fills up, and throttled cleanup of it
+
+ceph_monitor records the free space and the readers report their rate, but
+nothing puts the two together. DiskForecaster does: every cycle it takes the
+free space of strax_output_path (statvfs), the aggregate rate of the
+detectors from aggregate_status, and the compression ratio of what's being
+written (on-disk over decompressed size of the newest chunk files), and
+forecasts the time until the disk is full from
+    the rate times the compression ratio, and
+    the slope of the free space over the last --window seconds,
+whichever fills faster. The forecast goes to the disk_forecast collection, and
+when the time left drops below one of the warning levels (24 h, 6 h, 1 h by
+default) it's logged to the log collection like the validator's alarms.
+
+RunCleaner deletes runs that bootstrax is done with (bootstrax.state 'done' in
+the run doc), oldest first, once the free space drops below --clean-below,
+until it's back above --clean-target. Files are unlinked in small batches
+with a pause after each, so the deletion stays under --delete-rate MB/s and
+--delete-files files/s, from its own thread at the lowest CPU and idle I/O
+priority, so it doesn't compete with the readers writing live data and the
+forecasts keep coming while it works. The run doc's live data entry is
+marked 'deleted' when a run is gone.
+
+    python -m daqnt.disk_forecast /data/xenon/raw/xenonnt
+    python -m daqnt.disk_forecast /data/xenon/raw/xenonnt --cleanup --clean-below 0.2 --dry-run
+"""
+import argparse
+import collections
+import datetime
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import typing as ty
+import numpy as np
+from bson import ObjectId
+from .chunks import list_chunk_files, read_chunk_file
+
+__all__ = ['disk_space', 'compression_ratio', 'lower_priority', 'throttled_delete',
+           'DiskForecaster', 'RunCleaner']
+
+# hours left at which to warn, and the priority of the log message
+WARN_LEVELS = [(24., 2), (6., 3), (1., 4)]
+
+
+def disk_space(path: str) -> ty.Tuple[int, int]:
+    """:returns: (total, available) bytes of the filesystem path is on"""
+    st = os.statvfs(path)
+    return st.f_frsize * st.f_blocks, st.f_frsize * st.f_bavail
+
+
+def _runs(output_path: str) -> ty.List[int]:
+    """Numbers of the run directories, ascending"""
+    with os.scandir(output_path) as it:
+        return sorted(int(e.name) for e in it if e.name.isdigit() and e.is_dir())
+
+
+def compression_ratio(output_path: str, files: int = 8,
+                      payload_bytes: int = 220) -> ty.Optional[float]:
+    """
+    On-disk over decompressed size of the newest chunk files
+    :param files: how many of the newest files of the newest run to look at
+    :returns: the ratio, None if there's nothing to look at
+    """
+    for number in reversed(_runs(output_path)):
+        run_dir = os.path.join(output_path, f'{number:06d}')
+        try:
+            todo = list_chunk_files(run_dir, kinds=('chunk',))[-files:]
+            on_disk = decompressed = 0
+            for f in todo:
+                on_disk += f.size
+                decompressed += read_chunk_file(f.path, payload_bytes).nbytes
+        except (OSError, ValueError):
+            continue
+        if decompressed > 0:
+            return on_disk / decompressed
+    return None
+
+
+def lower_priority() -> None:
+    """
+    Lowest CPU priority and idle I/O class for the calling thread (on Linux
+        both are per thread)
+    """
+    os.nice(19)
+    try:
+        subprocess.run(['ionice', '-c', '3', '-p', str(threading.get_native_id())], check=True,
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    except (OSError, subprocess.CalledProcessError):
+        pass
+
+
+def throttled_delete(path: str, rate: float = 50., files_per_s: float = 200.,
+                     batch: int = 20, stop: ty.Optional[threading.Event] = None,
+                     dry_run: bool = False) -> ty.Tuple[int, int, bool]:
+    """
+    Delete a directory tree a batch of files at a time, pausing after each
+        batch so we stay under both limits
+    :param rate: MB/s
+    :param files_per_s: files/s
+    :param batch: files per batch
+    :param stop: give up (leaving the rest) when this is set
+    :param dry_run: only count
+    :returns: (files, bytes, finished)
+    """
+    todo = []
+    for root, _, names in os.walk(path):
+        todo += [os.path.join(root, n) for n in names]
+    n = nbytes = 0
+    t_start = time.time()
+    for i in range(0, len(todo), batch):
+        if stop is not None and stop.is_set():
+            return n, nbytes, False
+        for f in todo[i:i + batch]:
+            try:
+                size = os.path.getsize(f)
+                if not dry_run:
+                    os.unlink(f)
+            except FileNotFoundError:
+                continue
+            n += 1
+            nbytes += size
+        due = t_start + max(nbytes / (rate * 1e6), n / files_per_s)
+        if (wait := due - time.time()) > 0:
+            if stop is not None:
+                stop.wait(wait)
+            else:
+                time.sleep(wait)
+    if not dry_run:
+        shutil.rmtree(path, ignore_errors=True)
+    return n, nbytes, True
+
+
+class DiskForecaster(object):
+    """Forecasts when strax_output_path fills up and warns when that gets close"""
+
+    def __init__(self, output_path: str, db=None, window: float = 600., reserve: float = 0.02,
+                 warn_levels: ty.List[ty.Tuple[float, int]] = WARN_LEVELS,
+                 alarm_interval: float = 3600., payload_bytes: int = 220, logger=None):
+        """
+        :param output_path: strax_output_path
+        :param db: daq database for the rate, forecasts and warnings, None to just print
+        :param window: seconds of free space history (and rate) to average over
+        :param reserve: fraction of the disk we count as full already
+        :param warn_levels: [(hours left, log priority)]
+        :param alarm_interval: repeat a warning at the same level this often (s)
+        :param payload_bytes: strax_fragment_payload_bytes, for the compression ratio
+        :param logger: optional logger
+        """
+        self.output_path = output_path
+        self.db = db
+        self.window = window
+        self.reserve = reserve
+        self.warn_levels = sorted(warn_levels, key=lambda w: w[0])
+        self.alarm_interval = alarm_interval
+        self.payload_bytes = payload_bytes
+        self.logger = logger
+        self.hostname = socket.gethostname()
+        self.history = collections.deque()
+        self.ratio = None
+        self.ratio_time = 0
+        self.alarmed = {}
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+        else:
+            print(msg)
+
+    def rate(self) -> ty.Optional[float]:
+        """Aggregate rate (MB/s) of all detectors over the window, from aggregate_status"""
+        if self.db is None:
+            return None
+        since = datetime.datetime.now(datetime.timezone.utc) - \
+            datetime.timedelta(seconds=self.window)
+        try:
+            # _id rather than time, so this is a range scan on the _id index
+            docs = list(self.db['aggregate_status'].aggregate([
+                {'$match': {'_id': {'$gt': ObjectId.from_datetime(since)}}},
+                {'$group': {'_id': '$detector', 'rate': {'$avg': '$rate'}}}]))
+        except Exception as e:
+            self.log(f'Couldn\'t get the rate: {type(e)}, {e}')
+            return None
+        return sum(doc['rate'] or 0 for doc in docs)
+
+    def observed_fill(self) -> ty.Optional[float]:
+        """bytes/s the available space went down by over the window, from a linear fit"""
+        if len(self.history) < 3 or self.history[-1][0] - self.history[0][0] < 60:
+            return None
+        t, avail = np.array(self.history, dtype=np.float64).T
+        return -np.polyfit(t - t[0], avail, 1)[0]
+
+    def forecast(self) -> dict:
+        """
+        One cycle: sample, forecast, and warn if needed
+        :returns: the forecast document
+        """
+        now = time.time()
+        total, available = disk_space(self.output_path)
+        self.history.append((now, available))
+        while self.history[0][0] < now - self.window:
+            self.history.popleft()
+        # the ratio only changes with the run mode, no need to decompress every cycle
+        if now - self.ratio_time > self.window or self.ratio is None:
+            try:
+                self.ratio = compression_ratio(self.output_path, payload_bytes=self.payload_bytes)
+            except OSError as e:
+                self.log(f'Couldn\'t get the compression ratio: {type(e)}, {e}')
+            self.ratio_time = now
+        rate = self.rate()
+        expected = rate * 1e6 * self.ratio if rate is not None and self.ratio is not None else None
+        observed = self.observed_fill()
+        fills = [f for f in (expected, observed) if f is not None and f > 0]
+        usable = available - self.reserve * total
+        hours_left = None
+        if usable <= 0:
+            hours_left = 0.
+        elif fills:
+            hours_left = usable / max(fills) / 3600
+        doc = {'host': self.hostname, 'path': self.output_path,
+               'time': datetime.datetime.utcnow(), 'total': total, 'available': available,
+               'rate': rate, 'compression_ratio': self.ratio, 'expected_fill': expected,
+               'observed_fill': observed, 'hours_left': hours_left}
+        self.warn(doc)
+        if self.db is None:
+            print(doc)
+        else:
+            try:
+                self.db['disk_forecast'].update_one({'host': self.hostname,
+                                                     'path': self.output_path},
+                                                    {'$set': doc}, upsert=True)
+            except Exception as e:
+                self.log(f'Couldn\'t publish the forecast: {type(e)}, {e}')
+        return doc
+
+    def warn(self, doc: dict) -> None:
+        if (hours := doc['hours_left']) is None:
+            return
+        # the most urgent level we're under
+        level = next(((h, p) for h, p in self.warn_levels if hours < h), None)
+        if level is None:
+            return
+        now = time.time()
+        if now - self.alarmed.get(level[0], 0) < self.alarm_interval:
+            return
+        self.alarmed[level[0]] = now
+        msg = (f'{self.output_path} on {self.hostname} is full in {hours:.1f} h at this rate '
+               f'({doc["available"] / 1e12:.2f} of {doc["total"] / 1e12:.2f} TB free)')
+        self.log(msg)
+        if self.db is not None:
+            try:
+                self.db['log'].insert_one({'user': 'disk_forecast', 'message': msg,
+                                           'priority': level[1], 'runid': -1})
+            except Exception as e:
+                self.log(f'Couldn\'t log the warning: {type(e)}, {e}')
+
+
+class RunCleaner(object):
+    """Deletes runs bootstrax is done with when strax_output_path gets full"""
+
+    def __init__(self, output_path: str, runs_coll, clean_below: float = 0.2,
+                 clean_target: float = 0.3, min_age: float = 1., rate: float = 50.,
+                 files_per_s: float = 200., batch: int = 20, dry_run: bool = False, logger=None):
+        """
+        :param output_path: strax_output_path
+        :param runs_coll: the runs collection
+        :param clean_below: start deleting when less than this fraction is available
+        :param clean_target: stop deleting once this fraction is available
+        :param min_age: only runs that ended at least this many hours ago
+        :param rate: MB/s to delete at most
+        :param files_per_s: files/s to delete at most
+        :param batch: files per unlink batch
+        :param dry_run: only say what would be deleted
+        :param logger: optional logger
+        """
+        self.output_path = output_path
+        self.runs_coll = runs_coll
+        self.clean_below = clean_below
+        self.clean_target = clean_target
+        self.min_age = min_age
+        self.rate = rate
+        self.files_per_s = files_per_s
+        self.batch = batch
+        self.dry_run = dry_run
+        self.logger = logger
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+        else:
+            print(msg)
+
+    def candidates(self) -> ty.List[int]:
+        """Runs here that bootstrax is done with, oldest first"""
+        here = _runs(self.output_path)
+        if not here:
+            return []
+        before = datetime.datetime.utcnow() - datetime.timedelta(hours=self.min_age)
+        cursor = self.runs_coll.find({'number': {'$in': here}, 'bootstrax.state': 'done',
+                                      'end': {'$lt': before}}, {'number': 1})
+        return sorted(doc['number'] for doc in cursor)
+
+    def needed(self) -> bool:
+        total, available = disk_space(self.output_path)
+        return available < self.clean_below * total
+
+    def clean(self, stop: ty.Optional[threading.Event] = None) -> int:
+        """
+        Delete runs until clean_target is available, if we're under clean_below
+        :returns: how many runs got deleted
+        """
+        if not self.needed():
+            return 0
+        deleted = 0
+        for number in self.candidates():
+            total, available = disk_space(self.output_path)
+            if available >= self.clean_target * total or (stop is not None and stop.is_set()):
+                break
+            run_dir = os.path.join(self.output_path, f'{number:06d}')
+            t_start = time.time()
+            n, nbytes, finished = throttled_delete(run_dir, self.rate, self.files_per_s,
+                                                   self.batch, stop, self.dry_run)
+            elapsed = time.time() - t_start
+            self.log(f'{"Would delete" if self.dry_run else "Deleted"} run {number}: {n} files, '
+                     f'{nbytes / 1e9:.2f} GB in {elapsed:.0f} s'
+                     f'{"" if finished else " (interrupted)"}')
+            deleted += finished
+            if self.dry_run:
+                # nothing got freed, so this goes through every candidate
+                continue
+            if not finished:
+                break
+            try:
+                self.runs_coll.update_one(
+                    {'number': number, 'data': {'$elemMatch': {'type': 'live', 'host': 'daq'}}},
+                    {'$set': {'data.$.status': 'deleted'}})
+            except Exception as e:
+                self.log(f'Couldn\'t mark run {number} deleted: {type(e)}, {e}')
+        return deleted
+
+    def loop(self, stop: threading.Event, interval: float = 60.) -> None:
+        """Clean whenever needed until stop is set. Meant for its own thread"""
+        lower_priority()
+        while not stop.is_set():
+            try:
+                self.clean(stop)
+            except Exception as e:
+                self.log(f'Cleanup ran into {type(e)}, {e}')
+            stop.wait(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Forecast when strax_output_path fills up, '
+                                                 'and clean it up')
+    parser.add_argument('output_path', help='strax_output_path')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between forecasts')
+    parser.add_argument('--window', type=float, default=600,
+                        help='Seconds of history to forecast from')
+    parser.add_argument('--reserve', type=float, default=0.02,
+                        help='Fraction of the disk that counts as full already')
+    parser.add_argument('--warn-hours', type=float, nargs='+', default=[24, 6, 1],
+                        help='Warn when less than this many hours are left (least urgent first)')
+    parser.add_argument('--alarm-interval', type=float, default=3600,
+                        help='Repeat a warning this often (s)')
+    parser.add_argument('--payload-bytes', type=int, default=220)
+    parser.add_argument('--cleanup', action='store_true', help='Also delete processed runs')
+    parser.add_argument('--clean-below', type=float, default=0.2,
+                        help='Start deleting below this fraction available')
+    parser.add_argument('--clean-target', type=float, default=0.3,
+                        help='Stop deleting above this fraction available')
+    parser.add_argument('--min-age', type=float, default=1,
+                        help='Only delete runs that ended at least this many hours ago')
+    parser.add_argument('--delete-rate', type=float, default=50, help='MB/s to delete at most')
+    parser.add_argument('--delete-files', type=float, default=200,
+                        help='Files/s to delete at most')
+    parser.add_argument('--dry-run', action='store_true', help='Don\'t delete, just say what')
+    parser.add_argument('--no-db', action='store_true', help='Print instead of using the DB')
+    parser.add_argument('--runs-db', default='run')
+    parser.add_argument('--runs-coll', default='runs_gas')
+    args = parser.parse_args()
+
+    db = runs_coll = None
+    if not args.no_db:
+        from .database import get_client
+        db = get_client('daq')['daq']
+        runs_coll = get_client('run')[args.runs_db][args.runs_coll]
+    # warn_hours is given least urgent first, priorities go up from there
+    levels = [(h, min(2 + i, 4)) for i, h in enumerate(args.warn_hours)]
+    forecaster = DiskForecaster(args.output_path, db, args.window, args.reserve, levels,
+                                args.alarm_interval, args.payload_bytes)
+    from .signal_handler import SignalHandler
+    stop = SignalHandler().event
+    cleanup = None
+    if args.cleanup:
+        if runs_coll is None:
+            print('Cleanup needs the runs DB')
+            return
+        cleaner = RunCleaner(args.output_path, runs_coll, args.clean_below, args.clean_target,
+                             args.min_age, args.delete_rate, args.delete_files,
+                             dry_run=args.dry_run)
+        # a big delete takes hours at these rates, the forecasts can't wait for it
+        cleanup = threading.Thread(target=cleaner.loop, args=(stop, args.interval))
+        cleanup.start()
+    while not stop.is_set():
+        t_start = time.time()
+        try:
+            forecaster.forecast()
+        except Exception as e:
+            print(f'Forecast ran into {type(e)}, {e}')
+        stop.wait(max(0, args.interval - (time.time() - t_start)))
+    if cleanup is not None:
+        cleanup.join()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Export of a run's fragments to Parquet or Arrow
+
+For a quick study you don't want to decompress and concatenate a whole run,
+you want to ask for a few columns of a few channels. This converts a run's
+chunks into a hive-partitioned dataset,
+    <output>/chunk=<chunk>/channels=<first>-<last>/<host>_<thread>[_post].parquet
+(or .arrow for Arrow IPC), that pyarrow.dataset, pandas, polars, duckdb etc can
+read with partition and column pruning. The fragment header fields become
+columns, the waveform a fixed-size list column, which can be left out for a
+metadata-only export. Each file is converted in batches of a fixed number of
+fragments, so memory stays bounded, and chunks are converted in parallel.
+Needs pyarrow.
+
+    python -m daqnt.export /data/xenon/raw/xenonnt/012345 /data/user/012345_parquet --no-waveforms
+    pyarrow.dataset.dataset('/data/user/012345_parquet', partitioning='hive')
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+import typing as ty
+import numpy as np
+from .chunks import list_chunk_files, read_chunk_file
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+__all__ = ['FORMATS', 'fragments_to_arrow', 'export_chunk', 'export_run']
+
+FORMATS = ['parquet', 'arrow']
+
+
+def _need_pyarrow():
+    if pyarrow is None:
+        raise RuntimeError('pyarrow isn\'t installed')
+    return pyarrow
+
+
+def fragments_to_arrow(frags: np.ndarray, waveforms: bool = True):
+    """
+    A pyarrow Table of fragments, one column per field. The waveform (data)
+        becomes a fixed size list of int16, or is left out.
+    """
+    pa = _need_pyarrow()
+    columns, names = [], []
+    for name in frags.dtype.names:
+        if name == 'data':
+            if not waveforms:
+                continue
+            samples = frags.dtype['data'].shape[0]
+            flat = pa.array(np.ascontiguousarray(frags['data']).reshape(-1))
+            columns.append(pa.FixedSizeListArray.from_arrays(flat, samples))
+        else:
+            columns.append(pa.array(np.ascontiguousarray(frags[name])))
+        names.append(name)
+    return pa.Table.from_arrays(columns, names=names)
+
+
+class _PartitionWriters(object):
+    """One open writer per partition directory, opened when first needed"""
+
+    def __init__(self, fmt, compression):
+        self.fmt = fmt
+        self.compression = compression
+        self.writers = {}
+        self.rows = 0
+
+    def write(self, path, table):
+        pa = _need_pyarrow()
+        if (w := self.writers.get(path)) is None:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if self.fmt == 'parquet':
+                w = pa.parquet.ParquetWriter(path, table.schema, compression=self.compression)
+            else:
+                w = pa.ipc.new_file(path, table.schema)
+            self.writers[path] = w
+        if self.fmt == 'parquet':
+            w.write_table(table)
+        else:
+            w.write(table)
+        self.rows += table.num_rows
+
+    def close(self):
+        for w in self.writers.values():
+            w.close()
+
+
+def export_chunk(run_dir: str, chunk: int, output: str, fmt: str = 'parquet',
+                 channels_per_partition: int = 100, batch_size: int = 65536,
+                 waveforms: bool = True, payload_bytes: int = 220,
+                 compression: str = 'zstd') -> dict:
+    """
+    Export the files of one chunk and its _post (the _pre are the same data
+        as the previous _post). Runs in a worker process.
+    :param channels_per_partition: width of the channel ranges
+    :param batch_size: fragments converted (and written as a row group) at a time
+    :returns: {'chunk', 'files', 'fragments', 'bytes' (uncompressed), 'written'}
+    """
+    ext = '.parquet' if fmt == 'parquet' else '.arrow'
+    writers = _PartitionWriters(fmt, compression)
+    files = list_chunk_files(run_dir, kinds=('chunk', 'post'), chunks=[chunk])
+    n = nbytes = 0
+    try:
+        for f in files:
+            frags = read_chunk_file(f.path, payload_bytes)
+            n += len(frags)
+            nbytes += frags.nbytes
+            for start in range(0, len(frags), batch_size):
+                batch = frags[start:start + batch_size]
+                part = batch['channel'] // channels_per_partition
+                order = np.argsort(part, kind='stable')
+                batch, part = batch[order], part[order]
+                bounds = np.flatnonzero(np.diff(part)) + 1
+                for lo, hi in zip(np.r_[0, bounds], np.r_[bounds, len(batch)]):
+                    first = int(part[lo]) * channels_per_partition
+                    path = os.path.join(output, f'chunk={chunk:06d}',
+                                        f'channels={first:04d}-{first + channels_per_partition - 1:04d}',
+                                        f.host + ('_post' if f.kind == 'post' else '') + ext)
+                    writers.write(path, fragments_to_arrow(batch[lo:hi], waveforms))
+    finally:
+        writers.close()
+    written = sum(os.path.getsize(p) for p in writers.writers)
+    return {'chunk': chunk, 'files': len(files), 'fragments': n, 'bytes': nbytes,
+            'written': written}
+
+
+def export_run(run_dir: str, output: str, fmt: str = 'parquet', workers: int = 4,
+               chunks: ty.Optional[ty.Iterable[int]] = None, **kwargs) -> ty.List[dict]:
+    """
+    Export (some chunks of) a run, chunks in parallel
+    :param chunks: only these chunks
+    :param kwargs: see export_chunk
+    :returns: what export_chunk returns, per chunk
+    """
+    _need_pyarrow()
+    if fmt not in FORMATS:
+        raise ValueError(f'Unknown format {fmt}')
+    todo = sorted({f.chunk for f in list_chunk_files(run_dir, chunks=chunks)})
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(export_chunk, run_dir, c, output, fmt, **kwargs) for c in todo]
+        return [fut.result() for fut in futures]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Export a run to Parquet or Arrow')
+    parser.add_argument('run_dir', help='The run\'s directory')
+    parser.add_argument('output', help='Where the dataset goes')
+    parser.add_argument('--format', default='parquet', choices=FORMATS)
+    parser.add_argument('--no-waveforms', action='store_true', help='Only the fragment headers')
+    parser.add_argument('--channels-per-partition', type=int, default=100)
+    parser.add_argument('--batch-size', type=int, default=65536, help='Fragments per batch')
+    parser.add_argument('--compression', default='zstd', help='Parquet compression')
+    parser.add_argument('--chunks', type=int, nargs='+', help='Only these chunks')
+    parser.add_argument('--payload-bytes', type=int, default=220)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    args = parser.parse_args()
+
+    if os.path.exists(args.output) and os.listdir(args.output):
+        print(f'{args.output} isn\'t empty')
+        return
+    t_start = time.time()
+    res = export_run(args.run_dir, args.output, args.format, args.workers, args.chunks,
+                     channels_per_partition=args.channels_per_partition,
+                     batch_size=args.batch_size, waveforms=not args.no_waveforms,
+                     payload_bytes=args.payload_bytes, compression=args.compression)
+    elapsed = time.time() - t_start
+    raw = sum(r['bytes'] for r in res)
+    print(f'{len(res)} chunks, {sum(r["files"] for r in res)} files, '
+          f'{sum(r["fragments"] for r in res)} fragments, {raw / 1e6:.1f} MB -> '
+          f'{sum(r["written"] for r in res) / 1e6:.1f} MB in {elapsed:.1f} s '
+          f'({raw / elapsed / 1e6:.0f} MB/s)')
+
+
+if __name__ == '__main__':
+    main()
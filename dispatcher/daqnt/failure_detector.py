@@ -0,0 +1,267 @@
+"""
+Phi-accrual failure detection for hosts that check in periodically
+
+Instead of a fixed "no word for N seconds means dead", each host's recent
+status inter-arrival times are kept and the suspicion that it's gone is
+phi = -log10(P(a heartbeat this late | the host is fine)), assuming normally
+distributed intervals (Hayashibara et al, "The phi accrual failure detector").
+Real intervals have heavier tails than that, so phi is a ranking of how
+unusual a silence is rather than a calibrated probability; pick the threshold
+with the evaluation below. A host with a steady cadence gets declared dead a
+few of its intervals after it stops instead of after a fixed timeout.
+
+The intervals are those between the status docs themselves, from the time
+each reader wrote into them, so the readers' jitter is what's measured rather
+than how often the dispatcher happens to look. Arrivals and the time they're
+judged at have to come from the same clock though, so each batch of docs is
+moved onto the dispatcher's clock with a per-host offset: the smallest
+(time received - time written) of the recent batches, which is the clock
+offset plus the fastest delivery. An interval longer than max_timeout is an
+outage rather than part of the cadence, so the history starts over after one.
+
+Run this module to evaluate the detector on recorded status arrival times:
+    python -m daqnt.failure_detector --host reader0_reader_0 --hours 24
+"""
+import argparse
+import bisect
+import collections
+import math
+import typing as ty
+
+__all__ = ['PhiAccrualDetector']
+
+
+class PhiAccrualDetector(object):
+    """Per-host phi-accrual failure detector, constant memory per host"""
+
+    def __init__(self,
+                 threshold: float = 8.,
+                 min_timeout: float = 3.,
+                 max_timeout: float = 30.,
+                 fallback_timeout: float = 10.,
+                 window: int = 100,
+                 min_std: float = 0.2,
+                 acceptable_pause: float = 2.,
+                 min_samples: int = 5,
+                 max_phi: float = 100.):
+        """
+        :param threshold: phi at which a host counts as dead
+        :param min_timeout: never call a host dead before this long (s) without news
+        :param max_timeout: always call a host dead after this long (s) without news
+        :param fallback_timeout: the fixed timeout (s) for hosts we don't know enough about
+        :param window: how many recent intervals per host to base the estimate on
+        :param min_std: lower bound on the interval std (s), so a very regular
+            host doesn't become suspect after a few ms of delay
+        :param acceptable_pause: extra slack (s) added to the mean interval, for
+            the occasional hiccup (GC, DB write stalls, etc)
+        :param min_samples: how many intervals we need before we trust the estimate
+        :param max_phi: cap on the returned phi
+        """
+        self.threshold = threshold
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.fallback_timeout = fallback_timeout
+        self.window = window
+        self.min_std = min_std
+        self.acceptable_pause = acceptable_pause
+        self.min_samples = min_samples
+        self.max_phi = max_phi
+        self.intervals = {}
+        self.sums = {}
+        self.last = {}
+        self.offsets = {}
+
+    def heartbeat(self, host: str, t: float) -> None:
+        """
+        Record that host checked in at time t (unix timestamp). Repeated or
+            out-of-order timestamps are ignored.
+        """
+        if host not in self.last:
+            self.last[host] = t
+            self.intervals[host] = collections.deque()
+            self.sums[host] = [0., 0.]
+            return
+        if t <= self.last[host]:
+            return
+        dt = t - self.last[host]
+        self.last[host] = t
+        intervals, sums = self.intervals[host], self.sums[host]
+        if dt > self.max_timeout:
+            intervals.clear()
+            sums[0] = sums[1] = 0.
+            return
+        intervals.append(dt)
+        sums[0] += dt
+        sums[1] += dt * dt
+        if len(intervals) > self.window:
+            old = intervals.popleft()
+            sums[0] -= old
+            sums[1] -= old * old
+
+    def observe(self, host: str, times: ty.Sequence[float], received: float) -> None:
+        """
+        Record a batch of check-ins that we got at the same time
+        :param times: when the host wrote each of them (unix timestamps, its clock)
+        :param received: when we got them (unix timestamp, our clock)
+        """
+        if len(times) == 0:
+            return
+        offsets = self.offsets.setdefault(host, collections.deque(maxlen=self.window))
+        offsets.append(received - max(times))
+        offset = min(offsets)
+        for t in sorted(times):
+            self.heartbeat(host, t + offset)
+
+    def ready(self, host: str) -> bool:
+        """Do we know enough about this host to judge it?"""
+        return host in self.intervals and len(self.intervals[host]) >= self.min_samples
+
+    def stats(self, host: str) -> ty.Tuple[float, float]:
+        """Mean and std (s) of the recent intervals of this host"""
+        n = len(self.intervals[host])
+        s, s2 = self.sums[host]
+        mean = s / n
+        std = math.sqrt(max(s2 / n - mean * mean, 0.))
+        return mean, max(std, self.min_std)
+
+    def phi(self, host: str, t: float) -> float:
+        """
+        Suspicion level that host is dead at time t. 0 if we don't know enough.
+        """
+        if not self.ready(host):
+            return 0.
+        mean, std = self.stats(host)
+        mean += self.acceptable_pause
+        dt = t - self.last[host]
+        # P(interval > dt), the normal distribution's upper tail
+        p_later = 0.5 * math.erfc((dt - mean) / (std * math.sqrt(2)))
+        if p_later <= 0:
+            return self.max_phi
+        return min(-math.log10(p_later), self.max_phi)
+
+    def is_dead(self, host: str, t: float) -> bool:
+        """
+        Should we consider host dead at time t? Judged on phi within
+            [min_timeout, max_timeout], and on fallback_timeout until we
+            have enough history.
+        """
+        if host not in self.last:
+            return True
+        dt = t - self.last[host]
+        if not self.ready(host):
+            return dt > self.fallback_timeout
+        if dt <= self.min_timeout:
+            return False
+        if dt > self.max_timeout:
+            return True
+        return self.phi(host, t) >= self.threshold
+
+    def suspicion(self, t: float) -> ty.Dict[str, float]:
+        """phi of every host we know of at time t"""
+        return {host: self.phi(host, t) for host in self.last}
+
+    def forget(self, host: str) -> None:
+        """Drop the history of a host, eg because it got restarted"""
+        for d in [self.intervals, self.sums, self.last, self.offsets]:
+            d.pop(host, None)
+
+
+def evaluate(arrivals: ty.Sequence[float],
+             detector: PhiAccrualDetector,
+             fixed_timeout: float,
+             poll: float,
+             crash_gap: float) -> dict:
+    """
+    Replays the arrival times of one host, checking every {poll} seconds like
+        the dispatcher does. Like the dispatcher, the detector gets the docs
+        written since the previous check as one batch. A gap of at least {crash_gap}
+        seconds counts as the host having really been down, anything the
+        detectors flag in a shorter gap is a false positive.
+    :returns: dict with false positives and detection latency for both detectors
+    """
+    arrivals = sorted(arrivals)
+    ret = {'phi': {'false_positives': 0, 'latency': []},
+           'fixed': {'false_positives': 0, 'latency': []},
+           'checks': 0, 'crashes': 0, 'hours': (arrivals[-1] - arrivals[0]) / 3600}
+    host = 'host'
+    detector.forget(host)
+    ret['crashes'] = sum(b - a >= crash_gap for a, b in zip(arrivals[:-1], arrivals[1:]))
+    # the gap (index of the next arrival) each detector already flagged
+    flagged = {'phi': 0, 'fixed': 0}
+    t, seen = arrivals[0], 0
+    while t < arrivals[-1]:
+        ret['checks'] += 1
+        if (n := bisect.bisect_right(arrivals, t)) > seen:
+            detector.observe(host, arrivals[seen:n], t)
+            seen = n
+        last = arrivals[seen - 1]
+        dead = {'phi': detector.is_dead(host, t), 'fixed': t - last > fixed_timeout}
+        for kind in ['phi', 'fixed']:
+            if not dead[kind] or flagged[kind] == seen:
+                continue
+            flagged[kind] = seen
+            if arrivals[seen] - last >= crash_gap:
+                ret[kind]['latency'].append(t - last)
+            else:
+                ret[kind]['false_positives'] += 1
+        t += poll
+    for kind in ['phi', 'fixed']:
+        lat = ret[kind].pop('latency')
+        ret[kind]['detected'] = len(lat)
+        ret[kind]['mean_latency'] = sum(lat) / len(lat) if lat else None
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Evaluate the phi-accrual detector against a fixed timeout on '
+                    'recorded status arrival times')
+    parser.add_argument('--host', required=True, help='Which process to look at')
+    parser.add_argument('--hours', type=float, default=24, help='How far back to go')
+    parser.add_argument('--file', help='Read arrival times (unix timestamps, one per '
+                        'line) from here instead of the status collection')
+    parser.add_argument('--threshold', type=float, default=8)
+    parser.add_argument('--min-timeout', type=float, default=3)
+    parser.add_argument('--max-timeout', type=float, default=30)
+    parser.add_argument('--fixed-timeout', type=float, default=10, help='ClientTimeout')
+    parser.add_argument('--poll', type=float, default=3, help='PollFrequency')
+    parser.add_argument('--crash-gap', type=float, default=60,
+                        help='Gaps at least this long (s) count as real outages')
+    parser.add_argument('--window', type=int, default=100)
+    parser.add_argument('--min-std', type=float, default=0.2)
+    parser.add_argument('--acceptable-pause', type=float, default=2.)
+    args = parser.parse_args()
+
+    if args.file is not None:
+        with open(args.file) as f:
+            arrivals = [float(line) for line in f if line.strip()]
+    else:
+        import datetime
+        import pytz
+        from .database import get_client
+        since = datetime.datetime.now(pytz.utc) - datetime.timedelta(hours=args.hours)
+        coll = get_client('daq')['daq']['status']
+        arrivals = [doc['time'].replace(tzinfo=pytz.utc).timestamp() for doc in
+                    coll.find({'host': args.host, 'time': {'$gt': since}},
+                              {'time': 1, '_id': 0})]
+    if len(arrivals) < 2:
+        print(f'Only {len(arrivals)} arrivals, nothing to evaluate')
+        return
+    detector = PhiAccrualDetector(threshold=args.threshold, min_timeout=args.min_timeout,
+                                  max_timeout=args.max_timeout, fallback_timeout=args.fixed_timeout,
+                                  window=args.window, min_std=args.min_std,
+                                  acceptable_pause=args.acceptable_pause)
+    res = evaluate(arrivals, detector, args.fixed_timeout, args.poll, args.crash_gap)
+    print(f'{len(arrivals)} arrivals over {res["hours"]:.1f} h, {res["checks"]} checks, '
+          f'{res["crashes"]} outages of at least {args.crash_gap} s')
+    for kind, label in [('phi', f'phi >= {args.threshold}'),
+                        ('fixed', f'fixed {args.fixed_timeout} s')]:
+        r = res[kind]
+        lat = 'n/a' if r['mean_latency'] is None else f'{r["mean_latency"]:.1f} s'
+        print(f'{label:16}: {r["false_positives"]} false positives '
+              f'({r["false_positives"] / max(res["hours"], 1e-9):.2f}/h), '
+              f'detected {r["detected"]}/{res["crashes"]} outages, mean latency {lat}')
+
+
+if __name__ == '__main__':
+    main()
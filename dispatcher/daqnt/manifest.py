@@ -0,0 +1,311 @@
+"""
+Integrity manifests of finished runs
+
+Once a run has its end time (set_stop_time) and every writer it should have
+(the processing_threads of each reader in its daq_config) has written its
+THE_END, or a grace period after the end has passed, this hashes every file
+of it (chunks, _pre, _post and THE_END) and writes <run>/manifest.json with
+the size and hash of each, which writers wrote the run and which of the files
+those writers should have written are missing. The run doc gets a 'manifest'
+field pointing to it. Later, the same manifest can verify a copy of the run
+(after a transfer, or to check on ceph): same files, same sizes, same hashes.
+
+Files are read in large blocks in a thread pool; hashlib and xxhash hash
+without the GIL, so this goes about as fast as the disk. blake2b by default,
+xxh3_128 if xxhash is installed and you want it faster.
+
+    python -m daqnt.manifest --watch /data/xenon/raw/xenonnt
+    python -m daqnt.manifest --verify /mnt/copy/012345
+"""
+import argparse
+import concurrent.futures
+import datetime
+import hashlib
+import json
+import os
+import time
+import typing as ty
+from .chunks import list_chunk_files, parse_chunk_name
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+__all__ = ['ALGORITHMS', 'hash_file', 'build_manifest', 'verify_run', 'expected_writers',
+           'ManifestBuilder']
+
+MANIFEST_NAME = 'manifest.json'
+ALGORITHMS = ['blake2b', 'sha256', 'xxh3_128', 'xxh64']
+BLOCK = 8 << 20
+# what redax uses if processing_threads doesn't have the host
+DEFAULT_THREADS = 8
+
+
+def _hasher(algorithm: str):
+    if algorithm == 'blake2b':
+        return hashlib.blake2b(digest_size=16)
+    if algorithm == 'sha256':
+        return hashlib.sha256()
+    if algorithm in ('xxh3_128', 'xxh64'):
+        if xxhash is None:
+            raise RuntimeError('xxhash isn\'t installed')
+        return getattr(xxhash, algorithm)()
+    raise ValueError(f'Unknown hash {algorithm}')
+
+
+def hash_file(path: str, algorithm: str = 'blake2b', block: int = BLOCK) -> ty.Tuple[int, str]:
+    """:returns: (size, hex digest) of a file, read in blocks of this many bytes"""
+    h = _hasher(algorithm)
+    buf = bytearray(block)
+    view = memoryview(buf)
+    size = 0
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while (n := f.readinto(buf)) > 0:
+            h.update(view[:n])
+            size += n
+    return size, h.hexdigest()
+
+
+def _run_files(run_dir: str) -> ty.List[str]:
+    """Paths (relative to run_dir) of the files a manifest covers"""
+    ret = [os.path.relpath(f.path, run_dir)
+           for f in list_chunk_files(run_dir, kinds=('chunk', 'pre', 'post'))]
+    end_dir = os.path.join(run_dir, 'THE_END')
+    if os.path.isdir(end_dir):
+        ret += sorted(os.path.join('THE_END', n) for n in os.listdir(end_dir))
+    return ret
+
+
+def _expected(files: ty.List[str]) -> ty.Tuple[ty.List[str], ty.List[str]]:
+    """
+    Every writer (StraxFormatter thread) writes THE_END and, for every chunk
+        before its own last one, <c>, <c>_post and <c+1>_pre (CreateEmpty fills
+        in empty ones). Its last chunk only has the files that got data, and a
+        writer that never got data only has THE_END.
+    :returns: (writers, missing files)
+    """
+    last = {}
+    for f in files:
+        name, writer = os.path.split(f)
+        last.setdefault(writer, -1)
+        if (parsed := parse_chunk_name(name)) is None:
+            continue
+        # <c+1>_pre is written with chunk c
+        chunk = parsed[0] - 1 if parsed[1] == 'pre' else parsed[0]
+        last[writer] = max(last[writer], chunk)
+    present = set(files)
+    missing = []
+    for writer, chunk in last.items():
+        names = ['THE_END']
+        for c in range(chunk):
+            names += [f'{c:06d}', f'{c:06d}_post', f'{c + 1:06d}_pre']
+        missing += [os.path.join(n, writer) for n in names
+                    if os.path.join(n, writer) not in present]
+    return sorted(last), sorted(missing)
+
+
+def expected_writers(daq_config: ty.Optional[dict]) -> ty.Dict[str, int]:
+    """
+    How many writers (StraxFormatter threads, <host>_<thread id>) each reader
+        of a run has, from the run doc's daq_config
+    :returns: {host: number of writers}, empty if the config doesn't say
+    """
+    if not daq_config:
+        return {}
+    threads = daq_config.get('processing_threads', {})
+    return {b['host']: threads.get(b['host'], DEFAULT_THREADS)
+            for b in daq_config.get('boards', [])
+            if 'V17' in b.get('type', '') or 'f17' in b.get('type', '')}
+
+
+def build_manifest(run_dir: str, algorithm: str = 'blake2b', threads: int = 8) -> dict:
+    """
+    Hash every file of a run and write <run_dir>/manifest.json
+    :returns: the manifest
+    """
+    files = _run_files(run_dir)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        hashes = list(pool.map(lambda f: hash_file(os.path.join(run_dir, f), algorithm), files))
+    writers, missing = _expected(files)
+    manifest = {'run_dir': os.path.abspath(run_dir), 'algorithm': algorithm,
+                'created': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                'writers': writers, 'missing': missing,
+                'size': sum(h[0] for h in hashes),
+                'files': {f: [size, digest] for f, (size, digest) in zip(files, hashes)}}
+    tmp = os.path.join(run_dir, MANIFEST_NAME + '.tmp')
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=0)
+    os.replace(tmp, os.path.join(run_dir, MANIFEST_NAME))
+    return manifest
+
+
+def verify_run(run_dir: str, manifest: ty.Optional[dict] = None, threads: int = 8) -> dict:
+    """
+    Check (a copy of) a run against its manifest
+    :param manifest: default the run's own manifest.json
+    :returns: {'files', 'size', 'ok', 'missing', 'extra', 'wrong_size', 'wrong_hash'},
+        the last four lists of paths
+    """
+    if manifest is None:
+        with open(os.path.join(run_dir, MANIFEST_NAME)) as f:
+            manifest = json.load(f)
+    expected = manifest['files']
+    present = set(_run_files(run_dir))
+    todo = sorted(present & set(expected))
+    ret = {'files': len(todo), 'missing': sorted(set(expected) - present),
+           'extra': sorted(present - set(expected)), 'wrong_size': [], 'wrong_hash': []}
+
+    def check(f):
+        path = os.path.join(run_dir, f)
+        if os.path.getsize(path) != expected[f][0]:
+            return f, 'wrong_size', 0
+        size, digest = hash_file(path, manifest['algorithm'])
+        return f, None if digest == expected[f][1] else 'wrong_hash', size
+
+    size = 0
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as pool:
+        for f, problem, n in pool.map(check, todo):
+            size += n
+            if problem is not None:
+                ret[problem].append(f)
+    ret['size'] = size
+    ret['ok'] = not any(ret[k] for k in ('missing', 'extra', 'wrong_size', 'wrong_hash'))
+    return ret
+
+
+class ManifestBuilder(object):
+    """Builds the manifests of runs that ended, and points their run docs to them"""
+
+    def __init__(self, output_path: str, runs_coll, algorithm: str = 'blake2b',
+                 threads: int = 8, max_age: float = 7., grace: float = 600., logger=None):
+        """
+        :param output_path: strax_output_path, the runs are in <output_path>/<number>
+        :param runs_coll: the runs collection
+        :param max_age: only look at runs that ended in the last this many days
+        :param grace: seconds after the end of a run after which we build its
+            manifest even if not all of its writers wrote THE_END
+        """
+        self.output_path = output_path
+        self.runs_coll = runs_coll
+        self.algorithm = algorithm
+        self.threads = threads
+        self.max_age = max_age
+        self.grace = grace
+        self.logger = logger
+
+    def log(self, msg):
+        if self.logger is not None:
+            self.logger.info(msg)
+        else:
+            print(msg)
+
+    def pending(self) -> ty.List[int]:
+        """
+        Runs that ended, are here and have no manifest yet, and whose writers
+            are all done: THE_END/<host>_<thread> is there for every thread of
+            every reader. The first thread to finish makes THE_END while the
+            others may still be flushing chunks, so the directory alone isn't
+            enough. If we can't tell or they never all show up, the run is
+            done once it ended more than grace seconds ago.
+        """
+        now = datetime.datetime.utcnow()
+        since = now - datetime.timedelta(days=self.max_age)
+        ret = []
+        for doc in self.runs_coll.find({'end': {'$gt': since}, 'manifest': {'$exists': False}},
+                                       {'number': 1, 'end': 1, 'daq_config.boards': 1,
+                                        'daq_config.processing_threads': 1}).sort('number', 1):
+            end_dir = os.path.join(self.output_path, f'{doc["number"]:06d}', 'THE_END')
+            if not os.path.isdir(end_dir):
+                continue
+            ended = [n.rpartition('_')[0] for n in os.listdir(end_dir)]
+            writers = expected_writers(doc.get('daq_config'))
+            if ((writers and all(ended.count(host) >= n for host, n in writers.items())) or
+                    (now - doc['end']).total_seconds() > self.grace):
+                ret.append(doc['number'])
+        return ret
+
+    def process(self, number: int) -> ty.Optional[dict]:
+        run_dir = os.path.join(self.output_path, f'{number:06d}')
+        t_start = time.time()
+        try:
+            manifest = build_manifest(run_dir, self.algorithm, self.threads)
+        except Exception as e:
+            self.log(f'Couldn\'t build the manifest of run {number}: {type(e)}, {e}')
+            return None
+        elapsed = time.time() - t_start
+        with open(os.path.join(run_dir, MANIFEST_NAME), 'rb') as f:
+            digest = hashlib.blake2b(f.read(), digest_size=16).hexdigest()
+        ref = {'path': os.path.join(os.path.abspath(run_dir), MANIFEST_NAME),
+               'algorithm': self.algorithm, 'files': len(manifest['files']),
+               'size': manifest['size'], 'missing': len(manifest['missing']),
+               'digest': digest, 'created': datetime.datetime.utcnow()}
+        self.runs_coll.update_one({'number': number}, {'$set': {'manifest': ref}})
+        self.log(f'Run {number}: {ref["files"]} files, {ref["size"] / 1e9:.2f} GB hashed in '
+                 f'{elapsed:.1f} s ({ref["size"] / max(elapsed, 1e-6) / 1e6:.0f} MB/s), '
+                 f'{ref["missing"]} missing')
+        return manifest
+
+    def loop(self, stop, interval: float = 60.) -> None:
+        while not stop.is_set():
+            try:
+                for number in self.pending():
+                    if stop.is_set():
+                        break
+                    self.process(number)
+            except Exception as e:
+                self.log(f'Looking for runs to do ran into {type(e)}, {e}')
+            stop.wait(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build or check the integrity manifests of runs')
+    parser.add_argument('path', help='strax_output_path with --watch, otherwise a run directory')
+    parser.add_argument('--watch', action='store_true',
+                        help='Keep building manifests of runs as they end')
+    parser.add_argument('--verify', action='store_true', help='Check the run against its manifest')
+    parser.add_argument('--manifest', help='With --verify, use this manifest instead of the run\'s')
+    parser.add_argument('--algorithm', default='blake2b', choices=ALGORITHMS)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between checks')
+    parser.add_argument('--grace', type=float, default=600,
+                        help='With --watch, seconds after the end of a run to stop waiting '
+                             'for all of its writers to write THE_END')
+    parser.add_argument('--runs-db', default='run')
+    parser.add_argument('--runs-coll', default='runs_gas')
+    args = parser.parse_args()
+
+    if args.watch:
+        from .database import get_client
+        from .signal_handler import SignalHandler
+        builder = ManifestBuilder(args.path, get_client('run')[args.runs_db][args.runs_coll],
+                                  args.algorithm, args.threads, grace=args.grace)
+        builder.loop(SignalHandler().event, args.interval)
+        return
+    t_start = time.time()
+    if args.verify:
+        manifest = None
+        if args.manifest is not None:
+            with open(args.manifest) as f:
+                manifest = json.load(f)
+        res = verify_run(args.path, manifest, args.threads)
+        elapsed = time.time() - t_start
+        print(f'{res["files"]} files, {res["size"] / 1e6:.1f} MB checked in {elapsed:.1f} s '
+              f'({res["size"] / max(elapsed, 1e-6) / 1e6:.0f} MB/s): '
+              f'{"OK" if res["ok"] else "PROBLEMS"}')
+        for k in ('missing', 'extra', 'wrong_size', 'wrong_hash'):
+            if res[k]:
+                print(f'{k}: {len(res[k])}: {", ".join(res[k][:10])}'
+                      f'{" ..." if len(res[k]) > 10 else ""}')
+        return
+    manifest = build_manifest(args.path, args.algorithm, args.threads)
+    elapsed = time.time() - t_start
+    print(f'{len(manifest["files"])} files, {manifest["size"] / 1e6:.1f} MB hashed in '
+          f'{elapsed:.1f} s ({manifest["size"] / max(elapsed, 1e-6) / 1e6:.0f} MB/s), '
+          f'{len(manifest["writers"])} writers, {len(manifest["missing"])} missing files')
+
+
+if __name__ == '__main__':
+    main()
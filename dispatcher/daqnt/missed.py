@@ -0,0 +1,261 @@
+"""
+Decoder for the <run>_missed dumps of StraxFormatter
+
+When StraxFormatter::ProcessDatapacket finds a word where it expected an
+event header, it logs "Missed an event" and dumps the whole data packet (the
+raw digitizer buffer, 32-bit words) to <run number>_missed in its working
+directory. This reads such a dump the same way redax does: an event starts
+with a 0xA header word holding its size, the next event starts right after
+it, and whatever doesn't land on a header is skipped word by word until the
+next 0xA. That tells us where the stream went wrong. The events are then
+decoded all at once with NumPy: header (size, board, fail bit, channel mask,
+counter, trigger time), and for each channel in the mask its size, time
+(and baseline on V1725/V1730) and waveform. The file is memory mapped, so
+dumps of hundreds of MB take seconds.
+
+    python -m daqnt.missed 012345_missed --model V1724
+"""
+import argparse
+import time
+import typing as ty
+import numpy as np
+
+__all__ = ['MODELS', 'MissedDump']
+
+EVENT_HEADER_WORDS = 4
+# words of channel header, clock (ns), whether the channel mask has 16 bits
+MODELS = {'V1724': {'channel_header': 2, 'clock': 10, 'mask16': False},
+          'V1724_MV': {'channel_header': 0, 'clock': 10, 'mask16': False},
+          'V1725': {'channel_header': 3, 'clock': 4, 'mask16': True},
+          'V1730': {'channel_header': 3, 'clock': 2, 'mask16': True}}
+# one per channel per event. start is the word index of the channel header,
+# time in ns (without rollovers on V1724), bad_samples counts words with bits
+# above the 14-bit ADC range set
+CHANNEL_DTYPE = np.dtype([('event', '<i8'), ('channel', '<i2'), ('start', '<i8'),
+                          ('words', '<i4'), ('time', '<i8'), ('baseline', '<i2'),
+                          ('ok', '?'), ('bad_samples', '<i4')])
+_BLOCK = 1 << 24  # words at a time when looking at every word
+
+
+class MissedDump(object):
+    """A decoded dump"""
+
+    def __init__(self, path: str, model: str = 'V1724'):
+        """
+        :param path: the dump
+        :param model: the digitizer that sent it, one of MODELS
+        """
+        if model not in MODELS:
+            raise ValueError(f'Unknown model {model}, known are {", ".join(MODELS)}')
+        self.path = path
+        self.model = model
+        self.words = np.memmap(path, dtype='<u4', mode='r')
+        self.skipped = []  # (word index, words skipped until the next header)
+        self.truncated = False  # the last event runs past the end
+        self.events = None
+        self.channels = None
+        self._walk()
+        self._decode_events()
+        self._decode_channels()
+
+    def _candidates(self) -> np.ndarray:
+        """Indices of all words that look like an event header"""
+        ret = []
+        for start in range(0, len(self.words), _BLOCK):
+            block = self.words[start:start + _BLOCK]
+            ret.append(np.flatnonzero((block >> 28) == 0xA) + start)
+        return np.concatenate(ret) if ret else np.zeros(0, dtype=np.int64)
+
+    def _walk(self) -> None:
+        """Which header candidates are events, following the sizes like redax"""
+        cand = self._candidates()
+        n = len(self.words)
+        if len(cand) == 0:
+            self.starts = cand
+            if n > 0:
+                self.skipped.append((0, n))
+            return
+        size = (np.asarray(self.words[cand]) & 0xFFFFFFF).astype(np.int64)
+        # a zero size would never get anywhere, redax would spin on it too
+        end = cand + np.maximum(size, 1)
+        # the candidate where redax looks next: the end if it's a header, else the first after
+        succ = np.searchsorted(cand, end)
+        aligned = (succ < len(cand)) & (cand[np.minimum(succ, len(cand) - 1)] == end)
+        starts = []
+        if cand[0] > 0:
+            self.skipped.append((0, int(cand[0])))
+        i = 0
+        succ_l, aligned_l, end_l, cand_l = succ.tolist(), aligned.tolist(), end.tolist(), cand.tolist()
+        while i < len(cand_l):
+            starts.append(i)
+            if not aligned_l[i] and end_l[i] < n:
+                nxt = cand_l[succ_l[i]] if succ_l[i] < len(cand_l) else n
+                self.skipped.append((end_l[i], nxt - end_l[i]))
+            i = succ_l[i]
+        self.starts = cand[np.array(starts, dtype=np.int64)]
+        self.truncated = bool(end_l[starts[-1]] > n)
+
+    def _decode_events(self) -> None:
+        w = self.words
+        s = self.starts
+        ok = s + EVENT_HEADER_WORDS <= len(w)
+        s = s[ok]
+        w0, w1, w2, w3 = (np.asarray(w[s + i]) for i in range(EVENT_HEADER_WORDS))
+        mask = w1 & 0xFF
+        if MODELS[self.model]['mask16']:
+            mask |= (w2 >> 16) & 0xFF00
+        ev = np.zeros(len(s), dtype=[('start', '<i8'), ('words', '<i4'), ('board', '<i2'),
+                                     ('fail', '?'), ('mask', '<u2'), ('n_channels', '<i2'),
+                                     ('counter', '<u4'), ('time', '<u4'), ('ok', '?')])
+        ev['start'] = s
+        ev['words'] = w0 & 0xFFFFFFF
+        ev['board'] = w1 >> 27
+        ev['fail'] = (w1 & 0x4000000) != 0
+        ev['mask'] = mask
+        ev['n_channels'] = np.unpackbits(mask.astype('>u2').view(np.uint8).reshape(-1, 2),
+                                         axis=1).sum(axis=1)
+        ev['counter'] = w2 & 0xFFFFFF
+        ev['time'] = w3 & 0x7FFFFFFF
+        ev['ok'] = ev['start'] + ev['words'] <= len(w)
+        self.events = ev
+
+    def _decode_channels(self) -> None:
+        """One record per channel per event, going through the channels in step"""
+        m = MODELS[self.model]
+        hdr = m['channel_header']
+        ev = self.events
+        use = np.flatnonzero(~ev['fail'] & ev['ok'] & (ev['n_channels'] > 0))
+        records = []
+        pos = ev['start'][use] + EVENT_HEADER_WORDS
+        end = ev['start'][use] + ev['words'][use]
+        mask = ev['mask'][use].astype(np.int64)
+        for ch in range(16 if m['mask16'] else 8):
+            has = (mask >> ch) & 1 == 1
+            if not has.any():
+                continue
+            idx = np.flatnonzero(has)
+            p = pos[idx]
+            if hdr == 0:
+                # no channel headers, the event is split evenly
+                words = (ev['words'][use][idx] - EVENT_HEADER_WORDS) // ev['n_channels'][use][idx]
+                t = ev['time'][use][idx].astype(np.int64)
+                baseline = np.zeros(len(idx), dtype=np.int64)
+            else:
+                inside = p + hdr <= end[idx]
+                safe = np.where(inside, p, 0)
+                words = np.where(inside, np.asarray(self.words[safe]) & 0x7FFFFF, 0)
+                t1 = np.asarray(self.words[np.where(inside, safe + 1, 0)]).astype(np.int64)
+                if hdr == 3:
+                    t2 = np.asarray(self.words[np.where(inside, safe + 2, 0)]).astype(np.int64)
+                    t = t1 | ((t2 & 0xFFFF) << 32)
+                    baseline = (t2 >> 16) & 0x3FFF
+                else:
+                    t = t1 & 0x7FFFFFFF
+                    baseline = np.zeros(len(idx), dtype=np.int64)
+            rec = np.zeros(len(idx), dtype=CHANNEL_DTYPE)
+            rec['event'] = use[idx]
+            rec['channel'] = ch
+            rec['start'] = p
+            rec['words'] = words
+            rec['time'] = t * m['clock']
+            rec['baseline'] = baseline
+            rec['ok'] = (words >= max(hdr, 1)) & (p + words <= end[idx])
+            records.append(rec)
+            pos[idx] = p + np.maximum(words, 1)
+        if records:
+            ch = np.concatenate(records)
+            self.channels = ch[np.lexsort((ch['channel'], ch['event']))]
+        else:
+            self.channels = np.zeros(0, dtype=CHANNEL_DTYPE)
+        # the channels have to fill their event exactly
+        filled = np.bincount(self.channels['event'], self.channels['words'],
+                             minlength=len(ev)) + EVENT_HEADER_WORDS
+        self.events['ok'] &= ev['fail'] | (ev['n_channels'] == 0) | \
+            (filled.astype(np.int64) == ev['words'])
+        self._count_bad_samples()
+
+    def _count_bad_samples(self) -> None:
+        """Samples with bits above 14 set can't be from the ADC"""
+        hdr = MODELS[self.model]['channel_header']
+        c = self.channels
+        ok = np.flatnonzero(c['ok'])
+        lo = c['start'][ok] + hdr
+        hi = c['start'][ok] + c['words'][ok]
+        order = np.argsort(lo)
+        lo, hi, ok = lo[order], hi[order], ok[order]
+        for start in range(0, len(self.words), _BLOCK):
+            block = self.words[start:start + _BLOCK]
+            bad = np.flatnonzero((block & 0xC000C000) != 0) + start
+            if len(bad) == 0:
+                continue
+            i = np.searchsorted(lo, bad, side='right') - 1
+            inside = (i >= 0) & (bad < hi[np.maximum(i, 0)])
+            np.add.at(c['bad_samples'], ok[i[inside]], 1)
+
+    def waveform(self, i: int) -> np.ndarray:
+        """The samples of channel record i"""
+        c = self.channels[i]
+        hdr = MODELS[self.model]['channel_header']
+        return self.words[c['start'] + hdr:c['start'] + c['words']].view('<u2')
+
+    def summary(self) -> dict:
+        ev = self.events
+        good = ev[~ev['fail']]
+        gaps = np.flatnonzero(np.diff(good['counter'].astype(np.int64)) % (1 << 24) != 1)
+        ret = {'words': len(self.words), 'events': len(ev),
+               'board_fail': int(ev['fail'].sum()), 'bad_events': int((~ev['ok']).sum()),
+               'boards': sorted(int(b) for b in np.unique(ev['board'])),
+               'channel_records': len(self.channels),
+               'bad_channel_records': int((~self.channels['ok']).sum()),
+               'bad_samples': int(self.channels['bad_samples'].sum()),
+               'channels': {int(c): int(n) for c, n in
+                            zip(*np.unique(self.channels['channel'], return_counts=True))},
+               'counter_gaps': len(gaps),
+               'skipped': self.skipped, 'truncated': self.truncated}
+        if len(good):
+            ret['counter'] = [int(good['counter'][0]), int(good['counter'][-1])]
+            ret['trigger_time'] = [int(good['time'][0]), int(good['time'][-1])]
+        return ret
+
+    def context(self, index: int, before: int = 4, after: int = 8) -> ty.List[str]:
+        """Hex dump of the words around a word index"""
+        lo, hi = max(index - before, 0), min(index + after, len(self.words))
+        return [f'{i:8x}{"*" if i == index else " "} {int(self.words[i]):08x}' for i in range(lo, hi)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode a <run>_missed dump')
+    parser.add_argument('path', help='The dump')
+    parser.add_argument('--model', default='V1724', choices=list(MODELS))
+    parser.add_argument('--events', type=int, default=0, help='Print the first few events')
+    args = parser.parse_args()
+
+    t_start = time.time()
+    dump = MissedDump(args.path, args.model)
+    s = dump.summary()
+    elapsed = time.time() - t_start
+    print(f'{args.path}: {s["words"] * 4 / 1e6:.1f} MB decoded in {elapsed:.2f} s')
+    print(f'{s["events"]} events from board(s) {s["boards"]}, {s["board_fail"]} board fail, '
+          f'{s["bad_events"]} inconsistent, {s["counter_gaps"]} counter gaps')
+    print(f'{s["channel_records"]} channel records ({s["bad_channel_records"]} bad, '
+          f'{s["bad_samples"]} bad sample words), per channel {s["channels"]}')
+    if 'counter' in s:
+        print(f'Counters {s["counter"][0]}-{s["counter"][1]}, trigger times '
+              f'{s["trigger_time"][0]}-{s["trigger_time"][1]}')
+    if s['truncated']:
+        print('The last event runs past the end of the dump')
+    for index, n in s['skipped'][:10]:
+        print(f'Lost alignment at word {index:x} ({index * 4} bytes in), skipped {n} words:')
+        print('\n'.join(dump.context(index)))
+    if len(s['skipped']) > 10:
+        print(f'... and {len(s["skipped"]) - 10} more')
+    for i, e in enumerate(dump.events[:args.events]):
+        chs = dump.channels[dump.channels['event'] == i]
+        print(f'event {i} @{e["start"]:x}: {e["words"]} words, board {e["board"]}, '
+              f'mask {e["mask"]:04x}, counter {e["counter"]}, time {e["time"]}, '
+              f'{"ok" if e["ok"] else "BAD"}, channels ' +
+              ', '.join(f'{c["channel"]}:{c["words"]}w' for c in chs))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,201 @@
+"""
+Reassembly of pulses from strax fragments
+
+StraxFormatter cuts every pulse of pulse_length samples into fragments of
+strax_fragment_payload_bytes/2 samples: fragment record_i starts at
+time = pulse start + record_i * samples per fragment * dt, and the last one is
+zero-padded (its length says how much of it is real). To look at waveforms you
+want the pulses back. PulseBuilder does that for whole arrays of fragments
+at once: it groups them by (channel, pulse start), and copies the samples
+into one flat buffer, with an offsets array saying where each pulse starts,
+so there's no Python object per pulse. A pulse can be cut by a chunk
+boundary, so fragments of pulses that aren't complete yet are kept for the
+next batch.
+
+    python -m daqnt.pulses /data/xenon/raw/xenonnt/012345
+    python -m daqnt.pulses --fragments 1000000
+"""
+import argparse
+import time
+import typing as ty
+import numpy as np
+from .chunks import fragment_dtype, list_chunk_files, read_chunk_file
+
+__all__ = ['Pulses', 'PulseBuilder']
+
+
+class Pulses(ty.NamedTuple):
+    """Pulses with their waveforms in one buffer"""
+    time: np.ndarray  # ns, of the first sample
+    channel: np.ndarray
+    dt: np.ndarray
+    length: np.ndarray  # samples
+    baseline: np.ndarray
+    complete: np.ndarray  # False if fragments were missing (those samples are 0)
+    offsets: np.ndarray  # pulse i is data[offsets[i]:offsets[i+1]], len(offsets) = pulses + 1
+    data: np.ndarray  # int16 samples
+
+    @property
+    def n(self) -> int:
+        return len(self.time)
+
+    def waveform(self, i: int) -> np.ndarray:
+        return self.data[self.offsets[i]:self.offsets[i + 1]]
+
+    @classmethod
+    def empty(cls) -> 'Pulses':
+        z = np.zeros(0, dtype=np.int64)
+        return cls(z, z.astype(np.int16), z.astype(np.int16), z.astype(np.int32),
+                   z.astype(np.int16), z.astype(bool), np.zeros(1, dtype=np.int64),
+                   z.astype(np.int16))
+
+
+class PulseBuilder(object):
+    """Turns batches (eg chunks) of fragments into pulses"""
+
+    def __init__(self, payload_bytes: int = 220):
+        """
+        :param payload_bytes: strax_fragment_payload_bytes of the run
+        """
+        self.samples = payload_bytes // 2
+        self.dtype = fragment_dtype(payload_bytes)
+        self.carry = np.zeros(0, dtype=self.dtype)
+        # how many batches each carried fragment has been waiting
+        self.carry_age = np.zeros(0, dtype=np.int8)
+
+    def add(self, frags: np.ndarray) -> Pulses:
+        """
+        Add a batch of fragments, in any order. Call in time order, the batches
+            shouldn't overlap (so don't feed the same data from _post and _pre).
+        :returns: the pulses that are complete, plus the incomplete ones that
+            already had a batch to complete themselves and didn't
+        """
+        frags = np.concatenate([self.carry, frags])
+        age = np.concatenate([self.carry_age, np.zeros(len(frags) - len(self.carry), np.int8)])
+        pulses, waiting = self._build(frags, age, keep_incomplete=True)
+        self.carry = frags[waiting]
+        self.carry_age = age[waiting] + 1
+        return pulses
+
+    def flush(self) -> Pulses:
+        """Whatever is left at the end of the run, as incomplete pulses"""
+        pulses, _ = self._build(self.carry, self.carry_age, keep_incomplete=False)
+        self.carry = self.carry[:0]
+        self.carry_age = self.carry_age[:0]
+        return pulses
+
+    def _build(self, frags, age, keep_incomplete):
+        """:returns: (Pulses, indices of frags to keep for later)"""
+        if len(frags) == 0:
+            return Pulses.empty(), np.zeros(0, dtype=np.int64)
+        record_i = frags['record_i'].astype(np.int64)
+        start = frags['time'] - record_i * self.samples * frags['dt']
+        order = np.lexsort((record_i, start, frags['channel']))
+        start, record_i = start[order], record_i[order]
+        channel = frags['channel'][order]
+        pulse_length = frags['pulse_length'][order].astype(np.int64)
+
+        # a new pulse wherever the channel or the start changes
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = (channel[1:] != channel[:-1]) | (start[1:] != start[:-1])
+        first_i = np.flatnonzero(first)
+        group = np.cumsum(first) - 1
+        n_frags = np.diff(np.append(first_i, len(order)))
+        expected = -(-pulse_length[first_i] // self.samples)
+        complete = n_frags == expected
+
+        if keep_incomplete:
+            # incomplete pulses get one more batch to find the rest of their fragments
+            old = np.zeros(len(first_i), dtype=bool)
+            np.logical_or.at(old, group, age[order] > 0)
+            wait = ~complete & ~old
+            waiting = order[wait[group]]
+            emit = ~wait
+        else:
+            waiting = np.zeros(0, dtype=np.int64)
+            emit = np.ones(len(first_i), dtype=bool)
+
+        # where the pulses go in the buffer
+        lengths = pulse_length[first_i][emit]
+        offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        new_index = np.cumsum(emit) - 1
+
+        use = emit[group]
+        src = order[use]
+        pos = record_i[use] * self.samples
+        n = np.clip(np.minimum(frags['length'][src], pulse_length[use] - pos), 0, self.samples)
+        valid = np.arange(self.samples)[None, :] < n[:, None]
+        samples = frags['data'][src][valid]
+        if len(samples) == offsets[-1]:
+            # nothing missing, so the pulses are just the fragments back to back
+            data = samples
+        else:
+            # copy each fragment to its pulse's offset + record_i * samples
+            data = np.zeros(offsets[-1], dtype=np.int16)
+            dest = offsets[new_index[group[use]]] + pos
+            data[(dest[:, None] + np.arange(self.samples)[None, :])[valid]] = samples
+
+        firsts = order[first_i[emit]]
+        pulses = Pulses(time=start[first_i[emit]], channel=channel[first_i[emit]],
+                        dt=frags['dt'][firsts], length=lengths.astype(np.int32),
+                        baseline=frags['baseline'][firsts], complete=complete[emit],
+                        offsets=offsets, data=data)
+        return pulses, waiting
+
+
+def _fake_fragments(n: int, payload_bytes: int = 220, seed: int = 0) -> np.ndarray:
+    """About n fragments of random pulses, shuffled, for benchmarking"""
+    rng = np.random.default_rng(seed)
+    samples = payload_bytes // 2
+    pulse_length = rng.integers(50, 5 * samples, size=max(n // 3, 1))
+    n_frags = -(-pulse_length // samples)
+    pulse_i = np.repeat(np.arange(len(pulse_length)), n_frags)
+    record_i = np.arange(len(pulse_i)) - np.repeat(np.cumsum(n_frags) - n_frags, n_frags)
+    start = np.cumsum(rng.integers(1000, 20000, size=len(pulse_length)))
+    frags = np.zeros(len(pulse_i), dtype=fragment_dtype(payload_bytes))
+    frags['dt'] = 10
+    frags['time'] = start[pulse_i] + record_i * samples * 10
+    frags['channel'] = rng.integers(0, 494, size=len(pulse_length))[pulse_i]
+    frags['pulse_length'] = pulse_length[pulse_i]
+    frags['record_i'] = record_i
+    frags['length'] = np.minimum(samples, pulse_length[pulse_i] - record_i * samples)
+    frags['baseline'] = 16000
+    frags['data'] = rng.integers(15900, 16100, size=(len(frags), samples))
+    frags['data'][np.arange(samples)[None, :] >= frags['length'][:, None]] = 0
+    return frags[rng.permutation(len(frags))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark pulse reassembly')
+    parser.add_argument('run_dir', nargs='?', help='Reassemble the pulses of this run, chunk by chunk')
+    parser.add_argument('--fragments', type=int, default=1000000,
+                        help='Without a run, this many fake fragments')
+    parser.add_argument('--payload-bytes', type=int, default=220)
+    args = parser.parse_args()
+
+    if args.run_dir is not None:
+        batches = {}
+        for f in list_chunk_files(args.run_dir):
+            batches.setdefault((f.chunk, f.kind), []).append(read_chunk_file(f.path, args.payload_bytes))
+        batches = [np.concatenate(b) for _, b in sorted(batches.items())]
+    else:
+        batches = [_fake_fragments(args.fragments, args.payload_bytes)]
+    total = sum(len(b) for b in batches)
+    builder = PulseBuilder(args.payload_bytes)
+    pulses = incomplete = 0
+    t_start = time.perf_counter()
+    for b in batches:
+        p = builder.add(b)
+        pulses += p.n
+        incomplete += np.count_nonzero(~p.complete)
+    p = builder.flush()
+    pulses += p.n
+    incomplete += np.count_nonzero(~p.complete)
+    elapsed = time.perf_counter() - t_start
+    print(f'{total} fragments -> {pulses} pulses ({incomplete} incomplete) in {elapsed:.3f} s, '
+          f'{total / elapsed / 1e6:.2f} M fragments/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,290 @@
+"""
+Quick look at the data while it's being taken
+
+Noisy or dead PMTs and drifting baselines otherwise only show up once the run
+is processed. QuickLook follows strax_output_path like the ChunkValidator does
+and runs every new chunk file through a simple hit finder in a process pool:
+a hit is a stretch of samples more than the channel's threshold (from the
+run's 'thresholds', like the digitizers use) below the fragment's baseline.
+Per run and channel it keeps the number of fragments and hits, a histogram of
+hit amplitudes, and running sums of the baseline (mean, spread, and a linear
+fit against time for the drift), which are all just added up over files. The
+summary goes to the quicklook collection every few seconds.
+
+Some digitizers (V1724) don't fill in the baseline field, so where it's 0 the
+baseline of a channel is the median over its pulses of the mean of the first
+BASELINE_SAMPLES samples of each pulse.
+
+Hits are found per fragment, so a hit across a fragment boundary counts twice.
+That's fine to spot a channel that's off, which is what this is for.
+
+    python -m daqnt.quicklook /data/xenon/raw/xenonnt
+"""
+import argparse
+import concurrent.futures
+import datetime
+import typing as ty
+import numpy as np
+from .chunk_validator import ChunkValidator
+from .chunks import ChunkFile, read_chunk_file
+
+__all__ = ['AMPLITUDE_BINS', 'baselines', 'find_hits', 'analyze_file', 'QuickLook']
+
+# ADC counts above baseline, log spaced up to the 14-bit range
+AMPLITUDE_BINS = np.unique(np.geomspace(1, 2 ** 14, 33).astype(np.int64))
+DEFAULT_THRESHOLD = 10  # what redax uses if a board has none
+BASELINE_SAMPLES = 16  # leading samples of a pulse to estimate its baseline from
+
+
+def _leading_means(frags: np.ndarray) -> np.ndarray:
+    """Mean of the first BASELINE_SAMPLES samples of each fragment (or fewer if it's shorter)"""
+    n = np.clip(frags['length'], 1, BASELINE_SAMPLES)
+    lead = frags['data'][:, :BASELINE_SAMPLES].astype(np.float64)
+    lead[np.arange(lead.shape[1])[None, :] >= n[:, None]] = 0
+    return lead.sum(axis=1) / n
+
+
+def baselines(frags: np.ndarray) -> np.ndarray:
+    """
+    The baseline of each fragment: its baseline field, or where that's 0, the
+        median of its channel's pulse baselines estimated from leading samples
+    """
+    ret = frags['baseline'].astype(np.int32)
+    missing = ret == 0
+    if not missing.any():
+        return ret
+    first = frags[missing & (frags['record_i'] == 0)]
+    ch = frags['channel'].astype(np.int64)
+    estimate = np.zeros(int(ch.max()) + 1, dtype=np.int32)
+    if len(first):
+        lead = _leading_means(first)
+        fch = first['channel'].astype(np.int64)
+        order = np.lexsort((lead, fch))
+        chans, start, count = np.unique(fch[order], return_index=True, return_counts=True)
+        estimate[chans] = np.round(lead[order][start + count // 2]).astype(np.int32)
+    ret[missing] = estimate[ch[missing]]
+    return ret
+
+
+def find_hits(frags: np.ndarray, thresholds: np.ndarray) -> ty.Tuple[np.ndarray, np.ndarray]:
+    """
+    Find hits in fragments
+    :param frags: fragments
+    :param thresholds: threshold (ADC below baseline) for each channel, by channel number
+    :returns: (channel, amplitude) of each hit
+    """
+    if len(frags) == 0:
+        return np.zeros(0, dtype=np.int16), np.zeros(0, dtype=np.int32)
+    samples = frags['data'].shape[1]
+    signal = baselines(frags)[:, None] - frags['data']
+    thr = np.full(len(frags), DEFAULT_THRESHOLD, dtype=np.int32)
+    known = frags['channel'] < len(thresholds)
+    thr[known] = thresholds[frags['channel'][known]]
+    above = (signal > thr[:, None]) & \
+        (np.arange(samples)[None, :] < frags['length'][:, None])
+    starts = above.copy()
+    starts[:, 1:] &= ~above[:, :-1]
+    row = np.flatnonzero(starts.ravel()) // samples
+    # above samples of one hit are contiguous, so reduceat from each start
+    flat_above = above.ravel()
+    first = np.flatnonzero(starts.ravel()[flat_above])
+    if len(first) == 0:
+        return np.zeros(0, dtype=np.int16), np.zeros(0, dtype=np.int32)
+    amplitude = np.maximum.reduceat(signal.ravel()[flat_above], first)
+    return frags['channel'][row], amplitude
+
+
+def analyze_file(path: str, payload_bytes: int = 220,
+                 thresholds: ty.Optional[np.ndarray] = None) -> dict:
+    """
+    Hits and baselines of one chunk file, per channel. Runs in a worker process.
+    :returns: dict of arrays indexed by channel (fragments, hits, hist, and the
+        baseline sums bl_n, bl_sum, bl_sum2, bl_t, bl_t2, bl_tb with t in s), and
+        time ([min, max] ns or None)
+    """
+    frags = read_chunk_file(path, payload_bytes)
+    thresholds = np.zeros(0, dtype=np.int32) if thresholds is None else thresholds
+    n_ch = int(frags['channel'].max()) + 1 if len(frags) else 0
+    ch = frags['channel'].astype(np.int64)
+    hit_ch, amplitude = find_hits(frags, thresholds)
+    hist = np.zeros((n_ch, len(AMPLITUDE_BINS)), dtype=np.int64)
+    np.add.at(hist, (hit_ch.astype(np.int64),
+                     np.clip(np.searchsorted(AMPLITUDE_BINS, amplitude, side='right') - 1,
+                             0, len(AMPLITUDE_BINS) - 1)), 1)
+    # one baseline per pulse, from its first fragment
+    first = frags['record_i'] == 0
+    b = frags['baseline'][first].astype(np.float64)
+    # without a baseline field, each pulse's own estimate (not the channel's median) shows drift
+    b = np.where(b == 0, _leading_means(frags[first]), b)
+    t = frags['time'][first] / 1e9
+    bc = ch[first]
+    ret = {'fragments': np.bincount(ch, minlength=n_ch),
+           'hits': np.bincount(hit_ch.astype(np.int64), minlength=n_ch),
+           'hist': hist,
+           'bl_n': np.bincount(bc, minlength=n_ch).astype(np.float64),
+           'bl_sum': np.bincount(bc, b, minlength=n_ch),
+           'bl_sum2': np.bincount(bc, b * b, minlength=n_ch),
+           'bl_t': np.bincount(bc, t, minlength=n_ch),
+           'bl_t2': np.bincount(bc, t * t, minlength=n_ch),
+           'bl_tb': np.bincount(bc, t * b, minlength=n_ch),
+           'time': [int(frags['time'].min()), int(frags['time'].max())] if len(frags) else None}
+    return ret
+
+
+class _QuickLookStats(object):
+    """Per-channel sums of one run"""
+    sums = ['fragments', 'hits', 'hist', 'bl_n', 'bl_sum', 'bl_sum2', 'bl_t', 'bl_t2', 'bl_tb']
+
+    def __init__(self, number):
+        self.number = number
+        self.files = 0
+        self.time = [None, None]
+        self.arrays = {}
+        self.channels = None
+        self.noisy_rate = 1000.
+        self.finished = False
+        self.changed = True
+
+    def add(self, f: ChunkFile, res: dict) -> None:
+        self.files += 1
+        for k in self.sums:
+            a, new = self.arrays.get(k), res[k]
+            if a is None:
+                self.arrays[k] = new.copy()
+                continue
+            if len(new) > len(a):
+                a, new = new.copy(), a
+                self.arrays[k] = a
+            a[:len(new)] += new
+        if res['time'] is not None:
+            self.time[0] = res['time'][0] if self.time[0] is None else min(self.time[0], res['time'][0])
+            self.time[1] = res['time'][1] if self.time[1] is None else max(self.time[1], res['time'][1])
+        self.changed = True
+
+    def doc(self, hostname):
+        ret = {'number': self.number, 'host': hostname, 'files': self.files,
+               'time_min': self.time[0], 'time_max': self.time[1], 'finished': self.finished,
+               'updated': datetime.datetime.now(datetime.timezone.utc)}
+        if not self.arrays:
+            return ret
+        a = self.arrays
+        live = (self.time[1] - self.time[0]) / 1e9 if self.time[0] is not None else 0
+        n = np.maximum(a['bl_n'], 1)
+        mean = a['bl_sum'] / n
+        std = np.sqrt(np.maximum(a['bl_sum2'] / n - mean ** 2, 0))
+        # least squares slope of baseline vs time
+        var_t = a['bl_t2'] / n - (a['bl_t'] / n) ** 2
+        with np.errstate(divide='ignore', invalid='ignore'):
+            slope = np.where(var_t > 0, (a['bl_tb'] / n - a['bl_t'] / n * mean) / var_t, 0)
+        rate = a['hits'] / live if live > 0 else np.zeros(len(a['hits']))
+        has_data = a['fragments'] > 0
+        ret.update({'live_time': live,
+                    'fragments': a['fragments'].tolist(),
+                    'hits': a['hits'].tolist(),
+                    'hit_rate': np.round(rate, 2).tolist(),
+                    'baseline_mean': np.round(mean, 2).tolist(),
+                    'baseline_std': np.round(std, 2).tolist(),
+                    'baseline_drift': np.round(slope * 3600, 2).tolist(),  # ADC/h
+                    'amplitude_bins': AMPLITUDE_BINS.tolist(),
+                    # channels x bins of uint32, np.frombuffer(...).reshape(len(hits), -1)
+                    'amplitude_hist': a['hist'].astype('<u4').tobytes(),
+                    'noisy': np.flatnonzero(rate > self.noisy_rate).tolist()})
+        if self.channels is not None:
+            ret['dead'] = [int(c) for c in self.channels
+                           if c >= len(has_data) or not has_data[c]]
+        return ret
+
+
+class QuickLook(ChunkValidator):
+    """Follows strax_output_path and keeps hit and baseline stats per run and channel"""
+    collection = 'quicklook'
+    stats_class = _QuickLookStats
+
+    def __init__(self, output_path: str, workers: int = 4, noisy_rate: float = 1000., **kwargs):
+        """
+        :param workers: processes finding hits
+        :param noisy_rate: a channel with more hits than this (Hz) is noisy
+        :param kwargs: see ChunkValidator
+        """
+        super().__init__(output_path, workers, **kwargs)
+        self.processes = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+        self.noisy_rate = noisy_rate
+
+    def run_settings(self, number: int) -> dict:
+        """As for the validator, plus the threshold of each channel"""
+        if number in self.settings:
+            return self.settings[number]
+        settings = super().run_settings(number)
+        cfg = {}
+        if self.runs_coll is not None:
+            try:
+                doc = self.runs_coll.find_one({'number': number}, {'daq_config': 1})
+                cfg = (doc or {}).get('daq_config', {}) or {}
+            except Exception as e:
+                self.log(f'Couldn\'t get the thresholds of run {number}: {type(e)}, {e}')
+        thresholds = None
+        if isinstance(cfg.get('channels'), dict):
+            n_ch = max([c for chs in cfg['channels'].values() for c in chs], default=-1) + 1
+            thresholds = np.full(n_ch, DEFAULT_THRESHOLD, dtype=np.int32)
+            for board, chs in cfg['channels'].items():
+                thr = (cfg.get('thresholds') or {}).get(str(board), [])
+                for i, c in enumerate(chs):
+                    if i < len(thr):
+                        thresholds[c] = thr[i]
+        settings['thresholds'] = thresholds
+        return settings
+
+    def _process(self, number, f):
+        if f.kind == 'pre':
+            # same data as the previous chunk's _post
+            return
+        settings = self.run_settings(number)
+        try:
+            res = self.processes.submit(analyze_file, f.path, settings['payload_bytes'],
+                                        settings['thresholds']).result()
+        except Exception as e:
+            self.log(f'Looking at {f.path} ran into {type(e)}: {e}')
+            return
+        with self.lock:
+            if (stats := self.stats.get(number)) is None:
+                return
+            stats.channels = settings['channels']
+            stats.noisy_rate = self.noisy_rate
+            stats.add(f, res)
+
+    def loop(self, *args, **kwargs):
+        super().loop(*args, **kwargs)
+        self.processes.shutdown(wait=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hit and baseline stats of chunks as redax '
+                                     'writes them')
+    parser.add_argument('output_path', help='strax_output_path')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--poll', type=float, default=5, help='Scan interval without inotify (s)')
+    parser.add_argument('--no-inotify', action='store_true', help='Always poll')
+    parser.add_argument('--publish', type=float, default=10, help='Stats update interval (s)')
+    parser.add_argument('--noisy-rate', type=float, default=1000.,
+                        help='Hit rate (Hz) above which a channel is noisy')
+    parser.add_argument('--ignore-existing', action='store_true',
+                        help='Only look at runs that start after we do')
+    parser.add_argument('--no-db', action='store_true', help='Print instead of using the DB')
+    parser.add_argument('--runs-db', default='run')
+    parser.add_argument('--runs-coll', default='runs_gas')
+    args = parser.parse_args()
+
+    db = runs_coll = None
+    if not args.no_db:
+        from .database import get_client
+        db = get_client('daq')['daq']
+        runs_coll = get_client('run')[args.runs_db][args.runs_coll]
+    ql = QuickLook(args.output_path, args.workers, args.noisy_rate, db=db, runs_coll=runs_coll,
+                   poll=args.poll, publish=args.publish, use_inotify=not args.no_inotify)
+    from .signal_handler import SignalHandler
+    sh = SignalHandler()
+    ql.loop(sh.event, args.ignore_existing)
+
+
+if __name__ == '__main__':
+    main()
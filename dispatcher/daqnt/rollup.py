@@ -0,0 +1,238 @@
+"""
+Multi-resolution rollups of aggregate_status
+
+aggregate_status gets a document per detector every dispatcher cycle, which is
+far too much to plot a month of. This keeps 1-minute, 1-hour and 1-day buckets
+per detector in aggregate_status_1min/_1h/_1d with min/max/mean of rate and
+buffer, how often each status was seen, the range of the PLL unlock counter and
+the run numbers seen. Each update only recomputes the buckets that got new
+documents: minutes from the raw documents, hours from the minutes and days from
+the hours, so it's cheap to run every minute and safe to rerun.
+
+Run this module to keep the rollups up to date, or to look at them:
+    python -m daqnt.rollup
+    python -m daqnt.rollup --query tpc --hours 720
+"""
+import argparse
+import datetime
+import time
+import typing as ty
+import pytz
+from bson import ObjectId
+from .daq_status import DAQ_STATUS
+
+__all__ = ['StatusRollup']
+
+
+def _bucket(field: str, ms: int) -> dict:
+    """Expression flooring a date field to a multiple of ms"""
+    t = {'$toLong': field}
+    return {'$toDate': {'$subtract': [t, {'$mod': [t, ms]}]}}
+
+
+def _floor(t: datetime.datetime, seconds: int) -> datetime.datetime:
+    ts = t.replace(tzinfo=pytz.utc).timestamp()
+    return datetime.datetime.fromtimestamp(ts - ts % seconds, tz=pytz.utc)
+
+
+class StatusRollup(object):
+    """Maintains and queries the rollups of aggregate_status"""
+
+    # name, bucket length (s). Each level is built from the one before it
+    resolutions = [('1min', 60), ('1h', 3600), ('1d', 86400)]
+
+    def __init__(self, db, logger=None, chunk: float = 86400.):
+        """
+        :param db: the database holding aggregate_status
+        :param logger: optional logger
+        :param chunk: how much raw data (s) to process per aggregation, when catching up
+        """
+        self.db = db
+        self.logger = logger
+        self.chunk = chunk
+
+    def collection(self, resolution: str):
+        return self.db[f'aggregate_status_{resolution}']
+
+    def ensure_indexes(self) -> None:
+        """$merge needs a unique index on the fields it matches on"""
+        for name, _ in self.resolutions:
+            self.collection(name).create_index([('detector', 1), ('start', 1)], unique=True)
+
+    def _log(self, msg):
+        if self.logger is not None:
+            self.logger.debug(msg)
+
+    def _merge(self, resolution: str) -> dict:
+        return {'$merge': {'into': f'aggregate_status_{resolution}', 'on': ['detector', 'start'],
+                           'whenMatched': 'merge', 'whenNotMatched': 'insert'}}
+
+    def _from_raw(self, start: datetime.datetime, end: datetime.datetime) -> None:
+        """Recompute the minute buckets of the raw documents in [start, end)"""
+        group = {'_id': {'detector': '$detector', 'start': _bucket('$time', 60000)},
+                 'n': {'$sum': 1},
+                 'numbers': {'$addToSet': '$number'},
+                 'pll_min': {'$min': '$pll_unlocks'},
+                 'pll_max': {'$max': '$pll_unlocks'}}
+        for field in ['rate', 'buff']:
+            group[f'{field}_min'] = {'$min': f'${field}'}
+            group[f'{field}_max'] = {'$max': f'${field}'}
+            group[f'{field}_sum'] = {'$sum': f'${field}'}
+        for s in DAQ_STATUS:
+            group[f'status_{s.name}'] = {'$sum': {'$cond': [{'$eq': ['$status', s.value]}, 1, 0]}}
+        project = {'_id': 0, 'detector': '$_id.detector', 'start': '$_id.start', 'n': 1,
+                   'numbers': {'$filter': {'input': '$numbers', 'cond': {'$gte': ['$$this', 0]}}},
+                   'pll_unlocks': {'min': '$pll_min', 'max': '$pll_max'},
+                   'status': {s.name: f'$status_{s.name}' for s in DAQ_STATUS}}
+        for field in ['rate', 'buff']:
+            project[field] = {k: f'${field}_{k}' for k in ['min', 'max', 'sum']}
+        self.db['aggregate_status'].aggregate([
+            {'$match': {'_id': {'$gte': ObjectId.from_datetime(start),
+                                '$lt': ObjectId.from_datetime(end)}}},
+            {'$group': group},
+            {'$project': project},
+            self._merge('1min')], allowDiskUse=True)
+
+    def _from_finer(self, resolution: str, seconds: int, finer: str,
+                    start: datetime.datetime) -> None:
+        """Recompute the buckets of this resolution from the finer ones since start"""
+        group = {'_id': {'detector': '$detector', 'start': _bucket('$start', seconds * 1000)},
+                 'n': {'$sum': '$n'},
+                 'numbers': {'$push': '$numbers'},
+                 'pll_min': {'$min': '$pll_unlocks.min'},
+                 'pll_max': {'$max': '$pll_unlocks.max'}}
+        for field in ['rate', 'buff']:
+            for k in ['min', 'max', 'sum']:
+                group[f'{field}_{k}'] = {f'${k}': f'${field}.{k}'}
+        for s in DAQ_STATUS:
+            group[f'status_{s.name}'] = {'$sum': f'$status.{s.name}'}
+        project = {'_id': 0, 'detector': '$_id.detector', 'start': '$_id.start', 'n': 1,
+                   'numbers': {'$reduce': {'input': '$numbers', 'initialValue': [],
+                                           'in': {'$setUnion': ['$$value', '$$this']}}},
+                   'pll_unlocks': {'min': '$pll_min', 'max': '$pll_max'},
+                   'status': {s.name: f'$status_{s.name}' for s in DAQ_STATUS}}
+        for field in ['rate', 'buff']:
+            project[field] = {k: f'${field}_{k}' for k in ['min', 'max', 'sum']}
+        self.collection(finer).aggregate([
+            {'$match': {'start': {'$gte': start}}},
+            {'$group': group},
+            {'$project': project},
+            self._merge(resolution)], allowDiskUse=True)
+
+    def last_bucket(self) -> ty.Union[datetime.datetime, None]:
+        """Start of the newest minute bucket, None if there isn't one"""
+        doc = self.collection('1min').find_one({}, sort=[('start', -1)])
+        return None if doc is None else doc['start'].replace(tzinfo=pytz.utc)
+
+    def update(self, now: datetime.datetime = None) -> None:
+        """
+        Bring the rollups up to date. The newest minute bucket gets recomputed
+            since it was probably incomplete last time, as does everything after it.
+        """
+        now = now or datetime.datetime.now(pytz.utc)
+        if (start := self.last_bucket()) is None:
+            if (first := self.db['aggregate_status'].find_one({}, sort=[('_id', 1)])) is None:
+                return
+            start = _floor(first['_id'].generation_time, 60)
+        t0 = time.time()
+        t = start
+        while t < now:
+            end = min(t + datetime.timedelta(seconds=self.chunk), now + datetime.timedelta(seconds=1))
+            self._from_raw(t, end)
+            t = end
+        for (finer, _), (name, seconds) in zip(self.resolutions[:-1], self.resolutions[1:]):
+            self._from_finer(name, seconds, finer, _floor(start, seconds))
+        self._log(f'Rollups updated since {start} in {time.time() - t0:.2f} s')
+
+    def pick_resolution(self, start: datetime.datetime, end: datetime.datetime,
+                        min_points: int = 100) -> str:
+        """
+        The coarsest resolution that still gives at least min_points buckets
+            over [start, end), 'raw' if none does
+        """
+        length = (end - start).total_seconds()
+        for name, seconds in reversed(self.resolutions):
+            if length / seconds >= min_points:
+                return name
+        return 'raw'
+
+    def query(self, detector: str, start: datetime.datetime, end: datetime.datetime = None,
+              min_points: int = 100, resolution: str = None) -> ty.Tuple[str, ty.List[dict]]:
+        """
+        History of a detector between start and end, at the coarsest resolution
+            that gives at least min_points values (or the one asked for).
+        :returns: (resolution, list of buckets ordered in time). Each bucket has
+            time, n, rate and buff ({min, max, mean}), status (fraction of the
+            time in each status), pll_unlocks (increase over the bucket) and
+            numbers (runs seen). Raw documents are returned in the same shape.
+        """
+        end = end or datetime.datetime.now(pytz.utc)
+        resolution = resolution or self.pick_resolution(start, end, min_points)
+        ret = []
+        if resolution == 'raw':
+            for doc in self.db['aggregate_status'].find(
+                    {'detector': detector,
+                     '_id': {'$gte': ObjectId.from_datetime(start),
+                             '$lt': ObjectId.from_datetime(end)}}).sort('_id', 1):
+                ret.append({'time': doc['time'], 'n': 1,
+                            'rate': {k: doc.get('rate') for k in ['min', 'max', 'mean']},
+                            'buff': {k: doc.get('buff') for k in ['min', 'max', 'mean']},
+                            'status': {s.name: float(doc.get('status') == s.value)
+                                       for s in DAQ_STATUS},
+                            'pll_unlocks': 0,
+                            'numbers': [doc['number']] if doc.get('number', -1) >= 0 else []})
+            return resolution, ret
+        seconds = dict(self.resolutions)[resolution]
+        for doc in self.collection(resolution).find(
+                {'detector': detector, 'start': {'$gte': _floor(start, seconds), '$lt': end}}
+                ).sort('start', 1):
+            total = max(sum(doc['status'].values()), 1)
+            pll = doc['pll_unlocks']
+            ret.append({'time': doc['start'], 'n': doc['n'],
+                        'rate': {'min': doc['rate']['min'], 'max': doc['rate']['max'],
+                                 'mean': doc['rate']['sum'] / doc['n']},
+                        'buff': {'min': doc['buff']['min'], 'max': doc['buff']['max'],
+                                 'mean': doc['buff']['sum'] / doc['n']},
+                        'status': {k: v / total for k, v in doc['status'].items()},
+                        # the counter resets with each run, so this is a lower bound
+                        'pll_unlocks': max((pll['max'] or 0) - (pll['min'] or 0), 0),
+                        'numbers': doc['numbers']})
+        return resolution, ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Keep the aggregate_status rollups up to date')
+    parser.add_argument('--db', default='daq', help='Which database')
+    parser.add_argument('--interval', type=float, default=60, help='Seconds between updates')
+    parser.add_argument('--once', action='store_true', help='Update once and exit')
+    parser.add_argument('--query', metavar='DETECTOR', help='Print the history of this detector')
+    parser.add_argument('--hours', type=float, default=24, help='How far back to --query')
+    parser.add_argument('--points', type=int, default=100,
+                        help='Minimum number of points for --query')
+    args = parser.parse_args()
+
+    from .database import get_client
+    rollup = StatusRollup(get_client('daq')[args.db])
+    if args.query is not None:
+        end = datetime.datetime.now(pytz.utc)
+        t0 = time.time()
+        resolution, docs = rollup.query(args.query, end - datetime.timedelta(hours=args.hours),
+                                        end, args.points)
+        print(f'{len(docs)} points at {resolution} resolution in {time.time() - t0:.3f} s')
+        for doc in docs:
+            status = ' '.join(f'{k}:{v:.2f}' for k, v in doc['status'].items() if v > 0)
+            print(f'{doc["time"]} rate {doc["rate"]["mean"]:.1f} ({doc["rate"]["min"]}-'
+                  f'{doc["rate"]["max"]}) buff {doc["buff"]["mean"]:.1f} {status} '
+                  f'runs {doc["numbers"]}')
+        return
+    rollup.ensure_indexes()
+    while True:
+        t0 = time.time()
+        rollup.update()
+        if args.once:
+            break
+        time.sleep(max(0, args.interval - (time.time() - t0)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,262 @@
+"""
+Synthetic runs in the layout redax writes
+
+Benchmarking what reads strax_output_path (bootstrax, the validator, the
+quick look, compression and storage choices) shouldn't need digitizers or a
+redax with an f1724. SyntheticRun writes a run directory the way
+StraxFormatter does: per chunk and writer thread a compressed file in
+<chunk>, <chunk>_post and <chunk+1>_pre, written to a _temp directory and
+renamed into place, empty files where a thread had nothing, and THE_END at the
+end. The pulses have a configurable rate, channel count and length
+distribution, and their waveforms are picked from a bank of noisy baselines
+and pulse shapes, so everything is array operations and it's much faster than
+real time. With --realtime the chunks are written when redax would write them.
+
+    python -m daqnt.synthetic /data/test/raw --number 999 --rate 200 --duration 60
+"""
+import argparse
+import concurrent.futures
+import os
+import socket
+import time
+import typing as ty
+import numpy as np
+from .chunks import compress, fragment_dtype, write_chunk_file
+
+__all__ = ['generate_fragments', 'write_chunk', 'SyntheticRun']
+
+PULSE_LENGTHS = ['fixed', 'exponential', 'lognormal']
+# waveform bank of each worker process, by samples per fragment
+_banks = {}
+
+
+def _waveform_bank(samples: int, rng, baseline: int = 16000, noise: float = 3.,
+                   size: int = 4096) -> np.ndarray:
+    """Fragment waveforms to pick from: noise on the baseline, half of them with a pulse"""
+    bank = np.round(rng.normal(baseline, noise, size=(size, samples))).astype(np.int16)
+    has_pulse = np.arange(size) % 2 == 0
+    peak = rng.integers(0, samples, size=size)
+    height = rng.exponential(200, size=size)
+    i = np.arange(samples)[None, :]
+    shape = np.where(i >= peak[:, None], np.exp(-(i - peak[:, None]) / 20.), 0.)
+    bank[has_pulse] -= (height[:, None] * shape)[has_pulse].astype(np.int16)
+    return bank
+
+
+def generate_fragments(t_start: int, t_end: int, rate: float, channels: ty.Sequence[int],
+                       pulse_length: float = 100., distribution: str = 'exponential',
+                       payload_bytes: int = 220, dt: int = 10, rng=None,
+                       bank: ty.Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Fragments of random pulses in [t_start, t_end), ordered by pulse start
+        like a thread gets them from a digitizer
+    :param rate: MB/s of (uncompressed) fragments
+    :param channels: channels to spread the pulses over
+    :param pulse_length: mean (or only) pulse length, samples
+    :param distribution: of the pulse lengths, one of PULSE_LENGTHS
+    :param dt: ns per sample
+    """
+    rng = rng or np.random.default_rng()
+    dtype = fragment_dtype(payload_bytes)
+    samples = payload_bytes // 2
+    if bank is None:
+        bank = _waveform_bank(samples, rng)
+    n_frags_wanted = rate * 1e6 * (t_end - t_start) / 1e9 / dtype.itemsize
+    if distribution == 'fixed':
+        frags_per_pulse = np.ceil(pulse_length / samples)
+    else:
+        # near enough for the mean, so the rate comes out about right
+        frags_per_pulse = pulse_length / samples + 0.5
+    n_pulses = rng.poisson(n_frags_wanted / max(frags_per_pulse, 1))
+    if distribution == 'fixed':
+        lengths = np.full(n_pulses, int(pulse_length), dtype=np.int64)
+    elif distribution == 'exponential':
+        lengths = rng.exponential(pulse_length, size=n_pulses).astype(np.int64)
+    elif distribution == 'lognormal':
+        lengths = rng.lognormal(np.log(pulse_length) - 0.125, 0.5, size=n_pulses).astype(np.int64)
+    else:
+        raise ValueError(f'Unknown pulse length distribution {distribution}')
+    lengths = np.clip(lengths, 1, 2 ** 31 - 1)
+    starts = rng.integers(t_start, t_end, size=n_pulses)
+    chans = np.asarray(channels)[rng.integers(0, len(channels), size=n_pulses)]
+
+    # a digitizer channel can't have two pulses at once, drop the ones that would
+    order = np.lexsort((starts, chans))
+    starts, chans, lengths = starts[order], chans[order], lengths[order]
+    span = t_end - t_start + int(lengths.max(initial=0)) * dt + 1
+    # running max of the ends per channel, by putting the channels far apart
+    ends = np.maximum.accumulate(starts - t_start + lengths * dt + chans.astype(np.int64) * span)
+    # and keep pulses inside the chunk, one thread writes each chunk in one go
+    keep = starts + lengths * dt <= t_end
+    keep[1:] &= (chans[1:] != chans[:-1]) | \
+        (starts[1:] - t_start + chans[1:].astype(np.int64) * span >= ends[:-1])
+    order = np.argsort(starts[keep], kind='stable')
+    starts, chans, lengths = starts[keep][order], chans[keep][order], lengths[keep][order]
+    n_pulses = len(starts)
+
+    # one row per fragment
+    n_frags = -(-lengths // samples)
+    pulse_i = np.repeat(np.arange(n_pulses), n_frags)
+    record_i = np.arange(len(pulse_i)) - np.repeat(np.cumsum(n_frags) - n_frags, n_frags)
+    frags = np.empty(len(pulse_i), dtype=dtype)
+    frags['time'] = starts[pulse_i] + record_i * samples * dt
+    frags['length'] = np.minimum(samples, lengths[pulse_i] - record_i * samples)
+    frags['dt'] = dt
+    frags['channel'] = chans[pulse_i]
+    frags['pulse_length'] = lengths[pulse_i]
+    frags['record_i'] = record_i
+    frags['baseline'] = 16000
+    frags['data'] = bank[rng.integers(0, len(bank), size=len(frags))]
+    # zero padding after the end of the pulse, only the last fragments have any
+    last = np.flatnonzero(frags['length'] < samples)
+    frags['data'][last] *= np.arange(samples)[None, :] < frags['length'][last][:, None]
+    return frags
+
+
+def write_chunk(run_dir: str, chunk: int, writer: str, frags: np.ndarray,
+                chunk_length: float = 5., chunk_overlap: float = 0.5, codec: str = 'lz4') -> int:
+    """
+    Write one thread's fragments of a chunk: <chunk>, <chunk>_post and
+        <chunk+1>_pre (an empty file where there's nothing, like CreateEmpty)
+    :param frags: the fragments, all in this chunk's time range
+    :param writer: <host>_<thread id>
+    :returns: bytes written
+    """
+    full = int((chunk_length + chunk_overlap) * 1e9)
+    overlap = int(chunk_overlap * 1e9)
+    in_overlap = (chunk + 1) * full - frags['time'] <= overlap
+    main = compress(frags[~in_overlap], codec) if (~in_overlap).any() else b''
+    post = compress(frags[in_overlap], codec) if in_overlap.any() else b''
+    write_chunk_file(run_dir, f'{chunk:06d}', writer, main)
+    write_chunk_file(run_dir, f'{chunk:06d}_post', writer, post)
+    write_chunk_file(run_dir, f'{chunk + 1:06d}_pre', writer, post)
+    return len(main) + 2 * len(post)
+
+
+def _make_chunk(run_dir, chunk, writer, channels, seed, settings):
+    """Generate and write one thread's chunk. Runs in a worker process"""
+    rng = np.random.default_rng(seed)
+    full = int((settings['chunk_length'] + settings['chunk_overlap']) * 1e9)
+    samples = settings['payload_bytes'] // 2
+    if samples not in _banks:
+        _banks[samples] = _waveform_bank(samples, rng)
+    frags = generate_fragments(chunk * full, (chunk + 1) * full, settings['rate'], channels,
+                               settings['pulse_length'], settings['distribution'],
+                               settings['payload_bytes'], rng=rng, bank=_banks[samples])
+    written = write_chunk(run_dir, chunk, writer, frags, settings['chunk_length'],
+                          settings['chunk_overlap'], settings['codec'])
+    return frags.nbytes, written
+
+
+class SyntheticRun(object):
+    """Writes a fake run like a set of StraxFormatter threads would"""
+
+    def __init__(self, run_dir: str, rate: float = 100., channels: int = 494,
+                 threads: int = 8, hosts: ty.Optional[ty.List[str]] = None,
+                 pulse_length: float = 100., distribution: str = 'exponential',
+                 chunk_length: float = 5., chunk_overlap: float = 0.5,
+                 payload_bytes: int = 220, codec: str = 'lz4', workers: int = 4, seed: int = 0):
+        """
+        :param run_dir: the run's directory, <strax_output_path>/<number>
+        :param rate: MB/s of uncompressed fragments, all threads together
+        :param channels: how many channels, spread over the threads in blocks
+            like boards over readout threads
+        :param threads: writer threads per host
+        :param hosts: host names, default this one
+        :param pulse_length: mean pulse length (samples)
+        :param distribution: of the pulse lengths, one of PULSE_LENGTHS
+        :param chunk_length: strax_chunk_length (s)
+        :param chunk_overlap: strax_chunk_overlap (s)
+        :param payload_bytes: strax_fragment_payload_bytes
+        :param codec: compressor, lz4 or blosc like redax (or zstd)
+        :param workers: processes generating and writing
+        """
+        self.run_dir = run_dir
+        hosts = hosts or [socket.gethostname()]
+        rng = np.random.default_rng(seed)
+        # std::thread::id prints as a big number
+        self.writers = [f'{h}_{rng.integers(10 ** 14, 10 ** 15)}' for h in hosts for _ in range(threads)]
+        self.channels = np.array_split(np.arange(channels), len(self.writers))
+        self.settings = {'rate': rate / len(self.writers), 'pulse_length': pulse_length,
+                         'distribution': distribution, 'chunk_length': chunk_length,
+                         'chunk_overlap': chunk_overlap, 'payload_bytes': payload_bytes,
+                         'codec': codec}
+        self.workers = workers
+        self.seed = seed
+        self.bytes = self.written = 0
+
+    def run(self, duration: float, realtime: bool = False, buffer_chunks: int = 2,
+            progress: ty.Optional[ty.Callable[[int, float], None]] = None) -> None:
+        """
+        Write duration seconds of data, then THE_END
+        :param realtime: write each chunk when redax would, buffer_chunks chunks
+            after its end
+        :param buffer_chunks: strax_buffer_num_chunks
+        :param progress: called with (chunk, seconds) after each chunk
+        """
+        os.makedirs(self.run_dir, exist_ok=True)
+        full = self.settings['chunk_length'] + self.settings['chunk_overlap']
+        n_chunks = int(np.ceil(duration / full))
+        t_start = time.time()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=self.workers) as pool:
+            for chunk in range(n_chunks):
+                if realtime:
+                    time.sleep(max(0, t_start + (chunk + 1 + buffer_chunks) * full - time.time()))
+                futures = [pool.submit(_make_chunk, self.run_dir, chunk, w, ch,
+                                       (self.seed, chunk, i), self.settings)
+                           for i, (w, ch) in enumerate(zip(self.writers, self.channels))]
+                for fut in futures:
+                    b, w = fut.result()
+                    self.bytes += b
+                    self.written += w
+                if progress is not None:
+                    progress(chunk, time.time() - t_start)
+        os.makedirs(os.path.join(self.run_dir, 'THE_END'), exist_ok=True)
+        for w in self.writers:
+            with open(os.path.join(self.run_dir, 'THE_END', w), 'w') as f:
+                f.write('...my only friend\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write a synthetic run like redax would')
+    parser.add_argument('output_path', help='strax_output_path')
+    parser.add_argument('--number', type=int, default=999999, help='Run number')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds of data')
+    parser.add_argument('--rate', type=float, default=100, help='MB/s (uncompressed), total')
+    parser.add_argument('--channels', type=int, default=494)
+    parser.add_argument('--threads', type=int, default=8, help='Writer threads per host')
+    parser.add_argument('--hosts', nargs='+', help='Host names, default this one')
+    parser.add_argument('--pulse-length', type=float, default=100, help='Mean, samples')
+    parser.add_argument('--distribution', default='exponential', choices=PULSE_LENGTHS)
+    parser.add_argument('--chunk-length', type=float, default=5.)
+    parser.add_argument('--chunk-overlap', type=float, default=0.5)
+    parser.add_argument('--payload-bytes', type=int, default=220)
+    parser.add_argument('--codec', default='lz4', choices=['lz4', 'blosc', 'zstd'])
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--realtime', action='store_true', help='Write at the pace redax would')
+    parser.add_argument('--buffer-chunks', type=int, default=2, help='strax_buffer_num_chunks')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    run_dir = os.path.join(args.output_path, f'{args.number:06d}')
+    if os.path.exists(run_dir):
+        print(f'{run_dir} already exists')
+        return
+    run = SyntheticRun(run_dir, args.rate, args.channels, args.threads, args.hosts,
+                       args.pulse_length, args.distribution, args.chunk_length,
+                       args.chunk_overlap, args.payload_bytes, args.codec, args.workers, args.seed)
+
+    def progress(chunk, elapsed):
+        print(f'Chunk {chunk}: {run.bytes / 1e6:.0f} MB generated, {run.written / 1e6:.0f} MB '
+              f'written, {run.bytes / elapsed / 1e6:.0f} MB/s')
+
+    t_start = time.time()
+    run.run(args.duration, args.realtime, args.buffer_chunks, progress)
+    elapsed = time.time() - t_start
+    print(f'{run_dir}: {args.duration:.0f} s of data at {args.rate:.0f} MB/s from '
+          f'{len(run.writers)} threads, {run.bytes / 1e6:.0f} MB -> {run.written / 1e6:.0f} MB '
+          f'in {elapsed:.1f} s ({run.bytes / elapsed / 1e6:.0f} MB/s)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+"""
+Compressor benchmark and transcoder for runs redax wrote
+
+StraxFormatter compresses with lz4 (default) or blosc (option 'compressor').
+This recompresses the chunk files of a finished run with a set of codecs and
+levels in a process pool, and reports compression ratio, single-core compression
+and decompression throughput and total size for each, to decide on the
+compressor from our own data. It can then rewrite the run in place in the
+codec of your choice, eg for archived runs. Every file is verified after
+recompression and replaced atomically. strax and bootstrax decompress with
+the run doc's daq_config.compressor, so once every file is rewritten that gets
+set to the new codec too (unless --no-db, then it's up to you).
+
+    python -m daqnt.transcode /data/xenon/raw/xenonnt/012345 --codecs lz4 blosc:5 zstd:3
+    python -m daqnt.transcode /data/xenon/raw/xenonnt/012345 --rewrite zstd:3
+"""
+import argparse
+import concurrent.futures
+import os
+import time
+import typing as ty
+from .chunks import CODECS, codec_of, compress, decompress, list_chunk_files
+
+__all__ = ['parse_codec', 'benchmark_run', 'transcode_run']
+
+DEFAULT_CODECS = ['lz4', 'blosc:1', 'blosc:5', 'blosc:9', 'zstd:1', 'zstd:3', 'zstd:9']
+
+
+def parse_codec(spec: str) -> ty.Tuple[str, ty.Optional[int]]:
+    """'zstd:3' -> ('zstd', 3), 'lz4' -> ('lz4', None)"""
+    name, _, level = spec.partition(':')
+    return name, int(level) if level else None
+
+
+def _benchmark_file(path: str, codecs: ty.List[str]) -> dict:
+    """Recompresses one file with each codec. Runs in a worker process"""
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if len(buf) == 0:
+        return {'original': 0, 'raw': 0, 'codecs': {}}
+    t_start = time.perf_counter()
+    raw = decompress(buf)
+    ret = {'original': len(buf), 'original_codec': codec_of(buf), 'raw': len(raw),
+           'original_decompress': time.perf_counter() - t_start, 'codecs': {}}
+    for spec in codecs:
+        name, level = parse_codec(spec)
+        t_start = time.perf_counter()
+        packed = compress(raw, name, level)
+        t_mid = time.perf_counter()
+        if decompress(packed, name) != raw:
+            raise ValueError(f'{spec} didn\'t round-trip {path}')
+        ret['codecs'][spec] = {'size': len(packed), 'compress': t_mid - t_start,
+                               'decompress': time.perf_counter() - t_mid}
+    return ret
+
+
+def benchmark_run(run_dir: str, codecs: ty.Iterable[str] = DEFAULT_CODECS, workers: int = 4,
+                  max_files: ty.Optional[int] = None) -> dict:
+    """
+    Recompress the files of a run with each codec
+    :param run_dir: the run's directory
+    :param codecs: 'name' or 'name:level'
+    :param workers: processes
+    :param max_files: only look at this many files (spread over the run)
+    :returns: {'files', 'raw' (uncompressed bytes), 'original' (bytes on disk),
+        'wall' (s), 'codecs': {spec: {'size', 'ratio', 'compress_MBps', 'decompress_MBps'}}}
+    """
+    codecs = list(codecs)
+    files = [f.path for f in list_chunk_files(run_dir, kinds=('chunk', 'pre', 'post'))]
+    if max_files is not None and len(files) > max_files:
+        files = files[::len(files) // max_files][:max_files]
+    totals = {spec: {'size': 0, 'compress': 0., 'decompress': 0.} for spec in codecs}
+    raw = original = 0
+    t_start = time.time()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for res in pool.map(_benchmark_file, files, [codecs] * len(files), chunksize=4):
+            raw += res['raw']
+            original += res['original']
+            for spec, r in res['codecs'].items():
+                for k in totals[spec]:
+                    totals[spec][k] += r[k]
+    ret = {'files': len(files), 'raw': raw, 'original': original,
+           'wall': time.time() - t_start, 'codecs': {}}
+    for spec, t in totals.items():
+        ret['codecs'][spec] = {'size': t['size'],
+                               'ratio': raw / t['size'] if t['size'] else None,
+                               'compress_MBps': raw / t['compress'] / 1e6 if t['compress'] else None,
+                               'decompress_MBps': raw / t['decompress'] / 1e6 if t['decompress'] else None}
+    return ret
+
+
+def _transcode_file(path: str, codec: str, level: ty.Optional[int], force: bool) -> ty.Tuple[int, int]:
+    """
+    Rewrite one file in another codec, via a temporary file and a rename
+    :returns: (bytes before, bytes after)
+    """
+    with open(path, 'rb') as f:
+        buf = f.read()
+    if len(buf) == 0 or (codec_of(buf) == codec and not force):
+        return len(buf), len(buf)
+    raw = decompress(buf)
+    packed = compress(raw, codec, level)
+    if decompress(packed, codec) != raw:
+        raise ValueError(f'{codec} didn\'t round-trip {path}, leaving it alone')
+    tmp = f'{path}.transcode'
+    with open(tmp, 'wb') as f:
+        f.write(packed)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    return len(buf), len(packed)
+
+
+def transcode_run(run_dir: str, codec: str, level: ty.Optional[int] = None, workers: int = 4,
+                  force: bool = False, runs_coll=None) -> ty.Tuple[int, int, int]:
+    """
+    Rewrite every file of a run in this codec. Only for finished runs: anything
+        reading the run has to know the new codec, and redax mustn't be writing.
+    :param force: also rewrite files already in this codec (to change the level),
+        and runs without THE_END
+    :param runs_coll: the runs collection, to set the run doc's
+        daq_config.compressor to codec once all files are rewritten
+    :returns: (files, bytes before, bytes after)
+    """
+    if codec not in CODECS:
+        raise ValueError(f'strax can\'t read {codec}, only {", ".join(CODECS)}')
+    number = os.path.basename(os.path.normpath(run_dir))
+    if runs_coll is not None and not number.isdigit():
+        raise ValueError(f'Can\'t tell the run number of {run_dir}')
+    if not force and not os.path.exists(os.path.join(run_dir, 'THE_END')):
+        raise ValueError(f'{run_dir} has no THE_END, is it still being written?')
+    files = [f.path for f in list_chunk_files(run_dir, kinds=('chunk', 'pre', 'post'))]
+    before = after = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        for b, a in pool.map(_transcode_file, files, [codec] * len(files), [level] * len(files),
+                             [force] * len(files), chunksize=4):
+            before += b
+            after += a
+    if runs_coll is not None:
+        res = runs_coll.update_one({'number': int(number)},
+                                   {'$set': {'daq_config.compressor': codec}})
+        if res.matched_count == 0:
+            raise ValueError(f'No run doc for run {int(number)}, its compressor is still the old one')
+    return len(files), before, after
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare compressors on a run, or '
+                                     'rewrite it with another one')
+    parser.add_argument('run_dir', help='The run\'s directory')
+    parser.add_argument('--codecs', nargs='+', default=DEFAULT_CODECS,
+                        help='Codecs to compare, as name or name:level')
+    parser.add_argument('--rewrite', metavar='CODEC', help='Rewrite the run in place in this codec')
+    parser.add_argument('--force', action='store_true',
+                        help='Rewrite files already in the codec, and unfinished runs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--max-files', type=int, help='Benchmark on at most this many files')
+    parser.add_argument('--no-db', action='store_true',
+                        help='Don\'t update the run doc\'s compressor after --rewrite')
+    parser.add_argument('--runs-db', default='run')
+    parser.add_argument('--runs-coll', default='runs_gas')
+    args = parser.parse_args()
+
+    if args.rewrite is not None:
+        name, level = parse_codec(args.rewrite)
+        runs_coll = None
+        if not args.no_db:
+            from .database import get_client
+            runs_coll = get_client('run')[args.runs_db][args.runs_coll]
+        t_start = time.time()
+        n, before, after = transcode_run(args.run_dir, name, level, args.workers, args.force,
+                                         runs_coll)
+        print(f'Rewrote {n} files in {time.time() - t_start:.1f} s: {before / 1e6:.1f} MB -> '
+              f'{after / 1e6:.1f} MB ({(before - after) / 1e6:.1f} MB saved)')
+        if runs_coll is None:
+            print(f'Set daq_config.compressor of the run doc to {name}, or strax can\'t read it')
+        return
+    res = benchmark_run(args.run_dir, args.codecs, args.workers, args.max_files)
+    print(f'{res["files"]} files, {res["raw"] / 1e6:.1f} MB uncompressed, '
+          f'{res["original"] / 1e6:.1f} MB on disk now (ratio '
+          f'{res["raw"] / max(res["original"], 1):.2f}), {res["wall"]:.1f} s with {args.workers} workers')
+    print(f'{"codec":<10}{"size MB":>10}{"ratio":>8}{"comp MB/s":>11}{"decomp MB/s":>13}')
+    for spec, r in sorted(res['codecs'].items(), key=lambda kv: kv[1]['size']):
+        print(f'{spec:<10}{r["size"] / 1e6:>10.1f}{r["ratio"] or 0:>8.2f}'
+              f'{r["compress_MBps"] or 0:>11.0f}{r["decompress_MBps"] or 0:>13.0f}')
+
+
+if __name__ == '__main__':
+    main()
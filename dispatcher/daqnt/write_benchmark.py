@@ -0,0 +1,178 @@
+"""
+Benchmark of the way StraxFormatter writes to strax_output_path
+
+For each chunk, every StraxFormatter thread writes <chunk>, <chunk>_post and
+<chunk+1>_pre: it creates <name>_temp if it doesn't exist, writes its file
+there, checks whether the final file exists, creates <name> if needed and
+renames the file into it. How fast that goes, and how much the metadata
+operations cost, depends on the filesystem (local disk vs ceph), the file
+sizes (strax_chunk_length and the rate), how many threads do it at once, and
+whether anything is synced. This replays the pattern with threads against a
+target directory and reports the sustained MB/s and the latency
+distribution of every step, with and without fsync. Flat out by default, or
+paced like a real run (each chunk written strax_buffer_num_chunks chunks
+after its end) to see if a deployment keeps up.
+
+    python -m daqnt.write_benchmark /data/xenon/raw/test --threads 8 --rate 200 --fsync none file dir
+"""
+import argparse
+import os
+import shutil
+import threading
+import time
+import typing as ty
+import numpy as np
+
+__all__ = ['FSYNC_MODES', 'write_pattern', 'run_benchmark']
+
+FSYNC_MODES = ['none', 'file', 'dir']  # dir: the file, and the directory after the rename
+STEPS = ['mkdir_temp', 'write', 'fsync', 'exists', 'mkdir', 'rename', 'fsync_dir', 'file', 'chunk']
+
+
+def write_pattern(run_dir: str, chunk: int, writer: str, main: bytes, post: bytes,
+                  fsync: str = 'none', times: ty.Optional[ty.Dict[str, list]] = None) -> int:
+    """
+    Write one thread's files of one chunk like StraxFormatter::WriteOutChunk
+    :param main: contents of <chunk>
+    :param post: contents of <chunk>_post and <chunk+1>_pre
+    :param fsync: one of FSYNC_MODES
+    :param times: {step: [seconds]} to add the timing of each step to
+    :returns: bytes written
+    """
+    times = times if times is not None else {}
+    clock = time.perf_counter
+
+    def step(name, t0):
+        t1 = clock()
+        times.setdefault(name, []).append(t1 - t0)
+        return t1
+
+    t_chunk = clock()
+    for name, buf in ((f'{chunk:06d}', main), (f'{chunk:06d}_post', post),
+                      (f'{chunk + 1:06d}_pre', post)):
+        t_file = t = clock()
+        temp_dir = os.path.join(run_dir, name + '_temp')
+        if not os.path.exists(temp_dir):
+            os.makedirs(temp_dir, exist_ok=True)
+        t = step('mkdir_temp', t)
+        temp = os.path.join(temp_dir, writer)
+        with open(temp, 'wb') as f:
+            f.write(buf)
+            if fsync != 'none':
+                f.flush()
+                t = step('write', t)
+                os.fsync(f.fileno())
+                t = step('fsync', t)
+        if fsync == 'none':
+            t = step('write', t)
+        final_dir = os.path.join(run_dir, name)
+        final = os.path.join(final_dir, writer)
+        os.path.exists(final)
+        t = step('exists', t)
+        if not os.path.exists(final_dir):
+            os.makedirs(final_dir, exist_ok=True)
+        t = step('mkdir', t)
+        os.rename(temp, final)
+        t = step('rename', t)
+        if fsync == 'dir':
+            fd = os.open(final_dir, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            step('fsync_dir', t)
+        step('file', t_file)
+    step('chunk', t_chunk)
+    return len(main) + 2 * len(post)
+
+
+def run_benchmark(target: str, threads: int = 8, rate: float = 100., chunks: int = 10,
+                  chunk_length: float = 5., chunk_overlap: float = 0.5, fsync: str = 'none',
+                  paced: bool = False, buffer_chunks: int = 2, keep: bool = False) -> dict:
+    """
+    Write chunks files from threads into a fresh run directory under target
+    :param rate: MB/s on disk (ie compressed) of all threads together
+    :param chunks: how many chunks each thread writes
+    :param paced: write each chunk when redax would, instead of flat out
+    :param buffer_chunks: strax_buffer_num_chunks, for the pacing
+    :param keep: leave the files
+    :returns: {'bytes', 'wall', 'MBps', 'late' (chunks written after the next
+        one was due, when paced), 'steps': {step: {'n', 'p50', 'p90', 'p99', 'max'} (ms)}}
+    """
+    run_dir = os.path.join(target, f'write_benchmark_{os.getpid()}_{int(time.time())}')
+    os.makedirs(run_dir)
+    per_thread = rate * 1e6 / threads
+    main = np.random.default_rng(0).integers(0, 256, size=int(per_thread * chunk_length),
+                                             dtype=np.uint8).tobytes()
+    post = main[:int(per_thread * chunk_overlap)]
+    full = chunk_length + chunk_overlap
+    results = [None] * threads
+    t_start = time.time()
+
+    def writer(i):
+        times, written, late = {}, 0, 0
+        name = f'benchmark_{i}'
+        for chunk in range(chunks):
+            if paced:
+                due = t_start + (chunk + 1 + buffer_chunks) * full
+                if (wait := due - time.time()) > 0:
+                    time.sleep(wait)
+                elif -wait > full:
+                    late += 1
+            written += write_pattern(run_dir, chunk, name, main, post, fsync, times)
+        results[i] = (times, written, late)
+
+    workers = [threading.Thread(target=writer, args=(i,)) for i in range(threads)]
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    wall = time.time() - t_start
+    if not keep:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    total = sum(r[1] for r in results)
+    ret = {'bytes': total, 'wall': wall, 'MBps': total / wall / 1e6,
+           'late': sum(r[2] for r in results), 'steps': {}}
+    for s in STEPS:
+        t = np.concatenate([np.asarray(r[0].get(s, []), dtype=np.float64) for r in results]) * 1e3
+        if len(t) == 0:
+            continue
+        p50, p90, p99 = np.percentile(t, [50, 90, 99])
+        ret['steps'][s] = {'n': len(t), 'p50': p50, 'p90': p90, 'p99': p99, 'max': t.max()}
+    return ret
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark StraxFormatter\'s write pattern')
+    parser.add_argument('target', help='Where to write, eg strax_output_path')
+    parser.add_argument('--threads', type=int, nargs='+', default=[8],
+                        help='Writer threads (several to compare)')
+    parser.add_argument('--rate', type=float, default=100, help='MB/s on disk, all threads')
+    parser.add_argument('--chunks', type=int, default=10, help='Chunks per thread')
+    parser.add_argument('--chunk-length', type=float, nargs='+', default=[5.],
+                        help='strax_chunk_length (s, several to compare)')
+    parser.add_argument('--chunk-overlap', type=float, default=0.5)
+    parser.add_argument('--fsync', nargs='+', default=['none'], choices=FSYNC_MODES)
+    parser.add_argument('--paced', action='store_true', help='Write at the pace of a real run')
+    parser.add_argument('--buffer-chunks', type=int, default=2, help='strax_buffer_num_chunks')
+    parser.add_argument('--keep', action='store_true', help='Don\'t delete what got written')
+    args = parser.parse_args()
+
+    for threads in args.threads:
+        for chunk_length in args.chunk_length:
+            for fsync in args.fsync:
+                res = run_benchmark(args.target, threads, args.rate, args.chunks, chunk_length,
+                                    args.chunk_overlap, fsync, args.paced, args.buffer_chunks,
+                                    args.keep)
+                print(f'{threads} threads, {chunk_length} s chunks, fsync {fsync}: '
+                      f'{res["bytes"] / 1e6:.0f} MB in {res["wall"]:.2f} s, {res["MBps"]:.0f} MB/s'
+                      + (f', {res["late"]} chunks late' if args.paced else ''))
+                print(f'  {"ms":<11}{"n":>7}{"p50":>9}{"p90":>9}{"p99":>9}{"max":>9}')
+                for step, s in res['steps'].items():
+                    print(f'  {step:<11}{s["n"]:>7}{s["p50"]:>9.3f}{s["p90"]:>9.3f}'
+                          f'{s["p99"]:>9.3f}{s["max"]:>9.3f}')
+
+
+if __name__ == '__main__':
+    main()
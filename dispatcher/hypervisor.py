@@ -1,13 +1,23 @@
+import re
 import time
 import socket
 import subprocess
 import datetime
+import contextlib
 import daqnt
+from daqnt.database import status_order
 import pytz
+import threading
 import typing as ty
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
+from bson import ObjectId
+from pymongo.errors import PyMongoError
 
-__all__ = 'Hypervisor HypervisorAuthorization'.split()
+__all__ = 'Hypervisor HypervisorAuthorization HealthSnapshot RecoveryTimeline'.split()
+
+# commands whose target is a whole package (crate), so they have to run on their own
+BARRIER_COMMANDS = ('vmectl',)
 
 def date_now():
     return datetime.datetime.now(pytz.utc)
@@ -23,7 +33,8 @@ class Hypervisor(object):
                  detector='tpc',
                  control_inputs=None,
                  slackbot=None,
-                 testing=False):
+                 testing=False,
+                 sh=None):
         """
         Hypervisor, the daq resolver that restarts processes on request
             or if things are failing.
@@ -35,6 +46,7 @@ class Hypervisor(object):
         :param control_inputs: the list of control handles the dispatcher uses
         :param slackbot: optional slackbot messaging class
         :param testing: testing
+        :param sh: optional SignalHandler, whose event tells us to stop
         """
         if not isinstance(detector, str) or detector not in ['tpc', 'muon_veto', 'neutron_veto', 'test']:
             raise ValueError(f"Single detector only allowed: {detector} is unknown")
@@ -42,20 +54,46 @@ class Hypervisor(object):
         self.logger = logger
         self.detector = detector
         self.hosts = config[detector]['controller'] + config[detector]['readers']
+        # Whose start ack counts as the start of a run
+        self.start_ack_host = (config[detector]['controller'] or ['reader0_controller_0'])[0]
         self.vme_crates = vme_crates
         self.physical_detectors = dict(config.items())
         self.control_inputs = [] if control_inputs is None else control_inputs[:]
         self.slackbot = slackbot
+        # '_id' or 'time', depending on whether status is a time-series collection
+        self.status_order = None
+        # 'long' and 'short' are the ceilings on how long we wait for
+        # something to happen, we move on as soon as it has
         self.sleep_time = {
             'long': 10,
             'short': 5,
+            # How often to re-check a condition we are waiting on
+            'check': 0.5,
+            # Redax checks in every second, so a process that hasn't
+            # reported for this long is gone
+            'gone': 3,
+            # Minimum time the crates stay without power in a hard reset,
+            # even once they report off, so the boards fully power down
+            'off': 10,
+            # Settling time for the boards after the crates report power
+            'boot': 2,
             # Check on the status that the DAQ is up every 'poll' minutes
             'poll': 4 * 60,
+            # Look for new hypervisor commands at least this often
+            'command_poll': 2,
+            # How long to poll before trying to get a change stream again
+            'command_retry': 5 * 60,
             'max_wait': 15 * 60}
         # If we are not starting a run for this long, increase the
         # authorization on the Hypervisor
         self.max_timeout = 90 * 60
         self.testing = testing
+        # The RecoveryTimeline of the reset in progress, if any
+        self.timeline = None
+        self.event = sh.event if sh is not None else threading.Event()
+        # Commands and resets shouldn't step on each other
+        self.action_lock = threading.RLock()
+        self.command_thread = None
         self.logger.info(f'HV v{self.__version__} started')
 
     def run_over_ssh(self, address: str, cmd: str, rets: list) -> None:
@@ -100,6 +138,67 @@ class Hypervisor(object):
             return str(e)
         return 0
 
+    def vme_is_on(self, crate: ty.Union[str, int]) -> ty.Union[bool, None]:
+        """
+        Ask crate x if its main output is powered
+        :returns: True/False for on/off, None if the crate didn't give a usable answer
+        """
+        cmd = '$CMD:MON,CH:8,PAR:STAT\r\n'
+        if str(crate) not in self.vme_crates:
+            return None
+        try:
+            with socket.create_connection((self.vme_crates[str(crate)], 8100), timeout=1) as s:
+                s.sendall(cmd.encode())
+                time.sleep(0.01)
+                reply = s.recv(1024).decode(errors='replace')
+        except Exception as e:
+            self.logger.debug(f'Couldn\'t get status of VME{crate}: {type(e)}, {e}')
+            return None
+        if (m := re.search(r'VAL:(\d+)', reply)) is None:
+            self.logger.debug(f'Unexpected status reply from VME{crate}: {reply.strip()}')
+            return None
+        # bit 0 of the status word is the on/off state of the main output
+        return bool(int(m.group(1)) & 0x1)
+
+    def wait_for(self, condition: ty.Callable[[], bool], ceiling: float, what: str) -> bool:
+        """
+        Polls the condition every sleep_time['check'] seconds until it holds,
+            for at most ceiling seconds. Errors while checking count as "not yet".
+        :param condition: callable returning True once we can proceed
+        :param ceiling: the longest we are willing to wait (s)
+        :param what: description of the condition for the logs
+        :returns: True if the condition was met, False if we hit the ceiling
+        """
+        t_start = time.time()
+        while True:
+            try:
+                if condition():
+                    self.logger.debug(f'{what} after {time.time() - t_start:.1f} s')
+                    return True
+            except Exception as e:
+                self.logger.debug(f'Checking {what} ran into {type(e)}: {e}')
+            remaining = ceiling - (time.time() - t_start)
+            if remaining <= 0:
+                break
+            time.sleep(min(self.sleep_time['check'], remaining))
+        self.logger.warning(f'Not {what} after {ceiling} s, moving on')
+        return False
+
+    def readout_is_gone(self, hosts: list) -> bool:
+        """Have all of these processes stopped checking in?"""
+        _, timeout, _ = self.get_current_readout_state(hosts, max_age=self.sleep_time['gone'])
+        return set(timeout) == set(hosts)
+
+    def readout_is_idle(self, hosts: list) -> bool:
+        """Are all of these processes checking in as IDLE?"""
+        responding, _, states = self.get_current_readout_state(hosts)
+        return (set(responding) == set(hosts) and
+                all(s == daqnt.DAQ_STATUS.IDLE for s in states))
+
+    def crates_are(self, state: str) -> bool:
+        """Do all our crates report the requested power state ('on' or 'off')?"""
+        return all(self.vme_is_on(c) is (state == 'on') for c in self.vme_crates.keys())
+
     def fix_orphaned_sin(self, cc: str) -> int:
         """
         Fixes any potential orphaned S-IN by arming then disarming the CC.
@@ -113,14 +212,12 @@ class Hypervisor(object):
         doc = dict(command='arm', user='hypervisor', host=[cc], mode='tpc_cause_crashes',
             acknowledged={cc:0}, createdAt=date_now(), detector='tpc')
         oid = self.db.control.insert_one(doc)
-        time.sleep(0.2)
-        for i in range(5):
-            if self.db.control.find_one({'_id': oid.inserted_id})['acknowledged'][cc] == 0:
-                self.logger.info(f'S-IN not ack\'d yet ({i}/5)')
-                time.sleep(self.sleep_time['short'])
-            else:
-                self.logger.info(f'S-IN is ack\'d ({i}/5)')
-                break
+        if self.wait_for(
+                lambda: self.db.control.find_one({'_id': oid.inserted_id})['acknowledged'][cc] != 0,
+                5 * self.sleep_time['short'], 'S-IN ack\'d'):
+            self.logger.info('S-IN is ack\'d')
+        else:
+            self.logger.info('S-IN not ack\'d, stopping anyway')
         doc['command'] = 'stop'
         doc['createdAt'] = date_now()
         del doc['_id']
@@ -276,23 +373,26 @@ class Hypervisor(object):
             hypervisor collection and do it. Optionally, do the
             extra-todos AFTER the commands in the hypervisor collection.
 
+        All pending documents are handled, oldest first. Within a document,
+            the tasks run in the order they are listed, except that consecutive
+            tasks of the same command on different targets run concurrently
+            (see group_tasks). A document we can't run is marked with an error
+            so it isn't picked up again.
+
         Commands from the DB should be ack'd to the DB, and commands
             from the dispatcher should be ack'd to the dispatcher.
         """
         coll = self.db.hypervisor
-        doc = coll.find_one_and_update({'ack': 0},
-                                       {'$currentDate': {'ack': 1}}, sort=[('_id', 1)])
-        ret = []
-        if doc is not None:
-            self.logger.debug(f'Found {len(doc["commands"])} commands')
-            for task in doc['commands']:
-                self.logger.debug(f'{task}')
-                command, action, target = task['command'], task['action'], task['target']
+        with self.action_lock:
+            while (doc := coll.find_one_and_update({'ack': 0},
+                                                   {'$currentDate': {'ack': 1}},
+                                                   sort=[('_id', 1)])) is not None:
                 try:
-                    ret.append(getattr(self, command)(action, target))
+                    self.logger.debug(f'Found {len(doc["commands"])} commands')
+                    self.run_hypervisor_doc(doc)
                 except Exception as e:
-                    ret.append(str(e))
-            coll.update_one({'_id': doc['_id']}, {'$set': {'ret': ret}})
+                    self.logger.error(f'Couldn\'t run hypervisor doc {doc["_id"]}: {type(e)}, {e}')
+                    coll.update_one({'_id': doc['_id']}, {'$set': {'error': f'{type(e)}, {e}'}})
 
         # Return return codes to dispatcher, not mongo and vice versa
         ret = []
@@ -310,6 +410,120 @@ class Hypervisor(object):
                                       f'on {target}: {e}')
         return ret
 
+    def run_hypervisor_doc(self, doc: dict) -> list:
+        """
+        Runs the commands of one hypervisor document, acknowledging each task
+            (its return value in ret.i and the time it finished in done.i) as
+            soon as it is done.
+        :returns: the return values, in the order of the commands
+        """
+        coll = self.db.hypervisor
+        tasks = doc['commands']
+        ret = [None] * len(tasks)
+        coll.update_one({'_id': doc['_id']}, {'$set': {'ret': ret, 'done': [None] * len(tasks)}})
+
+        def run_group(indices):
+            for i in indices:
+                task = tasks[i]
+                self.logger.debug(f'{task}')
+                try:
+                    ret[i] = getattr(self, task['command'])(task['action'], task['target'])
+                except Exception as e:
+                    ret[i] = str(e)
+                try:
+                    coll.update_one({'_id': doc['_id']},
+                                    {'$set': {f'ret.{i}': ret[i], f'done.{i}': date_now()}})
+                except Exception as e:
+                    self.logger.error(f'Couldn\'t ack task {i} of {doc["_id"]}: {type(e)}, {e}')
+
+        for groups in self.group_tasks(tasks):
+            if len(groups) == 1:
+                run_group(groups[0])
+            else:
+                with ThreadPoolExecutor(max_workers=len(groups)) as pool:
+                    # list() so exceptions in the workers aren't swallowed
+                    list(pool.map(run_group, groups))
+        return ret
+
+    @staticmethod
+    def group_tasks(tasks: list) -> ty.List[ty.List[ty.List[int]]]:
+        """
+        Splits tasks into steps that run one after the other, in the order of
+            the doc. A step is either a single barrier command (vmectl: its
+            target is a whole package, so it can't overlap anything), or a run
+            of consecutive tasks with the same command. Inside such a step the
+            tasks are split into groups that can run in parallel: two tasks end
+            up in the same group if they (transitively) share a target.
+        :returns: a list of steps, each a list of groups of indices into tasks,
+            each group in the original order
+        """
+        steps = []  # [(command, [(set of targets, [indices])])]
+        for i, task in enumerate(tasks):
+            command = task.get('command')
+            if command in BARRIER_COMMANDS:
+                # a step of its own, nothing can join it
+                steps.append((None, [(set(), [i])]))
+                continue
+            if not steps or steps[-1][0] != command:
+                steps.append((command, []))
+            groups = steps[-1][1]
+            target = task.get('target')
+            targets = {str(t) for t in target} if isinstance(target, (list, tuple)) else {str(target)}
+            overlapping = [g for g in groups if g[0] & targets]
+            merged = (targets.union(*(g[0] for g in overlapping)),
+                      sorted([i] + [j for g in overlapping for j in g[1]]))
+            groups[:] = [g for g in groups if g not in overlapping] + [merged]
+        return [sorted((g[1] for g in groups), key=lambda indices: indices[0])
+                for _, groups in steps]
+
+    def watch_commands(self) -> None:
+        """
+        Handles documents in the hypervisor collection as soon as they are inserted.
+            We listen on a change stream, and also look for pending commands every
+            sleep_time['command_poll'] seconds in case we missed something. If the
+            database can't give us a change stream we fall back to polling only.
+        """
+        coll = self.db.hypervisor
+        pipeline = [{'$match': {'operationType': 'insert'}}]
+        # anything that came in while we weren't listening
+        try:
+            self.process_control()
+        except Exception as e:
+            self.logger.error(f'Caught a {type(e)} while handling commands: {e}')
+        while not self.event.is_set():
+            try:
+                with coll.watch(pipeline,
+                                max_await_time_ms=int(self.sleep_time['command_poll'] * 1000)) as stream:
+                    self.logger.debug('Watching the hypervisor collection')
+                    while not self.event.is_set() and stream.alive:
+                        # returns after max_await_time_ms if nothing happened
+                        stream.try_next()
+                        self.process_control()
+            except PyMongoError as e:
+                self.logger.warning(f'No change stream on the hypervisor collection ({type(e)}: {e}), '
+                                    f'polling for the next {self.sleep_time["command_retry"]} s')
+                t_start = time.time()
+                while (not self.event.is_set() and
+                       time.time() - t_start < self.sleep_time['command_retry']):
+                    self.event.wait(self.sleep_time['command_poll'])
+                    try:
+                        self.process_control()
+                    except PyMongoError as e:
+                        self.logger.error(f'DB down? {type(e)}, {e}')
+                    except Exception as e:
+                        self.logger.error(f'Caught a {type(e)} while handling commands: {e}')
+            except Exception as e:
+                # this thread is the only one handling commands, so it can't die
+                self.logger.error(f'Caught a {type(e)} while handling commands: {e}')
+                self.event.wait(self.sleep_time['command_poll'])
+
+    def start_command_watcher(self) -> threading.Thread:
+        """Starts watch_commands in a background thread, unless it's already running"""
+        if self.command_thread is None or not self.command_thread.is_alive():
+            self.command_thread = threading.Thread(target=self.watch_commands, daemon=True)
+            self.command_thread.start()
+        return self.command_thread
+
     # def strategic_nuclear_option(self):
     #     """
     #     When even the tactical options aren't powerful enough
@@ -385,12 +599,14 @@ class Hypervisor(object):
         if 0 not in self.kill_redax(host):
             self.logger.error(f'Error killing {host}?')
 
-        time.sleep(self.sleep_time['short'])
+        self.wait_for(lambda: self.readout_is_gone([host]),
+                      self.sleep_time['short'], f'{host} gone')
 
         # restart redax
         if 0 not in self.start_redax(host):
             self.logger.error(f'Error starting {host}?')
-        time.sleep(self.sleep_time['long'])
+        self.wait_for(lambda: self.readout_is_idle([host]),
+                      self.sleep_time['long'], f'{host} checking in IDLE')
 
     def linked_nuclear_option(self):
         """
@@ -450,26 +666,38 @@ class Hypervisor(object):
         """
         self.logger.critical("Hypervisor invoking the tactical nuclear option")
         level = HypervisorAuthorization.HardReset
-        if is_linked:
-            # we're currently in a linked mode, lots of extra logic to handle first
-            if self.linked_nuclear_option():
-                # problem solved
-                return False
-
-        # guess not, let's drop some nukes
-        if self.can_use_the_force():
-            self.logger.warning('Hypervisor going Nuclear')
-            level = HypervisorAuthorization.Nuclear
-        self.hard_reset(level)
+        self.timeline = tl = RecoveryTimeline(self.detector, 'tactical_nuclear_option', level)
+        try:
+            if is_linked:
+                # we're currently in a linked mode, lots of extra logic to handle first
+                with tl.phase('linked_nuclear_option') as phase:
+                    phase['condition_met'] = self.linked_nuclear_option()
+                if phase['condition_met']:
+                    # problem solved
+                    return False
+
+            # guess not, let's drop some nukes
+            if self.can_use_the_force():
+                self.logger.warning('Hypervisor going Nuclear')
+                level = HypervisorAuthorization.Nuclear
+                tl.escalate(level)
+            self.hard_reset(level)
+        finally:
+            self.finish_timeline()
         return True
 
-    def get_hypervisor_authorization(self):
-        """Determine until which level the hypervisor is allowed to resolve conflicts"""
+    def get_hypervisor_authorization(self, snapshot: ty.Optional['HealthSnapshot'] = None):
+        """
+        Determine until which level the hypervisor is allowed to resolve conflicts
+        :param snapshot: HealthSnapshot to decide on, a fresh one is taken if None
+        """
         self.logger.info(f'Determine authorization of hypervisor.')
         level = HypervisorAuthorization.Nothing
-        since = date_now() - datetime.timedelta(seconds=self.sleep_time['poll'])
-        is_running = self.was_daq_running(since)
-        should_be_running = self.should_daq_be_running()
+        if snapshot is None:
+            snapshot = self.get_health_snapshot()
+        since = snapshot.since
+        is_running = self.was_daq_running(since, snapshot)
+        should_be_running = self.should_daq_be_running(snapshot)
 
         self.logger.info(f'Since {since} the DAQ is running={is_running} '
                          f'which should be {should_be_running}')
@@ -490,7 +718,7 @@ class Hypervisor(object):
         assert (should_be_running and not is_running), "learn to elif please"
 
         level = HypervisorAuthorization.TimeoutResolve
-        if self.daq_timedout_long():
+        if self.daq_timedout_long(snapshot):
             self.logger.warning('Hypervisor going to hard reset')
             level = HypervisorAuthorization.HardReset
 
@@ -501,37 +729,112 @@ class Hypervisor(object):
         self.logger.info(f'Hypervisor authorized to level {str(level)}')
         return level
 
-    def was_daq_running(self, since: datetime.datetime) -> bool:
+    def get_health_snapshot(self,
+                            since: ty.Optional[datetime.datetime] = None,
+                            hosts: ty.Optional[list] = None,
+                            hosts_only: bool = False) -> 'HealthSnapshot':
+        """
+        Everything the hypervisor bases its decisions on, from two aggregations:
+            the newest status document of every host (by _id on a plain status
+            collection, by time on a time-series one, see daqnt.database.status_order),
+            and one pipeline over detector_control, aggregate_status and control
+            for the goal state, any RUNNING since {since}, and the last start ack.
+        :param since: start of the window for was_running, default 'poll' seconds ago
+        :param hosts: hosts to get the status of, default all of ours
+        :param hosts_only: skip the second aggregation (for when we only need host states)
+        :returns: HealthSnapshot
+        """
+        now = date_now()
+        hosts = self.hosts if hosts is None else hosts
+        if since is None:
+            since = now - datetime.timedelta(seconds=self.sleep_time['poll'])
+        host_status = {}
+        if self.status_order is None:
+            self.status_order = status_order(self.db['status'])
+        for doc in self.db['status'].aggregate([
+                {'$match': {'host': {'$in': hosts}}},
+                {'$sort': {'host': 1, self.status_order: -1}},
+                {'$group': {'_id': '$host',
+                            'status': {'$first': '$status'},
+                            'time': {'$first': '$time'}}}]):
+            host_status[doc['_id']] = {'status': doc['status'],
+                                       'time': doc['time'].replace(tzinfo=pytz.utc)}
+        if hosts_only:
+            return HealthSnapshot(time=now, since=since, hosts=host_status,
+                                  was_running=None, should_be_running=None, last_start_ack=None)
+
+        cc = self.start_ack_host
+        found = {}
+        for doc in self.db['detector_control'].aggregate([
+                {'$match': {'key': f'{self.detector}.active'}},
+                {'$sort': {'_id': -1}},
+                {'$limit': 1},
+                {'$project': {'_id': 0, 'kind': {'$literal': 'goal'}, 'value': '$value'}},
+                {'$unionWith': {'coll': 'aggregate_status', 'pipeline': [
+                    # _id rather than time, so this is a range scan on the (detector, _id) index
+                    {'$match': {'detector': self.detector,
+                                '_id': {'$gt': ObjectId.from_datetime(since)},
+                                'status': int(daqnt.DAQ_STATUS.RUNNING)}},
+                    {'$limit': 1},
+                    {'$project': {'_id': 0, 'kind': {'$literal': 'running'}, 'value': '$time'}}]}},
+                {'$unionWith': {'coll': 'control', 'pipeline': [
+                    # only acked starts: the field is 0 until then, and missing for
+                    # starts that didn't go to this host (other detectors)
+                    {'$match': {'command': 'start', f'acknowledged.{cc}': {'$type': 'date'}}},
+                    {'$sort': {'_id': -1}},
+                    {'$limit': 1},
+                    {'$project': {'_id': 0, 'kind': {'$literal': 'start'}, 'value': f'$acknowledged.{cc}'}}]}},
+                ]):
+            found[doc['kind']] = doc.get('value')
+        last_start = found.get('start')
+        return HealthSnapshot(
+            time=now,
+            since=since,
+            hosts=host_status,
+            was_running='running' in found,
+            should_be_running=found.get('goal') == 'true',
+            last_start_ack=last_start.replace(tzinfo=pytz.utc)
+                if isinstance(last_start, datetime.datetime) else None)
+
+    def was_daq_running(self, since: datetime.datetime,
+                        snapshot: ty.Optional['HealthSnapshot'] = None) -> bool:
         """Was the daq running since {since}"""
-        for doc in self.db['aggregate_status'].find({'time': {'$gt': since}, 'detector': self.detector}):
-            if doc['status'] == daqnt.DAQ_STATUS.RUNNING:
-                self.logger.debug(f'Since {since}, the {self.detector.upper()} was in {doc["status"]}')
-                return True
-        self.logger.debug(f'Since {since}, the {self.detector.upper()} was not running')
-        return False
+        if snapshot is None or snapshot.was_running is None or snapshot.since != since:
+            snapshot = self.get_health_snapshot(since=since)
+        if snapshot.was_running:
+            self.logger.debug(f'Since {since}, the {self.detector.upper()} was RUNNING')
+        else:
+            self.logger.debug(f'Since {since}, the {self.detector.upper()} was not running')
+        return snapshot.was_running
 
-    def should_daq_be_running(self) -> bool:
+    def should_daq_be_running(self, snapshot: ty.Optional['HealthSnapshot'] = None) -> bool:
         """Query if the detector was set to active"""
+        if snapshot is None or snapshot.should_be_running is None:
+            snapshot = self.get_health_snapshot()
+        self.logger.debug(f'Should daq be running: {snapshot.should_be_running}')
+        return snapshot.should_be_running
 
-        doc = self.db['detector_control'].find_one({'key': f'{self.detector}.active'},
-                                                   sort=[('_id', -1)])
-        res = doc is not None and doc['value'] == 'true'
-        self.logger.debug(f'Should daq be running: {res}')
-        return res
-
-    def daq_timedout_long(self) -> bool:
+    def daq_timedout_long(self, snapshot: ty.Optional['HealthSnapshot'] = None) -> bool:
         """
         Different way of checking that a run has started in the last
             self.max_timeout seconds
             """
-        last_start = self.db['control'].find_one(
-            {"acknowledged.reader0_controller_0": {"$ne": 0},
-             "command": "start"},
-            sort=[("_id", -1)])
-        last_start_date = last_start['acknowledged']['reader0_controller_0'].replace(tzinfo=pytz.utc)
-        time_since_last = date_now() - last_start_date
-        self.logger.debug(f'Time since last run start {time_since_last}')
-        return time_since_last.seconds > self.max_timeout
+        if snapshot is None or snapshot.should_be_running is None:
+            snapshot = self.get_health_snapshot()
+        if snapshot.last_start_ack is None:
+            self.logger.warning(f'No acked start for {self.start_ack_host}, not counting this as a long timeout')
+        self.logger.debug(f'Time since last run start {snapshot.time_since_start()}')
+        return snapshot.timed_out_long(self.max_timeout)
+
+    def get_host_suspicion(self) -> ty.Dict[str, float]:
+        """
+        How suspicious the dispatcher's failure detector is that each of our
+            hosts is dead (phi). Empty if we aren't connected to a dispatcher.
+        """
+        if not hasattr(self, 'mongo_connect'):
+            return {}
+        suspicion = self.mongo_connect.get_suspicion()
+        return {h: suspicion.get(h, 0.) for h in self.hosts}
 
     def can_use_the_force(self):
         """
@@ -546,18 +849,13 @@ class Hypervisor(object):
         self.logger.debug(f'can_use_the_force:: {hour not in working_hours}')
         return (hour not in working_hours) or (weekday in [5, 6])
 
-    def get_current_readout_state(self, hosts: list) -> ty.Tuple[list, list, list]:
-        """Get the states of the hosts"""
-        responding, timeout, states = [], [], []
-        now = date_now()
-        for host in hosts:
-            doc = self.db['status'].find_one({'host': host}, sort=[('_id', -1)])
-            if doc is None or now - doc['time'].replace(tzinfo=pytz.utc) > datetime.timedelta(seconds=10):
-                timeout.append(doc['host'])
-            else:
-                responding.append(doc['host'])
-                states.append(doc['status'])
-        return responding, timeout, states
+    def get_current_readout_state(self, hosts: list, max_age: float = 10) -> ty.Tuple[list, list, list]:
+        """
+        Get the states of the hosts
+        :param hosts: the processes to check
+        :param max_age: how old (s) the newest status may be before the host counts as timing out
+        """
+        return self.get_health_snapshot(hosts=hosts, hosts_only=True).readout_state(hosts, max_age)
 
     def hard_reset(self, authorization_level):
         """
@@ -570,6 +868,9 @@ class Hypervisor(object):
             it can go through the various levels of rebooting:
              - HardReset/TimeoutResolve -> Forceful restart allowed
              - Nuclear -> everything shy of rebooting the servers at LNGS
+
+        Everything that happens is recorded in a RecoveryTimeline, unless
+            the caller already started one.
         """
         if authorization_level not in [HypervisorAuthorization.TimeoutResolve,
                                        HypervisorAuthorization.HardReset,
@@ -577,36 +878,51 @@ class Hypervisor(object):
             self.logger.warning("hard_reset is not available for Nothing")
             return
 
+        with self.action_lock:
+            owns_timeline = self.timeline is None
+            if owns_timeline:
+                self.timeline = RecoveryTimeline(self.detector, 'hard_reset', authorization_level)
+            tl = self.timeline
+            try:
+                self._hard_reset(authorization_level, tl)
+            finally:
+                if owns_timeline:
+                    self.finish_timeline()
+
+    def _hard_reset(self, authorization_level, tl):
         all_readout = self.hosts[:]
 
         if authorization_level <= HypervisorAuthorization.HardReset:
             # Figure out what is running and what is in timeout
-            responding, timeout, states = [], [], [daqnt.DAQ_STATUS.RUNNING]
-            for i in range(int(self.sleep_time['max_wait'] // self.sleep_time['short'])):
-                if not any(s in [daqnt.DAQ_STATUS.ARMING,
-                                 daqnt.DAQ_STATUS.ARMED,
-                                 daqnt.DAQ_STATUS.RUNNING]
-                           for s in states):
-                    break
-                time.sleep(self.sleep_time['short'])
-                responding, timeout, states = self.get_current_readout_state(all_readout)
-                self.logger.info('Try %i Current states: %s/%s' % (i, states, timeout))
-            else:
-                self.logger.error(
-                    f"Did not resolve host status in {self.sleep_time['max_wait']} s. "
-                    f"Going for the nuclear option. There be dragons here")
-                authorization_level = HypervisorAuthorization.Nuclear
+            with tl.phase('wait_for_idle_or_timeout') as phase:
+                for i in range(int(self.sleep_time['max_wait'] // self.sleep_time['short'])):
+                    responding, timeout, states = self.get_current_readout_state(all_readout)
+                    self.logger.info('Try %i Current states: %s/%s' % (i, states, timeout))
+                    if not any(s in [daqnt.DAQ_STATUS.ARMING,
+                                     daqnt.DAQ_STATUS.ARMED,
+                                     daqnt.DAQ_STATUS.RUNNING]
+                               for s in states):
+                        break
+                    time.sleep(self.sleep_time['short'])
+                else:
+                    self.logger.error(
+                        f"Did not resolve host status in {self.sleep_time['max_wait']} s. "
+                        f"Going for the nuclear option. There be dragons here")
+                    authorization_level = HypervisorAuthorization.Nuclear
+                    tl.escalate(authorization_level)
+                phase['condition_met'] = authorization_level != HypervisorAuthorization.Nuclear
 
         if authorization_level == HypervisorAuthorization.Nuclear:
             self.logger.critical("Doing a Nuclear reset, this might be nasty")
             responding, timeout, states = [], all_readout, []
 
-        if hasattr(self, 'daq_controller'):
-            self.daq_controller.control_detector(
-                command='stop', detector='tpc', force=True)
-        else:
-            self.make_low_level_control_change(detector=self.detector, field='active', value='false')
-            self.make_low_level_control_change(detector=self.detector, field='softstop', value='false')
+        with tl.phase('stop_detector'):
+            if hasattr(self, 'daq_controller'):
+                self.daq_controller.control_detector(
+                    command='stop', detector='tpc', force=True)
+            else:
+                self.make_low_level_control_change(detector=self.detector, field='active', value='false')
+                self.make_low_level_control_change(detector=self.detector, field='softstop', value='false')
 
         if self.slackbot is not None:
             self.slackbot.send_message(
@@ -616,33 +932,56 @@ class Hypervisor(object):
                 f'Level {str(authorization_level)}',
                 add_tags='ALL')
         self.logger.info('%i responding, %i timeout' % (len(responding), len(timeout)))
+        if suspicion := self.get_host_suspicion():
+            self.logger.info('Suspicion: ' + ', '.join(f'{h} {phi:.1f}' for h, phi in suspicion.items()))
         # all processes are either idle or timing out.
         # Make sure to first (force) quit redax instances prior to VMEs.
-        if len(responding) > 0:
-            self.stop_redax(responding)
-        if len(timeout) > 0:
-            self.kill_redax(timeout)
-        time.sleep(self.sleep_time['long'])  # Make sure redax has shut down
-
-        # Double check all readout is in timeout before turning off VMEs:
-        _, timeout, _ = self.get_current_readout_state(all_readout)
-        if not set(timeout) == set(all_readout):
-            self.logger.fatal(f'Not all readout is in timeout, turning off VMEs might be bad')
-            self.logger.info(f'Timeout: {timeout}\nReadout: {all_readout}')
-
-        for c in self.vme_crates.keys():
-            self.vme_control(c, 'off')
-
-        time.sleep(self.sleep_time['long'])  # redax takes time to stop
-
-        for c in self.vme_crates.keys():
-            self.vme_control(c, 'on')
-        time.sleep(self.sleep_time['long'])  # the boards take time to boot
-        self.start_redax(all_readout)
-        time.sleep(self.sleep_time['long'])  # give redax time to start
-        for h in self.hosts:
-            if 'controller' in h:
-                self.fix_orphaned_sin(h)
+        with tl.phase('stop_redax') as phase:
+            if len(responding) > 0:
+                tl.host_action(responding, 'stop', self.stop_redax(responding[:]))
+            if len(timeout) > 0:
+                tl.host_action(timeout, 'kill', self.kill_redax(timeout))
+            # Make sure redax has shut down
+            phase['condition_met'] = self.wait_for(lambda: self.readout_is_gone(all_readout),
+                                                   self.sleep_time['long'], 'all readout gone')
+            if not phase['condition_met']:
+                # Double check all readout is in timeout before turning off VMEs:
+                _, timeout, _ = self.get_current_readout_state(all_readout,
+                                                               max_age=self.sleep_time['gone'])
+                self.logger.fatal(f'Not all readout is in timeout, turning off VMEs might be bad')
+                self.logger.info(f'Timeout: {timeout}\nReadout: {all_readout}')
+
+        with tl.phase('vme_off') as phase:
+            t_off = time.time()
+            for c in self.vme_crates.keys():
+                tl.crate_action(c, 'off', self.vme_control(c, 'off'))
+            phase['condition_met'] = self.wait_for(lambda: self.crates_are('off'),
+                                                   self.sleep_time['long'], 'all crates off')
+            # reporting off isn't the same as being drained, keep the power off a while
+            time.sleep(max(0, self.sleep_time['off'] - (time.time() - t_off)))
+
+        with tl.phase('vme_on') as phase:
+            for c in self.vme_crates.keys():
+                tl.crate_action(c, 'on', self.vme_control(c, 'on'))
+            # the boards take time to boot, give them a moment once the crates have power
+            t_on = time.time()
+            phase['condition_met'] = self.wait_for(lambda: self.crates_are('on'),
+                                                   self.sleep_time['long'], 'all crates on')
+            if phase['condition_met']:
+                time.sleep(max(0, min(self.sleep_time['boot'],
+                                      self.sleep_time['long'] - (time.time() - t_on))))
+
+        with tl.phase('start_redax') as phase:
+            tl.host_action(all_readout, 'start', self.start_redax(all_readout))
+            # give redax time to start
+            phase['condition_met'] = self.wait_for(lambda: self.readout_is_idle(all_readout),
+                                                   self.sleep_time['long'],
+                                                   'all readout checking in IDLE')
+
+        with tl.phase('fix_orphaned_sin'):
+            for h in self.hosts:
+                if 'controller' in h:
+                    tl.host_action([h], 'fix_orphaned_sin', [self.fix_orphaned_sin(h)])
 
         if hasattr(self, 'daq_controller'):
             # Might look a little funny but as far as the dispatcher is
@@ -653,6 +992,30 @@ class Hypervisor(object):
 
         self.logger.info('Hopefully that fixed it')
 
+    def finish_timeline(self) -> None:
+        """
+        Closes the current RecoveryTimeline with the final state of every
+            host and stores it in the recovery_timeline collection
+        """
+        if (tl := self.timeline) is None:
+            return
+        self.timeline = None
+        try:
+            responding, _, states = self.get_current_readout_state(self.hosts)
+            final = dict(zip(responding, states))
+            for host in self.hosts:
+                tl.host_outcome(host, daqnt.DAQ_STATUS(final[host]).name
+                                if host in final else daqnt.DAQ_STATUS.TIMEOUT.name)
+        except Exception as e:
+            self.logger.debug(f'Couldn\'t get the final readout state: {type(e)}, {e}')
+        doc = tl.finish()
+        self.logger.info(f'Recovery took {doc["duration"]:.1f} s: ' +
+                         ', '.join(f'{p["name"]} {p["duration"]:.1f} s' for p in doc['phases']))
+        try:
+            self.db['recovery_timeline'].insert_one(doc)
+        except Exception as e:
+            self.logger.error(f'Couldn\'t store the recovery timeline: {type(e)}, {e}')
+
     def ensure_readout_is_up(self, preset_authorization_level=None):
         """
         The beating heart of the hypervisor as a stand-alone.
@@ -663,8 +1026,10 @@ class Hypervisor(object):
              - Nuclear -> everything shy of rebooting LNGS
 
         This function infinitely loops with 'poll' timeout sleeps
-            in between.
+            in between. Commands in the hypervisor collection are handled
+            as they arrive by a separate thread (watch_commands).
         """
+        self.start_command_watcher()
         while not self.event.is_set():
             now = date_now()
             self.logger.info('Check at %s' % now.isoformat(sep=' '))
@@ -699,3 +1064,116 @@ class HypervisorAuthorization(IntEnum):
     # Nuclear: everything shy of rebooting LNGS
     Nuclear = 3
 
+
+
+class HealthSnapshot(ty.NamedTuple):
+    """
+    The state of one detector as seen by the hypervisor at one moment,
+        see Hypervisor.get_health_snapshot. Fields that weren't queried are None.
+    """
+    # when the snapshot was taken
+    time: datetime.datetime
+    # start of the window for was_running
+    since: datetime.datetime
+    # {host: {'status': int, 'time': datetime}} from the newest status doc of each host
+    hosts: ty.Dict[str, dict]
+    # was there any RUNNING aggregate status since {since}
+    was_running: ty.Optional[bool]
+    # is the detector set to active
+    should_be_running: ty.Optional[bool]
+    # when the last start command was ack'd, None if never
+    last_start_ack: ty.Optional[datetime.datetime]
+
+    def readout_state(self, hosts: list, max_age: float = 10) -> ty.Tuple[list, list, list]:
+        """
+        :param hosts: which hosts to report on
+        :param max_age: how old (s) the newest status may be before the host counts as timing out
+        :returns: (responding hosts, timing out hosts, states of the responding hosts)
+        """
+        responding, timeout, states = [], [], []
+        for host in hosts:
+            doc = self.hosts.get(host)
+            if doc is None or self.time - doc['time'] > datetime.timedelta(seconds=max_age):
+                timeout.append(host)
+            else:
+                responding.append(host)
+                states.append(doc['status'])
+        return responding, timeout, states
+
+    def time_since_start(self) -> ty.Optional[datetime.timedelta]:
+        return None if self.last_start_ack is None else self.time - self.last_start_ack
+
+    def timed_out_long(self, max_timeout: float) -> bool:
+        """
+        Has it been more than max_timeout seconds since a run started? If no
+            start was ever acked there's nothing to time out from, so that's
+            False: the hypervisor stays at TimeoutResolve rather than
+            escalating to a hard reset on missing data.
+        """
+        dt = self.time_since_start()
+        return dt is not None and dt.total_seconds() > max_timeout
+
+
+class RecoveryTimeline(object):
+    """
+    What happened during one reset, phase by phase, so we can tell afterwards
+        where the time went and what was done to which host and crate
+    """
+    def __init__(self, detector: str, kind: str, authorization_level: HypervisorAuthorization):
+        """
+        :param detector: the detector being reset
+        :param kind: what triggered this, eg 'hard_reset' or 'tactical_nuclear_option'
+        :param authorization_level: the level the hypervisor started with
+        """
+        self._t_start = time.time()
+        self.doc = {
+            'detector': detector,
+            'kind': kind,
+            'authorization': authorization_level.name,
+            'escalated_to': None,
+            'start': date_now(),
+            'end': None,
+            'duration': None,
+            'phases': [],
+            'hosts': {},
+            'crates': [],
+        }
+
+    @contextlib.contextmanager
+    def phase(self, name: str):
+        """
+        Times the enclosed block as one phase. The yielded dict is stored with the
+            phase, put a 'condition_met' in it if the phase waited on something.
+        """
+        entry = {'name': name, 'start': date_now()}
+        t_start = time.time()
+        try:
+            yield entry
+        finally:
+            entry['end'] = date_now()
+            entry['duration'] = time.time() - t_start
+            self.doc['phases'].append(entry)
+
+    def escalate(self, level: HypervisorAuthorization) -> None:
+        self.doc['escalated_to'] = level.name
+
+    def host_action(self, hosts: list, action: str, retcodes: list) -> None:
+        """Record that we did {action} to these hosts and what came back"""
+        for host, ret in zip(hosts, retcodes):
+            self.doc['hosts'].setdefault(host, {'actions': [], 'outcome': None})
+            self.doc['hosts'][host]['actions'].append(
+                {'action': action, 'ret': ret, 'time': date_now()})
+
+    def host_outcome(self, host: str, outcome: str) -> None:
+        self.doc['hosts'].setdefault(host, {'actions': [], 'outcome': None})
+        self.doc['hosts'][host]['outcome'] = outcome
+
+    def crate_action(self, crate: ty.Union[str, int], action: str, ret: ty.Union[int, str]) -> None:
+        self.doc['crates'].append(
+            {'crate': str(crate), 'action': action, 'ret': ret, 'time': date_now()})
+
+    def finish(self) -> dict:
+        """Close the timeline, returns the document"""
+        self.doc['end'] = date_now()
+        self.doc['duration'] = time.time() - self._t_start
+        return self.doc
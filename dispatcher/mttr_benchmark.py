@@ -0,0 +1,258 @@
+#!/daq_common/miniconda3/bin/python3
+"""
+Offline mean-time-to-recovery benchmark for the hypervisor
+
+Drives Hypervisor.hard_reset against simulated readout processes and VME
+crates (no database, ssh or crates needed) and reports how long it takes
+until everything checks in as IDLE again. All latencies and hypervisor
+timeouts are divided by --speedup so a trial takes seconds, the reported
+times are scaled back to real seconds.
+
+Compare against the old fixed sleeps with --fixed-sleeps.
+"""
+import argparse
+import itertools
+import logging
+import random
+import statistics
+import threading
+import time
+
+import daqnt
+from hypervisor import Hypervisor, HypervisorAuthorization, date_now
+
+
+class _InsertResult(object):
+    def __init__(self, inserted_id):
+        self.inserted_id = inserted_id
+
+
+class FakeCollection(object):
+    """Just enough of a pymongo collection for the hypervisor's reset path"""
+    _ids = itertools.count()
+
+    def __init__(self, plant=None):
+        self.docs = []
+        self.plant = plant
+
+    def insert_one(self, doc):
+        doc['_id'] = next(self._ids)
+        self.docs.append(doc)
+        if self.plant is not None:
+            self.plant.command(doc)
+        return _InsertResult(doc['_id'])
+
+    def find_one(self, query, **kwargs):
+        for doc in reversed(self.docs):
+            if all(doc.get(k) == v for k, v in query.items()):
+                return doc
+        return None
+
+
+class FakeDB(object):
+    def __init__(self, plant):
+        self.collections = {'control': FakeCollection(plant)}
+
+    def __getitem__(self, name):
+        return self.collections.setdefault(name, FakeCollection())
+
+    def __getattr__(self, name):
+        if name == 'collections':
+            raise AttributeError(name)
+        return self[name]
+
+
+class SimulatedPlant(object):
+    """
+    Readout processes and crates with randomized reaction times. Every
+        latency is a (min, max) range in real seconds.
+    """
+    latencies = {
+        'quit': (0.5, 2),  # redax acting on a 'quit'
+        'kill': (0.1, 0.5),  # screen going away
+        'crate_off': (0.5, 1.5),
+        'crate_on': (1, 3),
+        'boot': (3, 8),  # redax started until it reports IDLE
+        'ack': (0.1, 1),  # crate controller acking a command
+    }
+
+    def __init__(self, hosts, crates, crashed, rng, speedup):
+        self.rng = rng
+        self.speedup = speedup
+        self.lock = threading.Lock()
+        # host: (alive, status, time at which it becomes alive/dead)
+        self.hosts = {h: {'alive': h not in crashed, 'status': daqnt.DAQ_STATUS.IDLE,
+                          'change_at': None, 'becomes': None}
+                      for h in hosts}
+        self.crates = {c: {'on': True, 'change_at': None, 'becomes': None} for c in crates}
+
+    def _later(self, what):
+        return time.time() + self.rng.uniform(*self.latencies[what]) / self.speedup
+
+    def _settle(self):
+        now = time.time()
+        for thing in list(self.hosts.values()) + list(self.crates.values()):
+            if thing['change_at'] is not None and now >= thing['change_at']:
+                key = 'alive' if 'alive' in thing else 'on'
+                thing[key] = thing['becomes']
+                thing['change_at'] = None
+
+    def host_state(self, host):
+        """Returns the status a host would report, or None if it doesn't report"""
+        with self.lock:
+            self._settle()
+            h = self.hosts[host]
+            return h['status'] if h['alive'] else None
+
+    def crate_on(self, crate):
+        with self.lock:
+            self._settle()
+            return self.crates[str(crate)]['on']
+
+    def set_host(self, host, alive, what):
+        with self.lock:
+            self.hosts[host].update(change_at=self._later(what), becomes=alive,
+                                    status=daqnt.DAQ_STATUS.IDLE)
+
+    def set_crate(self, crate, on):
+        with self.lock:
+            self.crates[str(crate)].update(
+                change_at=self._later('crate_on' if on else 'crate_off'), becomes=on)
+
+    def command(self, doc):
+        """Something was written to the control collection"""
+        if doc['command'] == 'quit':
+            for h in doc['host']:
+                self.set_host(h, False, 'quit')
+        elif doc['command'] == 'arm':
+            ack_at = self._later('ack')
+            threading.Timer(ack_at - time.time(), self._ack, args=(doc,)).start()
+
+    def _ack(self, doc):
+        for h in doc['host']:
+            if self.host_state(h) is not None:
+                doc['acknowledged'][h] = date_now()
+
+
+class SimulatedHypervisor(Hypervisor):
+    """A Hypervisor whose hosts and crates are a SimulatedPlant"""
+
+    def __init__(self, plant, fixed_sleeps=False, speedup=1, **kwargs):
+        super().__init__(**kwargs)
+        self.plant = plant
+        self.fixed_sleeps = fixed_sleeps
+        self.speedup = speedup
+
+    # the waits the old code polled: (first sleep in s, then every this
+    # sleep_time) until the ceiling. Everything else was one sleep of the ceiling
+    old_polls = {'S-IN ack\'d': (0.2, 'short')}
+
+    def wait_for(self, condition, ceiling, what):
+        if not self.fixed_sleeps:
+            return super().wait_for(condition, ceiling, what)
+        # what we used to do
+        if (poll := self.old_polls.get(what)) is None:
+            time.sleep(ceiling)
+            return condition()
+        first, step = poll
+        t_start = time.time()
+        # a literal in the old code, so not scaled with the sleep_times
+        time.sleep(first / self.speedup)
+        while not condition():
+            remaining = ceiling - (time.time() - t_start)
+            if remaining <= 0:
+                return False
+            time.sleep(min(self.sleep_time[step], remaining))
+        return True
+
+    def get_current_readout_state(self, hosts, max_age=10):
+        responding, timeout, states = [], [], []
+        for host in hosts:
+            if (state := self.plant.host_state(host)) is None:
+                timeout.append(host)
+            else:
+                responding.append(host)
+                states.append(state)
+        return responding, timeout, states
+
+    def vme_control(self, crate, state):
+        self.plant.set_crate(crate, state == 'on')
+        return 0
+
+    def vme_is_on(self, crate):
+        return self.plant.crate_on(crate)
+
+    def start_redax(self, hosts, cycle_boards=True):
+        for h in hosts:
+            self.plant.set_host(h, True, 'boot')
+        return [0] * len(hosts)
+
+    def kill_redax(self, hosts):
+        for h in hosts:
+            self.plant.set_host(h, False, 'kill')
+        return [0] * len(hosts)
+
+    def make_low_level_control_change(self, detector, field, value):
+        return 0
+
+
+def run_trial(args, rng, fixed_sleeps):
+    hosts = [f'sim{i}_reader_0' for i in range(args.readers)]
+    controller = 'sim0_controller_0'
+    crates = {str(i): f'192.0.2.{i}' for i in range(args.crates)}
+    crashed = rng.sample(hosts, min(args.crashed, len(hosts)))
+    plant = SimulatedPlant(hosts + [controller], crates, crashed, rng, args.speedup)
+    logger = logging.getLogger('mttr_benchmark')
+    hv = SimulatedHypervisor(plant, fixed_sleeps, args.speedup,
+                             db=FakeDB(plant), logger=logger,
+                             config={'test': {'controller': [controller], 'readers': hosts}},
+                             vme_crates=crates, detector='test', testing=True)
+    for k in ['long', 'short', 'check', 'gone', 'off', 'boot']:
+        hv.sleep_time[k] /= args.speedup
+    hv.hard_reset(HypervisorAuthorization[args.level])
+    doc = hv.db['recovery_timeline'].docs[-1]
+    # scale back to real seconds
+    return (doc['duration'] * args.speedup,
+            {p['name']: p['duration'] * args.speedup for p in doc['phases']},
+            all(h['outcome'] == daqnt.DAQ_STATUS.IDLE.name for h in doc['hosts'].values()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Hypervisor mean time to recovery benchmark')
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--crates', type=int, default=5)
+    parser.add_argument('--crashed', type=int, default=1,
+                        help='How many readers are dead when the reset starts')
+    parser.add_argument('--level', default='HardReset',
+                        choices=['TimeoutResolve', 'HardReset', 'Nuclear'])
+    parser.add_argument('--speedup', type=float, default=10,
+                        help='Divide all latencies and timeouts by this')
+    parser.add_argument('--fixed-sleeps', action='store_true',
+                        help='Wait like the old hard_reset: fixed sleeps, and the S-IN ack '
+                             'polled every short')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    rng = random.Random(args.seed)
+    durations, phases, recovered = [], {}, 0
+    for i in range(args.trials):
+        duration, phase_times, ok = run_trial(args, rng, args.fixed_sleeps)
+        durations.append(duration)
+        recovered += ok
+        for name, t in phase_times.items():
+            phases.setdefault(name, []).append(t)
+        print(f'Trial {i}: {duration:.1f} s{"" if ok else " (not recovered)"}')
+
+    print(f'\n{"Fixed sleeps" if args.fixed_sleeps else "Condition waits"}, '
+          f'{args.readers} readers, {args.crates} crates, {args.crashed} crashed, {args.level}')
+    print(f'MTTR: {statistics.mean(durations):.1f} s (median {statistics.median(durations):.1f}, '
+          f'min {min(durations):.1f}, max {max(durations):.1f}), '
+          f'recovered {recovered}/{args.trials}')
+    for name, times in phases.items():
+        print(f'  {name:28} {statistics.mean(times):6.1f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# daqnt lives next to this directory, so the tests also run from the repo root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
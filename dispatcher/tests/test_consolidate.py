@@ -0,0 +1,57 @@
+import os
+import pytest
+import numpy as np
+from daqnt.chunks import list_chunk_files, read_chunk_file, read_run
+from daqnt.consolidate import Consolidator, merge_sorted
+from daqnt.synthetic import generate_fragments, write_chunk
+
+FULL = int(5.5e9)
+
+
+def _run(run_dir, chunks=3, writers=('reader0_1', 'reader0_2', 'reader1_1')):
+    rng = np.random.default_rng(0)
+    for chunk in range(chunks):
+        for i, w in enumerate(writers):
+            frags = generate_fragments(chunk * FULL, (chunk + 1) * FULL, 0.5,
+                                       np.arange(i * 10, i * 10 + 10), rng=rng)
+            write_chunk(run_dir, chunk, w, frags)
+    os.makedirs(os.path.join(run_dir, 'THE_END'))
+    for w in writers:
+        with open(os.path.join(run_dir, 'THE_END', w), 'w') as f:
+            f.write('...my only friend\n')
+
+
+def test_merge_sorted():
+    rng = np.random.default_rng(1)
+    parts = [np.sort(rng.integers(0, 1000, size=n)).astype([('time', '<i8')])
+             for n in (0, 5, 17, 3)]
+    merged = merge_sorted(parts)
+    assert np.all(np.diff(merged['time']) >= 0)
+    assert len(merged) == 25
+
+
+def test_output_reads_back(tmp_path):
+    run_dir = str(tmp_path / '000001')
+    out = str(tmp_path / '000001_merged')
+    _run(run_dir)
+    Consolidator(run_dir, out, workers=2).run()
+    assert os.listdir(os.path.join(out, 'THE_END')) == ['merged_0']
+    assert {f.host for f in list_chunk_files(out, kinds=('chunk', 'pre', 'post'))} == {'merged_0'}
+    before, after = read_run(run_dir), read_run(out)
+    assert len(after) == len(before) > 0
+    assert np.array_equal(before, after)
+    for f in list_chunk_files(out):
+        assert np.all(np.diff(read_chunk_file(f.path)['time']) >= 0)
+    window = read_run(out, start=FULL - int(0.2e9), end=FULL + int(1e9))
+    assert np.array_equal(window, read_run(run_dir, start=FULL - int(0.2e9), end=FULL + int(1e9)))
+
+
+def test_follow_waits_for_every_writer(tmp_path):
+    run_dir = str(tmp_path / '000001')
+    _run(run_dir, writers=('reader0_1', 'reader0_2'))
+    # a third thread that hasn't written anything yet, so nothing is complete
+    # and the run didn't end, even though THE_END is there
+    cons = Consolidator(run_dir, str(tmp_path / 'out'), workers=1, writers=3)
+    assert cons.complete_chunks() == ([], False)
+    with pytest.raises(ValueError):
+        Consolidator(run_dir, str(tmp_path / 'out'), workers=1).run(follow=True)
@@ -0,0 +1,77 @@
+import datetime
+import os
+from daqnt.manifest import build_manifest, verify_run, ManifestBuilder
+
+
+def _touch(run_dir, name, writer, data=b'x'):
+    os.makedirs(os.path.join(run_dir, name), exist_ok=True)
+    with open(os.path.join(run_dir, name, writer), 'wb') as f:
+        f.write(data)
+
+
+def _write(run_dir, writer, last):
+    """What StraxFormatter writes for a thread whose last chunk is last"""
+    for c in range(last):
+        for name in (f'{c:06d}', f'{c:06d}_post', f'{c + 1:06d}_pre'):
+            _touch(run_dir, name, writer)
+    _touch(run_dir, f'{last:06d}', writer)
+    _touch(run_dir, 'THE_END', writer, b'...my only friend\n')
+
+
+def test_writers_ending_at_different_chunks(tmp_path):
+    run_dir = str(tmp_path)
+    _write(run_dir, 'reader0_1', 5)
+    _write(run_dir, 'reader0_2', 2)
+    _write(run_dir, 'reader1_1', 0)
+    # a thread that never got data only writes THE_END
+    _touch(run_dir, 'THE_END', 'reader1_2', b'...my only friend\n')
+    manifest = build_manifest(run_dir)
+    assert manifest['writers'] == ['reader0_1', 'reader0_2', 'reader1_1', 'reader1_2']
+    assert manifest['missing'] == []
+    assert verify_run(run_dir)['ok']
+
+
+def test_missing_files(tmp_path):
+    run_dir = str(tmp_path)
+    _write(run_dir, 'reader0_1', 3)
+    _write(run_dir, 'reader0_2', 3)
+    os.unlink(os.path.join(run_dir, '000001_post', 'reader0_2'))
+    os.unlink(os.path.join(run_dir, 'THE_END', 'reader0_1'))
+    manifest = build_manifest(run_dir)
+    assert manifest['missing'] == [os.path.join('000001_post', 'reader0_2'),
+                                   os.path.join('THE_END', 'reader0_1')]
+    with open(os.path.join(run_dir, '000002', 'reader0_1'), 'wb') as f:
+        f.write(b'y')
+    res = verify_run(run_dir)
+    assert res['wrong_hash'] == [os.path.join('000002', 'reader0_1')]
+    assert not res['ok']
+
+
+class _Runs:
+    """Just enough of a runs collection for ManifestBuilder.pending"""
+    def __init__(self, docs):
+        self.docs = docs
+
+    def find(self, query, projection):
+        return self
+
+    def sort(self, key, direction):
+        return sorted(self.docs, key=lambda d: d[key])
+
+
+def test_pending_waits_for_every_writer(tmp_path):
+    now = datetime.datetime.utcnow()
+    daq_config = {'boards': [{'host': 'reader0', 'type': 'V1724'},
+                             {'host': 'reader1', 'type': 'V1724'},
+                             {'host': 'reader1', 'type': 'V2718'}],
+                  'processing_threads': {'reader0': 2, 'reader1': 1}}
+    runs = _Runs([{'number': 1, 'end': now, 'daq_config': daq_config},
+                  {'number': 2, 'end': now - datetime.timedelta(hours=1), 'daq_config': daq_config},
+                  {'number': 3, 'end': now, 'daq_config': daq_config}])
+    for number in (1, 2, 3):
+        _write(os.path.join(tmp_path, f'{number:06d}'), 'reader0_1', 2)
+        _write(os.path.join(tmp_path, f'{number:06d}'), 'reader1_1', 1)
+    # run 3 has every writer, runs 1 and 2 are still waiting for reader0_2,
+    # but run 2 ended longer ago than the grace period
+    _write(os.path.join(tmp_path, '000003'), 'reader0_2', 2)
+    assert ManifestBuilder(str(tmp_path), runs, grace=600).pending() == [2, 3]
@@ -0,0 +1,33 @@
+import numpy as np
+from daqnt.chunks import fragment_dtype
+from daqnt.quicklook import baselines, find_hits
+
+
+def _fragments(baseline_field, n=50, baseline=16000, seed=0):
+    """n single-fragment pulses on channels 0 and 1, each with one dip of 100 ADC"""
+    rng = np.random.default_rng(seed)
+    frags = np.zeros(n, dtype=fragment_dtype(220))
+    frags['time'] = np.arange(n) * 1000
+    frags['length'] = 110
+    frags['pulse_length'] = 110
+    frags['dt'] = 10
+    frags['channel'] = np.arange(n) % 2
+    frags['baseline'] = baseline_field
+    frags['data'] = np.round(rng.normal(baseline, 2, size=(n, 110)))
+    frags['data'][:, 50:55] -= 100
+    return frags
+
+
+def test_hits_with_baseline_field():
+    ch, amplitude = find_hits(_fragments(16000), np.full(2, 15))
+    assert len(ch) == 50
+    assert np.all(np.abs(amplitude - 100) < 10)
+
+
+def test_hits_without_baseline_field():
+    frags = _fragments(0)
+    assert np.all(np.abs(baselines(frags) - 16000) <= 2)
+    ch, amplitude = find_hits(frags, np.full(2, 15))
+    assert len(ch) == 50
+    assert np.bincount(ch).tolist() == [25, 25]
+    assert np.all(np.abs(amplitude - 100) < 10)
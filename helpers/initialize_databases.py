@@ -1,6 +1,12 @@
 from pymongo import MongoClient
+import argparse
 import os
 
+parser = argparse.ArgumentParser(description='Create the DAQ collections and indexes')
+parser.add_argument('--timeseries', action='store_true',
+                    help='Make status and system_monitor time-series collections (MongoDB >= 5)')
+args = parser.parse_args()
+
 username=os.environ['MONGO_USER']
 password=os.environ['MONGO_PASSWORD']
 host='127.0.0.1'
@@ -16,6 +22,10 @@ db = client[database]
 db.create_collection('aggregate_status')
 db.aggregate_status.create_index([('detector', 1), ('_id', -1)])
 db.aggregate_status.create_index('number')
+# and its rollups, see daqnt/rollup.py
+for resolution in ['1min', '1h', '1d']:
+    db.create_collection(f'aggregate_status_{resolution}')
+    db[f'aggregate_status_{resolution}'].create_index([('detector', 1), ('start', 1)], unique=True)
 
 # board and cable maps
 db.create_collection('board_map', validator={'$jsonSchema': {
@@ -91,6 +101,14 @@ db.create_collection('cable_map', validator={'$jsonSchema': {
 db.cable_map.create_index('pmt', unique=True)
 db.cable_map.create_index([('adc', 1), ('adc_channel', 1)], unique=True)
 
+# chunk validation stats, see daqnt/chunk_validator.py
+db.create_collection('chunk_validation')
+db.chunk_validation.create_index([('number', 1), ('host', 1)], unique=True)
+
+# quick look hit and baseline stats, see daqnt/quicklook.py
+db.create_collection('quicklook')
+db.quicklook.create_index([('number', 1), ('host', 1)], unique=True)
+
 db.create_collection('control', validator={'$jsonSchema': {
     'bsonType': 'object',
     'required': ['command', 'user', 'host', 'createdAt', 'acknowledged'],
@@ -138,13 +156,25 @@ db.create_collection('options', validator={'$jsonSchema': {
     }}})
 db.options.create_index('name')
 
-# status
-db.create_collection('status')
-db.status.create_index('time', expireAfterSeconds=3*24*3600)
-db.status.create_index([('host', 1), ('_id', -1)])
+# hypervisor commands
+db.create_collection('hypervisor')
+db.hypervisor.create_index([('ack', 1), ('_id', 1)])
+
+# hypervisor recovery timelines
+db.create_collection('recovery_timeline')
+db.recovery_timeline.create_index([('detector', 1), ('_id', -1)])
 
-# system monitor
-db.create_collection('system_monitor')
-db.system_monitor.create_index('time', expireAfterSeconds=3*24*3600)
-db.system_monitor.create_index([('host', 1), ('_id', -1)])
+# status and system monitor. The newest docs of a host are looked up by
+# (host, time) in a time-series collection and by (host, _id) in a plain one,
+# see migrate_to_timeseries.py to move existing collections over
+for name in ['status', 'system_monitor']:
+    if args.timeseries:
+        db.create_collection(name, timeseries={'timeField': 'time', 'metaField': 'host',
+                                               'granularity': 'seconds'},
+                             expireAfterSeconds=3*24*3600)
+        db[name].create_index([('host', 1), ('time', -1)])
+    else:
+        db.create_collection(name)
+        db[name].create_index('time', expireAfterSeconds=3*24*3600)
+        db[name].create_index([('host', 1), ('_id', -1)])
 
@@ -0,0 +1,170 @@
+#!/daq_common/miniconda3/bin/python3
+"""
+Moves status and system_monitor to time-series collections (MongoDB >= 5)
+
+For each collection the existing one is renamed to <name>_plain, a time-series
+collection (metaField=host, timeField=time) takes its place straight away so
+redax and the monitors keep writing to <name>, and then whatever hasn't expired
+yet is copied over in batches. The old collection stays around (for --benchmark,
+or rollback) unless you --drop-old.
+
+With --benchmark, times the dispatcher's and hypervisor's queries against both
+layouts: the old ones (by _id) against <name>_plain, the new ones (by time)
+against <name>, and compares storage. Plain collections don't need anything,
+the dispatcher and hypervisor keep using their (host, _id) index; --index-only
+adds a (host, time) index to them for queries by time.
+"""
+import argparse
+import datetime
+import os
+import statistics
+import time
+from pymongo import MongoClient
+from pymongo.errors import BulkWriteError, CollectionInvalid
+
+
+def IsTimeseries(db, name):
+    for info in db.list_collections(filter={'name': name}):
+        return info.get('type') == 'timeseries'
+    return False
+
+
+def CreateTimeseries(db, name, expire):
+    db.create_collection(name, timeseries={'timeField': 'time', 'metaField': 'host',
+                                           'granularity': 'seconds'},
+                         expireAfterSeconds=expire)
+    db[name].create_index([('host', 1), ('time', -1)])
+
+
+def Migrate(db, name, batch, expire, drop_old):
+    if IsTimeseries(db, name):
+        print(f'{name} already is a time-series collection')
+        return
+    old = f'{name}_plain'
+    if old in db.list_collection_names():
+        print(f'{old} already exists, not overwriting it')
+        return
+    print(f'Renaming {name} to {old}')
+    db[name].rename(old)
+    try:
+        CreateTimeseries(db, name, expire)
+    except CollectionInvalid:
+        # someone inserted in between and got a new plain collection. Move that
+        # over too and try again
+        print(f'{name} got recreated in the meantime, copying that too')
+        db[name].rename(f'{name}_plain_late')
+        CreateTimeseries(db, name, expire)
+        Copy(db[f'{name}_plain_late'], db[name], batch, expire)
+        db[f'{name}_plain_late'].drop()
+    Copy(db[old], db[name], batch, expire)
+    if drop_old:
+        print(f'Dropping {old}')
+        db[old].drop()
+
+
+def Copy(source, dest, batch, expire):
+    """Copies what hasn't expired yet, oldest first"""
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=expire)
+    query = {'time': {'$gt': since}, 'host': {'$exists': True}}
+    total = source.count_documents(query)
+    print(f'Copying {total} documents from {source.name} to {dest.name}')
+    done = 0
+    t_start = time.time()
+    docs = []
+    for doc in source.find(query).sort('_id', 1).batch_size(batch):
+        docs.append(doc)
+        if len(docs) >= batch:
+            done += Insert(dest, docs)
+            docs = []
+            print(f'  {done}/{total}, {done / (time.time() - t_start):.0f} docs/s', end='\r')
+    if len(docs) > 0:
+        done += Insert(dest, docs)
+    print(f'  {done}/{total} in {time.time() - t_start:.1f} s')
+
+
+def Insert(coll, docs):
+    try:
+        return len(coll.insert_many(docs, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        # rerunning after an interruption gives duplicates, that's fine
+        return e.details.get('nInserted', 0)
+
+
+def Time(f, repeat):
+    """Median time (ms) of f()"""
+    times = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        f()
+        times.append((time.perf_counter() - t_start) * 1000)
+    return statistics.median(times)
+
+
+def Benchmark(db, name, repeat):
+    old, new = db[f'{name}_plain'], db[name]
+    hosts = new.distinct('host')
+    print(f'\n{name}: {len(hosts)} hosts, median of {repeat} (ms)')
+    window = datetime.datetime.utcnow() - datetime.timedelta(hours=1)
+    queries = {
+        'latest per host (hypervisor)': (
+            lambda: list(old.aggregate([{'$match': {'host': {'$in': hosts}}},
+                                        {'$sort': {'host': 1, '_id': -1}},
+                                        {'$group': {'_id': '$host', 'status': {'$first': '$status'},
+                                                    'time': {'$first': '$time'}}}])),
+            lambda: list(new.aggregate([{'$match': {'host': {'$in': hosts}}},
+                                        {'$sort': {'host': 1, 'time': -1}},
+                                        {'$group': {'_id': '$host', 'status': {'$first': '$status'},
+                                                    'time': {'$first': '$time'}}}]))),
+        'newest of each host (dispatcher)': (
+            lambda: [old.find_one({'host': h}, sort=[('_id', -1)]) for h in hosts],
+            lambda: [new.find_one({'host': h}, sort=[('time', -1)]) for h in hosts]),
+        'last hour of one host': (
+            lambda: list(old.find({'host': hosts[0], 'time': {'$gt': window}})),
+            lambda: list(new.find({'host': hosts[0], 'time': {'$gt': window}}))),
+    }
+    print(f'{"":36}{"plain":>10}{"timeseries":>12}')
+    for label, (f_old, f_new) in queries.items():
+        print(f'{label:36}{Time(f_old, repeat):10.1f}{Time(f_new, repeat):12.1f}')
+    for coll in [old, new]:
+        try:
+            stats = db.command('collStats', coll.name)
+        except Exception as e:
+            print(f'No stats for {coll.name}: {e}')
+            continue
+        print(f'{coll.name:36} {stats.get("count", 0)} docs, storage '
+              f'{stats.get("storageSize", 0) / 1e6:.1f} MB, indexes '
+              f'{stats.get("totalIndexSize", 0) / 1e6:.1f} MB')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Move status and system_monitor to '
+                                     'time-series collections')
+    parser.add_argument('--collections', nargs='+', default=['status', 'system_monitor'])
+    parser.add_argument('--db', default='daq')
+    parser.add_argument('--batch', type=int, default=10000, help='Documents per insert')
+    parser.add_argument('--expire', type=int, default=3*24*3600,
+                        help='TTL of the new collections (s), older documents aren\'t copied')
+    parser.add_argument('--drop-old', action='store_true',
+                        help='Drop the old collections once copied')
+    parser.add_argument('--benchmark', action='store_true',
+                        help='Compare the old and new layout instead of migrating')
+    parser.add_argument('--repeat', type=int, default=20, help='Repetitions per query')
+    parser.add_argument('--index-only', action='store_true',
+                        help='Keep the plain collections, just add a (host, time) index '
+                        'for queries by time')
+    args = parser.parse_args()
+
+    client = MongoClient(f'mongodb://{os.environ["MONGO_USER"]}:{os.environ["MONGO_PASSWORD"]}'
+                         f'@127.0.0.1:27017/admin')
+    db = client[args.db]
+    for name in args.collections:
+        if args.benchmark:
+            Benchmark(db, name, args.repeat)
+        elif args.index_only:
+            db[name].create_index([('host', 1), ('time', -1)])
+        else:
+            Migrate(db, name, args.batch, args.expire, args.drop_old)
+
+
+if __name__ == '__main__':
+    main()
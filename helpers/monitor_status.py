@@ -1,21 +1,233 @@
-import pymongo
-from pymongo import MongoClient
+"""
+Live terminal dashboard of the DAQ
+
+Shows every host in MasterDAQConfig (status, age of its last check-in, rate,
+buffer, PLL unlocks, busiest channels), the aggregate state of each detector,
+and commands that haven't been acknowledged yet. The newest status of all hosts
+comes from one aggregation at startup, then from a change stream on status
+(polling with that aggregation if change streams aren't available, eg on a
+standalone server or a time-series collection). Only lines that changed get
+redrawn.
+    python monitor_status.py [--config ../dispatcher/config.ini] [--test]
+"""
+import argparse
+import configparser
+import curses
+import datetime
+import json
 import os
 import time
+from pymongo import MongoClient
+from pymongo.errors import PyMongoError
+
+STATUS = ['IDLE', 'ARMING', 'ARMED', 'RUNNING', 'ERROR', 'TIMEOUT', 'UNKNOWN']
+# curses color pair of each status
+COLORS = {'IDLE': 0, 'ARMING': 3, 'ARMED': 3, 'RUNNING': 2, 'ERROR': 1, 'TIMEOUT': 1, 'UNKNOWN': 4}
+
+
+def StatusName(status):
+    try:
+        return STATUS[status]
+    except (IndexError, TypeError):
+        return 'UNKNOWN'
+
+
+def StatusOrder(db):
+    """Newest status docs by time in a time-series collection, by _id in a plain one"""
+    for info in db.list_collections(filter={'name': 'status'}):
+        return 'time' if info.get('type') == 'timeseries' else '_id'
+    return '_id'
+
+
+class Dashboard(object):
+
+    def __init__(self, db, daq_config, top=5, timeout=10, command_window=600):
+        """
+        :param db: the daq database
+        :param daq_config: MasterDAQConfig, {detector: {'controller': [...], 'readers': [...]}}
+        :param top: how many channels to show per host
+        :param timeout: how old (s) a host's latest status can be before we flag it
+        :param command_window: how far back (s) to look for unacknowledged commands
+        """
+        self.db = db
+        self.daq_config = daq_config
+        self.top = top
+        self.timeout = timeout
+        self.command_window = command_window
+        self.hosts = [h for det in daq_config.values() for h in det['controller'] + det['readers']]
+        self.latest = {}
+        self.detectors = {}
+        self.commands = []
+        self.stream = None
+        self.source = 'polling'
+        self.order = StatusOrder(db)
+
+    def Connect(self):
+        """Initial state of all hosts, and a change stream for the rest if we can"""
+        self.PollHosts()
+        try:
+            self.stream = self.db['status'].watch(
+                [{'$match': {'operationType': 'insert', 'fullDocument.host': {'$in': self.hosts}}}],
+                max_await_time_ms=100)
+            self.source = 'change stream'
+        except PyMongoError:
+            self.stream = None
+            self.source = 'polling'
+
+    def PollHosts(self):
+        """The newest status of every host, in one go"""
+        for doc in self.db['status'].aggregate([
+                {'$match': {'host': {'$in': self.hosts}}},
+                {'$sort': {'host': 1, self.order: -1}},
+                {'$group': {'_id': '$host', 'doc': {'$first': '$$ROOT'}}}]):
+            self.latest[doc['_id']] = doc['doc']
+
+    def UpdateHosts(self):
+        if self.stream is None:
+            self.PollHosts()
+            return
+        try:
+            while (change := self.stream.try_next()) is not None:
+                doc = change['fullDocument']
+                self.latest[doc['host']] = doc
+        except PyMongoError:
+            # the stream died, we'll manage without
+            self.stream = None
+            self.source = 'polling'
+            self.PollHosts()
+
+    def UpdateDetectors(self):
+        self.detectors = {}
+        for doc in self.db['aggregate_status'].aggregate([
+                {'$match': {'detector': {'$in': list(self.daq_config.keys())}}},
+                {'$sort': {'detector': 1, '_id': -1}},
+                {'$group': {'_id': '$detector', 'doc': {'$first': '$$ROOT'}}}]):
+            self.detectors[doc['_id']] = doc['doc']
+
+    def UpdateCommands(self):
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=self.command_window)
+        self.commands = []
+        for doc in self.db['control'].find({'createdAt': {'$gt': since}}).sort('_id', -1):
+            waiting = [h for h, ack in doc.get('acknowledged', {}).items() if ack == 0]
+            if len(waiting) > 0:
+                self.commands.append(('control', doc['createdAt'], doc['command'],
+                                      doc.get('user', '?'), waiting))
+        for doc in self.db['hypervisor'].find({'ack': 0}).sort('_id', 1):
+            self.commands.append(('hypervisor', doc['_id'].generation_time.replace(tzinfo=None),
+                                  ', '.join(f'{c["command"]} {c["action"]} {c["target"]}'
+                                            for c in doc.get('commands', [])),
+                                  doc.get('user', '?'), []))
+
+    def Update(self):
+        self.UpdateHosts()
+        self.UpdateDetectors()
+        self.UpdateCommands()
+
+    def Lines(self):
+        """What to show, as a list of (text, color pair)"""
+        now = datetime.datetime.utcnow()
+        lines = [(f'DAQ status {now:%Y-%m-%d %H:%M:%S} UTC, from {self.source}. q to quit', 0),
+                 ('', 0),
+                 (f'{"DETECTOR":<16}{"STATUS":<10}{"MODE":<24}{"RUN":>8}'
+                  f'{"RATE MB/s":>11}{"BUFF MB":>10}{"PLL":>6}', 0)]
+        for det in self.daq_config:
+            if (doc := self.detectors.get(det)) is None:
+                lines.append((f'{det:<16}{"no data":<10}', COLORS['UNKNOWN']))
+                continue
+            status = StatusName(doc.get('status'))
+            lines.append((f'{det:<16}{status:<10}{str(doc.get("mode")):<24}{doc.get("number", -1):>8}'
+                          f'{doc.get("rate", 0):>11.2f}{doc.get("buff", 0):>10.1f}'
+                          f'{doc.get("pll_unlocks", 0):>6}', COLORS[status]))
+        lines += [('', 0),
+                  (f'{"HOST":<28}{"STATUS":<10}{"AGE":>6}{"RATE MB/s":>11}{"BUFF MB":>10}'
+                   f'{"PLL":>6}  {"RUN":>7}  TOP CHANNELS (ch:kB)', 0)]
+        for host in self.hosts:
+            if (doc := self.latest.get(host)) is None:
+                lines.append((f'{host:<28}{"no data":<10}', COLORS['UNKNOWN']))
+                continue
+            age = (now - doc['time']).total_seconds()
+            status = 'TIMEOUT' if age > self.timeout else StatusName(doc.get('status'))
+            channels = sorted(doc.get('channels', {}).items(), key=lambda kv: -kv[1])[:self.top]
+            top = ' '.join(f'{ch}:{kb}' for ch, kb in channels if kb > 0)
+            lines.append((f'{host:<28}{status:<10}{age:>6.0f}{doc.get("rate", 0):>11.2f}'
+                          f'{doc.get("buffer_size", 0):>10.1f}{doc.get("pll", 0):>6}  '
+                          f'{doc.get("number", -1):>7}  {top}', COLORS[status]))
+        lines += [('', 0), (f'PENDING COMMANDS ({len(self.commands)})', 0)]
+        for source, t, command, user, waiting in self.commands:
+            wait = f', waiting for {" ".join(waiting)}' if waiting else ''
+            lines.append((f'{t:%H:%M:%S} {source:<11}{command} ({user}){wait}', COLORS['ARMING']))
+        return lines
+
+
+def Draw(stdscr, dashboard, refresh):
+    curses.curs_set(0)
+    curses.use_default_colors()
+    for pair, color in [(1, curses.COLOR_RED), (2, curses.COLOR_GREEN),
+                        (3, curses.COLOR_YELLOW), (4, curses.COLOR_MAGENTA)]:
+        curses.init_pair(pair, color, -1)
+    stdscr.nodelay(True)
+    shown = []
+    while True:
+        t_start = time.time()
+        try:
+            dashboard.Update()
+        except PyMongoError as e:
+            dashboard.source = f'nowhere, DB issue: {type(e).__name__}'
+        height, width = stdscr.getmaxyx()
+        lines = dashboard.Lines()[:height - 1]
+        for i, (text, color) in enumerate(lines):
+            if i < len(shown) and shown[i] == (text, color):
+                continue
+            stdscr.move(i, 0)
+            stdscr.clrtoeol()
+            stdscr.addnstr(i, 0, text, width - 1, curses.color_pair(color))
+        for i in range(len(lines), len(shown)):
+            stdscr.move(i, 0)
+            stdscr.clrtoeol()
+        shown = lines
+        stdscr.noutrefresh()
+        curses.doupdate()
+        while time.time() - t_start < refresh:
+            key = stdscr.getch()
+            if key in (ord('q'), ord('Q')):
+                return
+            if key == curses.KEY_RESIZE:
+                stdscr.clear()
+                shown = []
+                break
+            time.sleep(0.05)
+
 
-client = MongoClient("mongodb://daq:%s@xenon1t-daq:27017/admin"%os.environ["MONGO_PASSWORD"])
+def main():
+    parser = argparse.ArgumentParser(description='Live DAQ status')
+    parser.add_argument('--config', help='The dispatcher config, for the list of hosts',
+                        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                             '..', 'dispatcher', 'config.ini'))
+    parser.add_argument('--test', action='store_true', help='Use the TESTING section')
+    parser.add_argument('--refresh', type=float, default=1, help='Seconds between redraws')
+    parser.add_argument('--top', type=int, default=5, help='How many channels to show per host')
+    parser.add_argument('--once', action='store_true', help='Print once, no curses')
+    args = parser.parse_args()
 
-db = client['daq']
-collection = db['status']
+    config = configparser.ConfigParser()
+    config.read(args.config)
+    config = config['TESTING' if args.test else 'DEFAULT']
+    client = MongoClient(f'mongodb://{os.environ["MONGO_USER"]}:{os.environ["MONGO_PASSWORD"]}'
+                         f'@127.0.0.1:27017/admin')
+    dashboard = Dashboard(client[config.get('ControlDatabaseName', 'daq')],
+                          json.loads(config['MasterDAQConfig']), args.top,
+                          int(config.get('ClientTimeout', 10)))
+    if args.once:
+        dashboard.Update()
+        for text, _ in dashboard.Lines():
+            print(text)
+        return
+    dashboard.Connect()
+    try:
+        curses.wrapper(Draw, dashboard, args.refresh)
+    except KeyboardInterrupt:
+        pass
 
-clients = ["fdaq00"]
-STATUS = ["Idle", "Arming", "Armed", "Running", "Error"]
 
-while 1:
-    for c in clients:
-        docs= collection.find({"host": c}).sort("_id", -1).limit(1)
-        doc = list(docs)[0]
-        print("%s: Client %s reports status: %s rate: %.2f buffer: %i"%(doc['_id'].generation_time,
-                                                                        doc['host'], STATUS[doc['status']], doc['rate'],
-                                                                        doc['buffer_length']))
-    time.sleep(1)
+if __name__ == '__main__':
+    main()
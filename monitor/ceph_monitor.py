@@ -1,104 +1,252 @@
-import subprocess
-import re
-import psutil
+#!/daq_common/miniconda3/bin/python3
+"""
+Ceph monitor
+
+Every --interval seconds runs `ceph osd status` and `ceph status` (concurrently,
+with --format json) and stores the result in the system_monitor collection.
+To keep the collection small, only the fields that changed since the previous
+cycle are written ('type': 'delta'), with a complete document ('type': 'full')
+every --full-every seconds. Documents are inserted in batches, and kept in a
+local buffer while the database is unreachable.
+
+For testing without a cluster, point --ceph at fake_ceph.py, which replays
+outputs captured with --record.
+"""
+import argparse
+import collections
+import datetime
+import json
 import os
+import subprocess
 import time
 from pymongo import MongoClient
-from pymongo.errors import NotMasterError
-import datetime
-timeout=2
-factors = {'k': 1e3, 'M': 1e6, 'G': 1e9, 'T': 1e12, 'B': 1, 'MiB': 1e6, 'GiB': 1e9,
-           'TiB': 1e12, 'kiB': 1e3, 'kB': 1e3, 'objects,': 1}
+from pymongo.errors import BulkWriteError, PyMongoError
+
+# fields of each osd we keep, and what we call them
+osd_fields = {'kb used': 'kb_used', 'kb available': 'kb_available',
+              'wr ops': 'wr_ops', 'wr data': 'wr_data',
+              'rd ops': 'rd_ops', 'rd data': 'rd_data',
+              'state': 'state', 'host name': 'host'}
 
 
-def CheckOSDs():
-    result = subprocess.check_output(['ceph', 'osd', 'status'])
-    lines = result.decode().split('\n')
-    ansi_escape = re.compile(r'\x1B[@-_][0-?]*[ -/]*[@-~]')
-    skipped_header = False
-    headers = []
+def RunCeph(ceph, args, record=None):
+    """
+    Starts 'ceph <args> --format json' for each args, and waits for all of them
+    :param ceph: the ceph executable
+    :param args: list of argument lists, eg [['osd', 'status'], ['status']]
+    :param record: optional directory to save the raw outputs to
+    :returns: list of decoded outputs, None where the command failed
+    """
+    procs = [subprocess.Popen([ceph] + a + ['--format', 'json'], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE) for a in args]
     ret = []
-    for line in lines:
-        res_list = line.split('|')
-        if len(res_list) == 1:
+    for a, p in zip(args, procs):
+        try:
+            out, err = p.communicate(timeout=30)
+        except subprocess.TimeoutExpired:
+            p.kill()
+            p.communicate()
+            print(f'ceph {" ".join(a)} timed out')
+            ret.append(None)
             continue
-        if skipped_header == False:
-            skipped_header=True
-            for h in res_list:
-                if h.strip() != '':
-                    headers.append(h.strip())
+        if p.returncode != 0:
+            print(f'ceph {" ".join(a)} returned {p.returncode}: {err.decode(errors="replace")}')
+            ret.append(None)
             continue
-        thisdoc = {}
-
-        hi = 0
-        for i, res in enumerate(res_list):
-            if res.strip() != '':
-                field = ansi_escape.sub('', res).strip()
-                if field.isdigit():
-                    thisdoc[headers[hi]] = int(field)
-                elif (field[len(field)-1] in ['k', 'M', 'G', 'T'] and
-                      field[:-1].replace(".", "", 1).isdigit()):
-                    thisdoc[headers[hi]] = float(float(field[:-1]) *
-                                            factors[field[len(field)-1]])
-                else:
-                    thisdoc[headers[hi]] = field
-                hi+=1
-        ret.append(thisdoc)
+        if record is not None:
+            name = '_'.join(a)
+            with open(os.path.join(record, f'{name}.{time.time():.3f}.json'), 'wb') as f:
+                f.write(out)
+        try:
+            ret.append(json.loads(out))
+        except ValueError as e:
+            print(f'Couldn\'t parse output of ceph {" ".join(a)}: {e}')
+            ret.append(None)
     return ret
 
-def CheckStatus():
-    ''' This function is really fixed to the format of ceph status. 
-    I don't really know how to do it otherwise since I only see the
-    output of the cluster I have.'''
-    
-    result = subprocess.check_output(['ceph', 'status'])
-    lines = result.decode().split('\n')
-    ret = {'time' : datetime.datetime.utcnow()}
-    for line in lines:
-        
-        res_list = [a.strip() for a in line.split(' ') if a != '']
-        if len(res_list) < 2:
-            continue
-        if res_list[0] == 'health:':
-            ret['health'] = res_list[1]
-        #elif res_list[0] == 'mon:':
-        #    ret['monitors'] = int(res_list[1])
-        #    ret['monitor_hosts'] = res_list[4]
-        elif res_list[0] == 'mgr:':
-            ret['manager'] = res_list[1]
-        elif res_list[0] == 'pools:':
-            ret['pools'] = int(res_list[1])
-            ret['pool_pgs'] = int(res_list[3])
-        #elif res_list[0] == 'objects:':
-        #    ret['objects'] = int(float(res_list[1]) * factors[res_list[2]])
-        #    ret['object_size'] = int(float(res_list[3]) * factors[res_list[4]])
-        elif res_list[0] == 'usage':
-            ret['used_space'] = int(float(res_list[1])*factors[res_list[2]])
-            ret['available_space'] = int(float(res_list[4]) * factors[res_list[5]])
-            ret['total_space'] = int(float(res_list[7])*factors[res_list[8]])
-        #elif res_list[0] == 'client:':
-        #    ret['rd_s'] = int(res_list[1]) * factors[(res_list[2].split('/')[0])]
-        #    ret['wt_s'] = int(res_list[4]) * factors[(res_list[5].split('/')[0])]
-        #    ret['rd_op_s'] = int(res_list[7])
-        #    ret['wt_op_s'] = int(res_list[10])
+
+def ParseOSDs(osd_status):
+    """
+    Turns the output of `ceph osd status --format json` into {osd id: {field: value}}
+    """
+    # newer releases wrap the list in {'OSDs': [...]}
+    if isinstance(osd_status, dict):
+        osd_status = osd_status.get('OSDs', [])
+    ret = {}
+    for osd in osd_status:
+        ret[str(osd['id'])] = {new: osd[old] for old, new in osd_fields.items() if old in osd}
+    return ret
+
+
+def ParseStatus(status):
+    """Turns the output of `ceph status --format json` into a flat dict"""
+    pgmap = status.get('pgmap', {})
+    ret = {
+        'health': status.get('health', {}).get('status'),
+        'manager': status.get('mgrmap', {}).get('active_name'),
+        'pools': pgmap.get('num_pools'),
+        'pool_pgs': pgmap.get('num_pgs'),
+        'objects': pgmap.get('num_objects'),
+        'used_space': pgmap.get('bytes_used'),
+        'available_space': pgmap.get('bytes_avail'),
+        'total_space': pgmap.get('bytes_total'),
+        'rd_s': pgmap.get('read_bytes_sec', 0),
+        'wt_s': pgmap.get('write_bytes_sec', 0),
+        'rd_op_s': pgmap.get('read_op_per_sec', 0),
+        'wt_op_s': pgmap.get('write_op_per_sec', 0),
+    }
+    osdmap = status.get('osdmap', {})
+    # this moved around between releases
+    osdmap = osdmap.get('osdmap', osdmap)
+    ret['osds_up'] = osdmap.get('num_up_osds')
+    ret['osds_in'] = osdmap.get('num_in_osds')
+    return ret
+
+
+def Diff(old, new):
+    """The entries of new that aren't the same in old. Nested dicts are diffed recursively"""
+    ret = {}
+    for k, v in new.items():
+        if isinstance(v, dict) and isinstance(old.get(k), dict):
+            if d := Diff(old[k], v):
+                ret[k] = d
+        elif k not in old or old[k] != v:
+            ret[k] = v
     return ret
 
-client = MongoClient("mongodb://daq:%s@xenon1t-daq:27017/admin"%os.environ["MONGO_PASSWORD_DAQ"])
-db = client['daq']
-coll = db['system_monitor']
-while(1):
-    osds = CheckOSDs()
-    stat = CheckStatus()
-    stat['osds'] = osds
-    
-    statvfs = os.statvfs('/live_data')
-    stat['host'] = 'ceph'
-    stat['ceph_size'] = statvfs.f_frsize * statvfs.f_blocks
-    stat['ceph_free'] = statvfs.f_frsize * statvfs.f_bfree
-    stat['ceph_available'] = statvfs.f_frsize * statvfs.f_bavail
+
+class Collector(object):
+    """Keeps the previous state and turns each new one into a full or delta document"""
+
+    def __init__(self, full_every):
+        self.full_every = full_every
+        self.last = None
+        self.last_full = 0
+
+    def Document(self, state, now):
+        """
+        :param state: {'osds': {...}, cluster fields...}
+        :param now: unix time of this state
+        :returns: document to insert, or None if nothing changed
+        """
+        if self.last is None or now - self.last_full >= self.full_every:
+            doc = dict(state)
+            doc['type'] = 'full'
+            self.last_full = now
+        elif changed := Diff(self.last, state):
+            doc = changed
+            doc['type'] = 'delta'
+        else:
+            doc = None
+        self.last = state
+        if doc is not None:
+            doc['host'] = 'ceph'
+            doc['time'] = datetime.datetime.utcfromtimestamp(now)
+        return doc
+
+
+class BufferedWriter(object):
+    """
+    Batches documents and inserts them with insert_many. If that fails they stay
+    in the buffer (oldest dropped first once it is full) and we retry later.
+    """
+
+    def __init__(self, coll, batch_size, flush_interval, max_buffer):
+        self.coll = coll
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer = collections.deque(maxlen=max_buffer)
+        self.last_flush = time.time()
+
+    def Add(self, doc):
+        if len(self.buffer) == self.buffer.maxlen:
+            print('Buffer full, dropping the oldest document')
+        self.buffer.append(doc)
+        if (len(self.buffer) >= self.batch_size or
+                time.time() - self.last_flush >= self.flush_interval):
+            self.Flush()
+
+    def Flush(self):
+        self.last_flush = time.time()
+        while len(self.buffer) > 0:
+            batch = [self.buffer[i] for i in range(min(self.batch_size, len(self.buffer)))]
+            if self.coll is None:
+                for doc in batch:
+                    print(doc)
+            else:
+                try:
+                    self.coll.insert_many(batch, ordered=True)
+                except BulkWriteError as e:
+                    # the first nInserted made it. The documents got their _id on the
+                    # first try, so one that's already there from an earlier attempt
+                    # shows up as a duplicate key and can go too
+                    done = e.details.get('nInserted', 0)
+                    errors = e.details.get('writeErrors', [])
+                    if errors and errors[0].get('code') == 11000:
+                        done += 1
+                    for _ in range(done):
+                        self.buffer.popleft()
+                    if done == 0:
+                        print(f'DB issue, {len(self.buffer)} documents buffered: {e.details}')
+                        return
+                    continue
+                except PyMongoError as e:
+                    print(f'DB issue, {len(self.buffer)} documents buffered: {type(e)}, {e}')
+                    return
+            for _ in batch:
+                self.buffer.popleft()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ceph monitor')
+    parser.add_argument('--ceph', default='ceph', help='The ceph executable')
+    parser.add_argument('--interval', type=float, default=2, help='Seconds between checks')
+    parser.add_argument('--full-every', type=float, default=60,
+                        help='Seconds between full (not delta) documents')
+    parser.add_argument('--batch', type=int, default=30, help='Documents per insert')
+    parser.add_argument('--flush', type=float, default=30,
+                        help='Insert at least this often (s), even if the batch isn\'t full')
+    parser.add_argument('--max-buffer', type=int, default=100000,
+                        help='How many documents to keep while the DB is down')
+    parser.add_argument('--mount', default='/live_data', help='Where ceph is mounted')
+    parser.add_argument('--record', help='Save the raw ceph outputs to this directory')
+    parser.add_argument('--dry-run', action='store_true', help='Print instead of inserting')
+    parser.add_argument('--cycles', type=int, default=0, help='Stop after this many, 0 = never')
+    args = parser.parse_args()
+
+    if args.dry_run:
+        coll = None
+    else:
+        client = MongoClient("mongodb://daq:%s@xenon1t-daq:27017/admin" % os.environ["MONGO_PASSWORD_DAQ"])
+        coll = client['daq']['system_monitor']
+    if args.record is not None:
+        os.makedirs(args.record, exist_ok=True)
+    collector = Collector(args.full_every)
+    writer = BufferedWriter(coll, args.batch, args.flush, args.max_buffer)
+
+    cycle = 0
     try:
-        coll.insert(stat)
-    except:
+        while args.cycles == 0 or cycle < args.cycles:
+            t_start = time.time()
+            cycle += 1
+            osd_status, status = RunCeph(args.ceph, [['osd', 'status'], ['status']], args.record)
+            state = {}
+            if osd_status is not None:
+                state['osds'] = ParseOSDs(osd_status)
+            if status is not None:
+                state.update(ParseStatus(status))
+            if os.path.exists(args.mount):
+                statvfs = os.statvfs(args.mount)
+                state['ceph_size'] = statvfs.f_frsize * statvfs.f_blocks
+                state['ceph_free'] = statvfs.f_frsize * statvfs.f_bfree
+                state['ceph_available'] = statvfs.f_frsize * statvfs.f_bavail
+            if state and (doc := collector.Document(state, t_start)) is not None:
+                writer.Add(doc)
+            time.sleep(max(0, args.interval - (time.time() - t_start)))
+    except KeyboardInterrupt:
         pass
-    time.sleep(timeout)
+    writer.Flush()
+
 
+if __name__ == '__main__':
+    main()
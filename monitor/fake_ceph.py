@@ -0,0 +1,39 @@
+#!/usr/bin/env python3
+"""
+Stand-in for the ceph executable, for testing ceph_monitor.py
+
+Replays outputs captured with `ceph_monitor.py --record DIR`: each call of
+`fake_ceph.py <args> --format json` prints the next capture of that command
+from $FAKE_CEPH_DIR (osd_status.*.json for `osd status`, etc), in order,
+starting over when it runs out.
+    FAKE_CEPH_DIR=captures ./ceph_monitor.py --ceph ./fake_ceph.py --dry-run
+"""
+import glob
+import os
+import sys
+
+
+def main():
+    args = [a for a in sys.argv[1:] if not a.startswith('--') and a != 'json']
+    name = '_'.join(args)
+    capture_dir = os.environ.get('FAKE_CEPH_DIR', '.')
+    captures = sorted(glob.glob(os.path.join(capture_dir, f'{name}.*.json')))
+    if len(captures) == 0:
+        print(f'No captures of "{" ".join(args)}" in {capture_dir}', file=sys.stderr)
+        return 1
+    # remember where we are for each command
+    counter = os.path.join(capture_dir, f'.{name}.next')
+    try:
+        with open(counter) as f:
+            i = int(f.read())
+    except (OSError, ValueError):
+        i = 0
+    with open(captures[i % len(captures)], 'rb') as f:
+        sys.stdout.buffer.write(f.read())
+    with open(counter, 'w') as f:
+        f.write(str(i + 1))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
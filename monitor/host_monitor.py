@@ -0,0 +1,262 @@
+#!/daq_common/miniconda3/bin/python3
+"""
+Host monitor for the reader machines
+
+Runs a set of collectors (CPU per core, memory, disk I/O of the device holding
+strax_output_path, network per NIC, and the redax processes), each on its own
+schedule. Every --write-interval seconds the samples are downsampled into one
+document per host (mean of each quantity, and its max under 'max') and stored in
+the system_monitor collection, next to what the ceph monitor writes, in batches.
+Run one per machine.
+"""
+import argparse
+import datetime
+import heapq
+import os
+import socket
+import time
+import psutil
+from pymongo import MongoClient
+from ceph_monitor import BufferedWriter
+
+
+class Collector(object):
+    """
+    Base class for collectors. Sample() returns a dict of numbers (may be nested),
+    or None if there's nothing to report this time
+    """
+    name = None
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def Sample(self):
+        raise NotImplementedError
+
+
+class RateCollector(Collector):
+    """For counters that only ever go up, reports their per-second rate"""
+
+    def __init__(self, interval):
+        super().__init__(interval)
+        self.last = None
+
+    def Counters(self):
+        """dict of name: {field: cumulative value}"""
+        raise NotImplementedError
+
+    def Sample(self):
+        now, counters = time.time(), self.Counters()
+        last, self.last = self.last, (now, counters)
+        if last is None:
+            return None
+        dt = now - last[0]
+        return {name: {f'{field}_per_s': max(0, (v - last[1][name][field]) / dt)
+                       for field, v in fields.items()}
+                for name, fields in counters.items() if name in last[1]}
+
+
+class CPUCollector(Collector):
+    name = 'cpu'
+
+    def __init__(self, interval):
+        super().__init__(interval)
+        # the first call only sets the reference point
+        psutil.cpu_percent(percpu=True)
+
+    def Sample(self):
+        per_core = psutil.cpu_percent(percpu=True)
+        load1, load5, load15 = os.getloadavg()
+        return {'percent': sum(per_core) / len(per_core),
+                'per_core': {str(i): p for i, p in enumerate(per_core)},
+                'load1': load1, 'load5': load5, 'load15': load15}
+
+
+class MemoryCollector(Collector):
+    name = 'memory'
+
+    def Sample(self):
+        vm = psutil.virtual_memory()
+        swap = psutil.swap_memory()
+        return {'percent': vm.percent, 'used': vm.used, 'available': vm.available,
+                'cached': getattr(vm, 'cached', 0), 'swap_used': swap.used}
+
+
+class DiskCollector(RateCollector):
+    """Read/write bandwidth of the device that holds path, and how full it is"""
+    name = 'disk'
+
+    def __init__(self, interval, path):
+        self.path = path
+        self.device = self.FindDevice(path)
+        super().__init__(interval)
+
+    @staticmethod
+    def FindDevice(path):
+        """The disk name psutil uses for the partition holding path, None if unknown"""
+        path = os.path.realpath(path)
+        best = None
+        for part in psutil.disk_partitions(all=False):
+            if path.startswith(part.mountpoint) and (
+                    best is None or len(part.mountpoint) > len(best.mountpoint)):
+                best = part
+        if best is None:
+            return None
+        return os.path.basename(os.path.realpath(best.device))
+
+    def Counters(self):
+        counters = psutil.disk_io_counters(perdisk=True)
+        if self.device not in counters:
+            return {}
+        c = counters[self.device]
+        return {'io': {'read_bytes': c.read_bytes, 'write_bytes': c.write_bytes,
+                       'read_count': c.read_count, 'write_count': c.write_count}}
+
+    def Sample(self):
+        ret = super().Sample() or {}
+        usage = psutil.disk_usage(self.path)
+        ret['free'] = usage.free
+        ret['percent'] = usage.percent
+        return ret
+
+
+class NetworkCollector(RateCollector):
+    name = 'network'
+
+    def Counters(self):
+        return {nic: {'bytes_sent': c.bytes_sent, 'bytes_recv': c.bytes_recv,
+                      'dropin': c.dropin, 'dropout': c.dropout}
+                for nic, c in psutil.net_io_counters(pernic=True).items() if nic != 'lo'}
+
+
+class ProcessCollector(Collector):
+    """CPU, memory and I/O of the processes whose executable is called {match}"""
+    name = 'redax'
+
+    def __init__(self, interval, match='redax'):
+        super().__init__(interval)
+        self.match = match
+        self.procs = {}
+
+    def Sample(self):
+        ret = {}
+        seen = set()
+        for p in psutil.process_iter(['pid', 'name', 'cmdline']):
+            # exactly, not as a substring: screen -S redax0, the dispatcher under
+            # .../redax/dispatcher and this monitor aren't redax
+            exe = os.path.basename((p.info['cmdline'] or [''])[0])
+            if p.info['name'] != self.match and exe != self.match:
+                continue
+            seen.add(p.pid)
+            if p.pid not in self.procs:
+                # the first cpu_percent call only sets the reference point
+                self.procs[p.pid] = p
+                p.cpu_percent()
+                continue
+            try:
+                with p.oneshot():
+                    io = p.io_counters()
+                    ret[str(p.pid)] = {'cpu_percent': p.cpu_percent(),
+                                       'rss': p.memory_info().rss,
+                                       'threads': p.num_threads(),
+                                       'read_bytes': io.read_bytes,
+                                       'write_bytes': io.write_bytes}
+            except (psutil.NoSuchProcess, psutil.AccessDenied):
+                continue
+        for pid in set(self.procs) - seen:
+            del self.procs[pid]
+        return ret or None
+
+
+def Downsample(samples):
+    """
+    Combine a list of (nested) sample dicts into their mean and max, leaf by leaf
+    :returns: (mean dict, max dict)
+    """
+    sums, maxes, counts = {}, {}, {}
+
+    def add(sample, s, m, c):
+        for k, v in sample.items():
+            if isinstance(v, dict):
+                add(v, s.setdefault(k, {}), m.setdefault(k, {}), c.setdefault(k, {}))
+            elif isinstance(v, (int, float)):
+                s[k] = s.get(k, 0) + v
+                m[k] = max(m.get(k, v), v)
+                c[k] = c.get(k, 0) + 1
+
+    def mean(s, c):
+        return {k: mean(v, c[k]) if isinstance(v, dict) else v / c[k] for k, v in s.items()}
+
+    for sample in samples:
+        add(sample, sums, maxes, counts)
+    return mean(sums, counts), maxes
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Host monitor')
+    parser.add_argument('--output-path', default='./',
+                        help='strax_output_path, we watch the disk it is on')
+    parser.add_argument('--process', default='redax', help='Executable name of the processes to watch')
+    parser.add_argument('--interval', nargs='*', default=[],
+                        help='Sampling interval of collectors, eg cpu=1 disk=2 (s)')
+    parser.add_argument('--write-interval', type=float, default=10,
+                        help='One document per this many seconds')
+    parser.add_argument('--batch', type=int, default=6, help='Documents per insert')
+    parser.add_argument('--max-buffer', type=int, default=10000,
+                        help='How many documents to keep while the DB is down')
+    parser.add_argument('--dry-run', action='store_true', help='Print instead of inserting')
+    args = parser.parse_args()
+
+    intervals = {'cpu': 1, 'memory': 5, 'disk': 1, 'network': 1, 'redax': 2}
+    for kv in args.interval:
+        k, v = kv.split('=')
+        intervals[k] = float(v)
+    collectors = [CPUCollector(intervals['cpu']),
+                  MemoryCollector(intervals['memory']),
+                  DiskCollector(intervals['disk'], args.output_path),
+                  NetworkCollector(intervals['network']),
+                  ProcessCollector(intervals['redax'], args.process)]
+
+    if args.dry_run:
+        coll = None
+    else:
+        client = MongoClient("mongodb://daq:%s@xenon1t-daq:27017/admin" % os.environ["MONGO_PASSWORD_DAQ"])
+        coll = client['daq']['system_monitor']
+    # documents come at a fixed rate, so a full batch is also the flush interval
+    writer = BufferedWriter(coll, args.batch, args.batch * args.write_interval, args.max_buffer)
+    hostname = socket.gethostname()
+
+    samples = {c.name: [] for c in collectors}
+    now = time.time()
+    schedule = [(now + c.interval, i) for i, c in enumerate(collectors)]
+    heapq.heapify(schedule)
+    next_write = now + args.write_interval
+    try:
+        while True:
+            due, i = heapq.heappop(schedule)
+            time.sleep(max(0, min(due, next_write) - time.time()))
+            if time.time() >= next_write:
+                heapq.heappush(schedule, (due, i))
+                doc = {'host': hostname, 'type': 'host', 'interval': args.write_interval,
+                       'time': datetime.datetime.utcnow(), 'max': {}}
+                for name, s in samples.items():
+                    if len(s) > 0:
+                        doc[name], doc['max'][name] = Downsample(s)
+                        s.clear()
+                writer.Add(doc)
+                next_write += args.write_interval
+                continue
+            c = collectors[i]
+            try:
+                if (sample := c.Sample()) is not None:
+                    samples[c.name].append(sample)
+            except Exception as e:
+                print(f'{c.name} collector ran into {type(e)}: {e}')
+            heapq.heappush(schedule, (max(due + c.interval, time.time()), i))
+    except KeyboardInterrupt:
+        pass
+    writer.Flush()
+
+
+if __name__ == '__main__':
+    main()